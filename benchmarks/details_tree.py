@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""Benchmark of expanding and scrolling through a node of the details tree that has a large number
+of children.
+
+Run with:
+
+    python benchmarks/details_tree.py [num_children]
+"""
+import sys
+import time
+import timeit
+
+from PySide2 import QtWidgets
+
+from mincepy_gui import entry_details
+
+
+def linear_row(item: entry_details.BaseTreeItem) -> int:
+    """Find the row of an item the way it used to be done: by searching the children of its
+    parent"""
+    for row, child in item.parent()._children.items():  # pylint: disable=protected-access
+        if child is item:
+            return row
+    raise ValueError("'{}' is not a child".format(item))
+
+
+def main(num_children=100000, repeat=5):
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication(sys.argv)
+
+    model = entry_details.EntryDetails()
+    builder = model._item_builder  # pylint: disable=protected-access
+    data = {'wide': {str(idx): idx for idx in range(num_children)}}
+    root = entry_details.LazyMappingItem(entry_details.EntryDetails.COLUMN_HEADERS, data, builder,
+                                         len(data))
+    model.set_tree(None, root)
+    view = QtWidgets.QTreeView()
+    view.setModel(model)
+    view.resize(800, 600)
+    view.show()
+    app.processEvents()
+
+    def report(name, seconds, number=1):
+        print('{:<45} {:>10.3f} ms'.format(name, seconds / number * 1e3))
+
+    print('Details tree node with {} children'.format(num_children))
+
+    start = time.perf_counter()
+    wide = model.index(0, 0)
+    view.expand(wide)
+    app.processEvents()
+    report('expand', time.perf_counter() - start)
+    print('{:<45} {:>10}'.format('children built by expand', len(wide.internalPointer()._children)))  # pylint: disable=protected-access
+
+    # Scroll all the way through, a page at a time, as if holding page down.  More children are
+    # fetched each time the bottom is reached.
+    scroll_bar = view.verticalScrollBar()
+    num_pages = 0
+    start = time.perf_counter()
+    while scroll_bar.value() < scroll_bar.maximum() or model.canFetchMore(wide):
+        scroll_bar.setValue(scroll_bar.value() + max(scroll_bar.pageStep(), 1))
+        view.viewport().repaint()
+        app.processEvents()
+        num_pages += 1
+    report('scroll, per page', time.perf_counter() - start, num_pages)
+
+    # Every child has been fetched now so time parent lookups in isolation
+    children = [model.index(row, 0, wide) for row in range(num_children)]
+    number = 3
+    best = min(
+        timeit.repeat(lambda: [model.parent(child) for child in children],
+                      number=number,
+                      repeat=repeat))
+    report('parent() of every child', best, number)
+
+    # The old approach is quadratic so only time it on the last few rows, the worst case
+    items = [child.internalPointer() for child in children[-1000:]]
+    best = min(timeit.repeat(lambda: [linear_row(item) for item in items], number=1, repeat=repeat))
+    report('row lookup of last 1000 (search, as before)', best)
+    best = min(timeit.repeat(lambda: [item.row() for item in items], number=1, repeat=repeat))
+    report('row lookup of last 1000 (stored row)', best)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""Micro-benchmark of encoding and decoding queries as typed into the query line.
+
+Run with:
+
+    python benchmarks/query_codec.py [num_obj_ids]
+"""
+import json
+import sys
+import timeit
+import uuid
+
+import bson
+from pytray import tree
+
+from mincepy_gui import utils
+
+
+def tree_transform_decode(text: str):
+    """Decode the way it used to be done: decode everything then transform the result"""
+
+    def to_obj(entry, path):  # pylint: disable=unused-argument
+        if isinstance(entry, str):
+            if entry.startswith('UUID('):
+                try:
+                    return uuid.UUID(entry[6:-2])
+                except ValueError:
+                    pass
+            elif entry.startswith('ObjectId'):
+                try:
+                    return bson.ObjectId(entry[10:-2])
+                except ValueError:
+                    pass
+        return entry
+
+    return tree.transform(to_obj, json.loads(text))
+
+
+def main(num_obj_ids=50000, repeat=5):
+    # A query with a long list of ids, as pasted into the object ids line.  The list is nested so,
+    # as before, its entries are left as strings
+    ids_query = {
+        'obj_type': 'Car',
+        'obj_id': {
+            '$in': [repr(uuid.uuid4()) for _ in range(num_obj_ids // 2)] +
+                   [repr(bson.ObjectId()) for _ in range(num_obj_ids // 2)]
+        },
+    }
+    # A query without any literals, as most are
+    plain_query = {
+        'obj_type': 'Car',
+        'state.make': {
+            '$in': [str(idx) for idx in range(num_obj_ids)]
+        },
+    }
+    plain_query.update({'state.field{}'.format(idx): idx for idx in range(num_obj_ids)})
+    # A query with many top level entries, all of which are converted
+    wide_query = {'ref{}'.format(idx): uuid.uuid4() for idx in range(num_obj_ids)}
+
+    codec = utils.QueryCodec()
+    ids_text = json.dumps(ids_query, cls=utils.UUIDEncoder)
+    wide_text = json.dumps(wide_query, cls=utils.UUIDEncoder)
+    plain_text = json.dumps(plain_query, cls=utils.UUIDEncoder)
+    assert codec.decode(plain_text) == tree_transform_decode(plain_text) == plain_query
+    assert codec.decode(ids_text) == tree_transform_decode(ids_text) == ids_query
+    assert codec.decode(wide_text) == tree_transform_decode(wide_text) == wide_query
+
+    def report(name, func, number):
+        best = min(timeit.repeat(func, number=number, repeat=repeat)) / number
+        print('{:<45} {:>10.3f} ms'.format(name, best * 1e3))
+
+    print('Queries with {} object ids'.format(num_obj_ids))
+    report('decode plain query (decode then transform)', lambda: tree_transform_decode(plain_text),
+           3)
+    report('decode plain query (QueryCodec)', lambda: codec.decode(plain_text), 3)
+    report('decode wide query (decode then transform)', lambda: tree_transform_decode(wide_text), 3)
+    report('decode wide query (QueryCodec)', lambda: codec.decode(wide_text), 3)
+    report('decode ids query (decode then transform)', lambda: tree_transform_decode(ids_text), 3)
+    report('decode ids query (QueryCodec)', lambda: codec.decode(ids_text), 3)
+    report('encode ids query (json.dumps)', lambda: json.dumps(ids_query, cls=utils.UUIDEncoder), 3)
+    report('encode ids query (QueryCodec, unchanged)', lambda: codec.encode(ids_query), 1000)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
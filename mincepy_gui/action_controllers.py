@@ -24,6 +24,8 @@ class ActionContext(AutoNumber):
     PARENT = ()
     CLIPBOARD = ()
     DATABASE = ()
+    # The cache of loaded objects and snapshots, see caching.ObjectCache
+    OBJECT_CACHE = ()
 
 
 CONTEXT_CLIPBOARD = ActionContext.CLIPBOARD
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""Module containing caches used to avoid recomputing or reloading things"""
+import collections
+import threading
+import time
+from typing import Any, Callable, Hashable, Iterable, List, Optional
+
+import mincepy
+
+from . import sources
+from . import utils
+
+__all__ = 'LRUCache', 'ObjectCache'
+
+_MISSING = object()
+
+# Approximate overhead of a cache entry, i.e. the key and the bookkeeping
+ENTRY_OVERHEAD = 100
+
+
+def entry_size(value) -> int:
+    """The default way of sizing cache entries"""
+    return utils.approx_size(value) + ENTRY_OVERHEAD
+
+
+class LRUCache:
+    """A thread safe, least recently used, cache that is bounded by the (approximate) number of bytes
+    that its values take up.  Optionally, entries can expire a fixed time after they were put."""
+
+    def __init__(self,
+                 max_bytes: int,
+                 sizeof: Callable[[Any], int] = entry_size,
+                 ttl: Optional[float] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        """
+        :param max_bytes: the maximum number of bytes that the cache will hold
+        :param sizeof: a callable used to get the size of a value in bytes
+        :param ttl: the time to live of entries in seconds, None means they never expire
+        :param clock: the clock used to expire entries
+        """
+        self._max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._ttl = ttl
+        self._clock = clock
+        self._lock = threading.RLock()
+        self._entries = collections.OrderedDict()  # key -> (value, size, expiry time)
+        self._num_bytes = 0
+        self._hits = 0
+        self._misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            entry = self._entries.get(key, None)
+            return entry is not None and not self._expired(entry)
+
+    @property
+    def max_bytes(self) -> int:
+        return self._max_bytes
+
+    @property
+    def num_bytes(self) -> int:
+        """The approximate number of bytes currently held"""
+        return self._num_bytes
+
+    @property
+    def hits(self) -> int:
+        return self._hits
+
+    @property
+    def misses(self) -> int:
+        return self._misses
+
+    @property
+    def hit_rate(self) -> float:
+        """The fraction of lookups that were found in the cache"""
+        total = self._hits + self._misses
+        return self._hits / total if total else 0.
+
+    def get(self, key: Hashable, default=None):
+        """Get the value for the given key, or the default if there isn't one"""
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is not _MISSING and self._expired(entry):
+                self.pop(key)
+                entry = _MISSING
+            if entry is _MISSING:
+                self._misses += 1
+                return default
+
+            self._hits += 1
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: Hashable, value, size: int = None):
+        """Put a value in the cache, evicting the least recently used entries if needed.  Values
+        that are bigger than the cache itself are not stored."""
+        if size is None:
+            size = self._sizeof(value)
+
+        with self._lock:
+            self.pop(key)
+            if size > self._max_bytes:
+                return
+
+            expiry = None if self._ttl is None else self._clock() + self._ttl
+            self._entries[key] = value, size, expiry
+            self._num_bytes += size
+            while self._num_bytes > self._max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._num_bytes -= evicted_size
+
+    def pop(self, key: Hashable, default=None):
+        """Remove the entry with the given key, returning its value (or the default if there isn't
+        one)"""
+        with self._lock:
+            entry = self._entries.pop(key, _MISSING)
+            if entry is _MISSING:
+                return default
+
+            self._num_bytes -= entry[1]
+            return entry[0]
+
+    def keys(self) -> List[Hashable]:
+        """Get the keys currently in the cache, least recently used first"""
+        with self._lock:
+            return list(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._num_bytes = 0
+
+    def _expired(self, entry: tuple) -> bool:
+        expiry = entry[2]
+        return expiry is not None and self._clock() >= expiry
+
+
+class ObjectCache:
+    """A memory bounded, least recently used, cache of full records, objects and snapshots loaded
+    from the archive keyed by (obj_id, version).  Their size is estimated from the size of the
+    record state.  This is thread safe and can be shared by anything that loads objects."""
+    DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+    RECORD = 'record'
+    OBJECT = 'object'
+    SNAPSHOT = 'snapshot'
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self._cache = LRUCache(max_bytes)
+
+    @property
+    def hits(self) -> int:
+        return self._cache.hits
+
+    @property
+    def misses(self) -> int:
+        return self._cache.misses
+
+    @property
+    def hit_rate(self) -> float:
+        """The fraction of lookups that were found in the cache"""
+        return self._cache.hit_rate
+
+    def get_full_record(self,
+                        historian: mincepy.Historian,
+                        record: mincepy.DataRecord,
+                        load=True) -> Optional[mincepy.DataRecord]:
+        """Get the full record for a record that may be partial.  If it isn't cached and 'load' is
+        False then None is returned."""
+        if not isinstance(record, sources.PartialRecord):
+            return record
+        return self._get(self.RECORD, record,
+                         (lambda: sources.load_full_record(historian, record)) if load else None)
+
+    def get_object(self, record: mincepy.DataRecord, load=True):
+        """Get the object of the given (full) record.  If it isn't cached and 'load' is False then
+        None is returned."""
+        return self._get(self.OBJECT, record, record.load if load else None)
+
+    def get_snapshot(self, record: mincepy.DataRecord, load=True):
+        """Get the snapshot of the given (full) record.  If it isn't cached and 'load' is False then
+        None is returned."""
+        return self._get(self.SNAPSHOT, record, record.load_snapshot if load else None)
+
+    def invalidate(self, obj_ids: Iterable):
+        """Remove everything cached for the given objects"""
+        obj_ids = set(obj_ids)
+        for key in self._cache.keys():
+            if key[1] in obj_ids:
+                self._cache.pop(key)
+
+    def clear(self):
+        self._cache.clear()
+
+    def _get(self, kind: str, record: mincepy.DataRecord, loader: Optional[Callable[[], Any]]):
+        key = kind, record.obj_id, record.version
+        if loader is None and key not in self._cache:
+            # Only peeking so don't count it as a miss
+            return None
+
+        value = self._cache.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        value = loader()
+        if value is not None:
+            state = value.state if isinstance(value, mincepy.DataRecord) else record.state
+            self._cache.put(key, value, size=entry_size(state))
+        return value
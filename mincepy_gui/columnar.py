@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""Module for a compact, column oriented, representation of the records loaded into the entries
+table"""
+from typing import Any, List, Optional, Sequence
+
+from PySide2 import QtCore
+import mincepy
+from pytray import tree
+
+from . import columns as cols
+from . import common
+from . import sources
+
+__all__ = 'ColumnarBatch', 'RowHandle'
+
+# Stands in for the values of columns that the record doesn't have, so their cells show nothing
+_MISSING = object()
+
+
+class ColumnarBatch:
+    """The values of the columns for a batch of records, extracted once into flat per column lists.
+    The records themselves are not kept, each row has a RowHandle with just enough to load its
+    record again.  The state of each record is kept so that the values of state columns added later
+    can be extracted when they are first needed.  Records are normally projected to the columns
+    shown, in which case this is little more than the values themselves."""
+    __slots__ = '_values', '_states'
+
+    def __init__(self,
+                 records: Sequence[mincepy.DataRecord],
+                 columns: Sequence[cols.Column],
+                 historian: Optional[mincepy.Historian] = None):
+        # Column -> list of values
+        self._values = {
+            col: [_extract(col, record, historian) for record in records] for col in columns
+        }
+        self._states = [record.state for record in records]
+
+    def __contains__(self, column: cols.Column) -> bool:
+        """Returns True if the batch has (or can extract) the values of the given column"""
+        return column in self._values or _is_state_column(column)
+
+    def value(self, column: cols.Column, index: int) -> Any:
+        """Get the value of the given column at the given index, _MISSING if the record doesn't
+        have it (or the column isn't in the batch)"""
+        try:
+            values = self._values[column]
+        except KeyError:
+            if not _is_state_column(column):
+                return _MISSING
+            # Added since the batch was created so extract it from the states now
+            values = [_get_value(state, column.path[1:]) for state in self._states]
+            self._values[column] = values
+
+        return values[index]
+
+    def prune(self, columns: Sequence[cols.Column]):
+        """Discard the values of any columns that aren't in the given sequence"""
+        for column in set(self._values).difference(columns):
+            del self._values[column]
+
+    @classmethod
+    def create_handles(cls,
+                       records: Sequence[mincepy.DataRecord],
+                       columns: Sequence[cols.Column],
+                       historian: Optional[mincepy.Historian] = None) -> List['RowHandle']:
+        """Extract the values of the given columns from the records and get a handle for each"""
+        batch = cls(records, columns, historian)
+        # Rows tend to share the same state keys so keep just one copy of each set
+        interned = {}
+        handles = []
+        for index, record in enumerate(records):
+            keys = frozenset(record.state.keys() if isinstance(record.state, dict) else ())
+            handles.append(RowHandle(batch, index, record, interned.setdefault(keys, keys)))
+        return handles
+
+
+class RowHandle:
+    """A row of a columnar batch.  This keeps the identity of the record that the row came from so
+    that the full record can be loaded when it's needed, along with the keys of its state."""
+    __slots__ = 'obj_id', 'version', 'type_id', 'state_keys', 'partial', '_batch', '_index'
+
+    def __init__(self, batch: ColumnarBatch, index: int, record: mincepy.DataRecord,
+                 state_keys: frozenset):
+        self.obj_id = record.obj_id
+        self.version = record.version
+        self.type_id = record.type_id
+        self.state_keys = state_keys
+        # True if the record only had some of its fields
+        self.partial = isinstance(record, sources.PartialRecord)
+        self._batch = batch
+        self._index = index
+
+    @property
+    def batch(self) -> ColumnarBatch:
+        return self._batch
+
+    def __contains__(self, column: cols.Column) -> bool:
+        return column in self._batch
+
+    def lacks(self, column: cols.Column) -> bool:
+        """Returns True if the row doesn't have the value of the given column but the record might,
+        i.e. the record has to be loaded again to find out"""
+        if column not in self._batch:
+            return True
+        # The record may have been projected without this column
+        return self.partial and self._batch.value(column, self._index) is _MISSING
+
+    def data(self, column: cols.Column, role: int, historian: mincepy.Historian = None) -> Any:
+        """Get the data of the given column for the given role"""
+        if role not in (common.DataRole, QtCore.Qt.DisplayRole) or \
+                isinstance(column, cols.TypeColumn):
+            # These only need the identity, e.g. the type is looked up from the type id
+            return column.data(self.to_record(), role, historian)
+
+        value = self._batch.value(column, self._index)
+        if value is _MISSING:
+            return None
+        return value if role == common.DataRole else column.formatter(value)
+
+    def raw_value(self, column: cols.Column) -> Any:
+        """Get the value of the given column as it is in the record, e.g. the type id rather than
+        the type, which is what the archive sorts on.  None if the record doesn't have it."""
+        value = self._batch.value(column, self._index)
+        return None if value is _MISSING else value
+
+    def to_record(self) -> sources.PartialRecord:
+        """Get a partial record with the identity of the record that this row came from"""
+        return sources.PartialRecord.from_dict({
+            mincepy.OBJ_ID: self.obj_id,
+            mincepy.VERSION: self.version,
+            mincepy.TYPE_ID: self.type_id,
+        })
+
+
+def _extract(column: cols.Column, record: mincepy.DataRecord,
+             historian: Optional[mincepy.Historian]) -> Any:
+    """Get the raw value of a column for a record, _MISSING if the record doesn't have it"""
+    if not isinstance(column, cols.DataColumn):
+        value = column.data(record, common.DataRole, historian)
+        return _MISSING if value is None else value
+
+    path = column.path
+    value = getattr(record, path[0])
+    if len(path) > 1:
+        return _get_value(value, path[1:])
+    return value
+
+
+def _is_state_column(column: cols.Column) -> bool:
+    """Returns True if the column shows an entry of the state, these can be extracted from the states
+    that a batch keeps"""
+    return isinstance(column, cols.DataColumn) and len(column.path) > 1 and \
+        column.path[0] == mincepy.STATE
+
+
+def _get_value(value, path: Sequence) -> Any:
+    """Get the value at the given path, _MISSING if there isn't one"""
+    try:
+        return tree.get_by_path(value, path)
+    except (KeyError, IndexError, TypeError):
+        return _MISSING
@@ -1,4 +1,5 @@
 import functools
+from typing import Optional
 
 from PySide2 import QtCore, QtWidgets
 import mincepy
@@ -60,6 +61,7 @@ class DatabaseController(QtCore.QObject):
         self._uri_line = uri_line
         self._connect_button = connect_button
         self._executor = executor
+        self._uri = None  # type: Optional[str]
 
         self._uri_line.setText(default_uri)
 
@@ -71,6 +73,11 @@ class DatabaseController(QtCore.QObject):
     def database_model(self) -> ConstDatabaseModel:
         return self._db_model
 
+    @property
+    def uri(self) -> Optional[str]:
+        """The URI of the database that we last connected to"""
+        return self._uri
+
     def _handle_connect(self):
         uri = self._uri_line.text()
         self._executor(functools.partial(self._connect, uri), "Connecting", blocking=True)
@@ -82,6 +89,7 @@ class DatabaseController(QtCore.QObject):
             err_msg = "Error creating historian with uri '{}':\n{}".format(uri, exc)
             raise RuntimeError(err_msg)
         else:
+            self._uri = uri
             self.historian_created.emit(historian)
 
         return "Connected to {}".format(uri)
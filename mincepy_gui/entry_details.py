@@ -1,25 +1,35 @@
 # -*- coding: utf-8 -*-
 """Module for display details about a database entry"""
 from abc import ABCMeta, abstractmethod
-import operator
+import collections
+import functools
+import logging
 import typing
-from typing import Sequence, Mapping, Optional
+from typing import Sequence, Mapping, Optional, Tuple
 
 from PySide2 import QtCore, QtWidgets, QtGui
 import mincepy
 
+from . import caching
 from . import common
-from . import entry_table
+from . import paged_table
 from . import utils
 
+logger = logging.getLogger(__name__)
+
 
 class BaseTreeItem(metaclass=ABCMeta):
 
-    def __init__(self, column_data: Sequence, parent=None):
+    def __init__(self, column_data: Sequence, parent=None, row=0):
+        """
+        :param row: the row of this item within its parent
+        """
         self._data = column_data
         self._strings = tuple(
             utils.pretty_format(datum, single_line=True, max_length=300) for datum in column_data)
         self._parent = parent
+        # Kept so that finding the row, which Qt does constantly, doesn't need the parent to search
+        self._row = row
 
     def data(self, column: int):
         """Get the data at the given column"""
@@ -37,10 +47,7 @@ class BaseTreeItem(metaclass=ABCMeta):
 
     def row(self) -> int:
         """Get the row of this item within its parent"""
-        if self._parent is None:
-            return 0
-
-        return self._parent.child_row(self)
+        return self._row
 
     def column_count(self) -> int:
         """Get the number of columns in this item"""
@@ -58,19 +65,39 @@ class BaseTreeItem(metaclass=ABCMeta):
     def child_count(self) -> int:
         """Get the number of children this item has"""
 
+    def fetched_count(self) -> int:
+        """Get the number of children that have been fetched, i.e. that views can see, so far"""
+        return self.child_count()
+
+    def fetch_more(self, count: int):
+        """Fetch up to count more children"""
+
     @abstractmethod
     def child_row(self, tree_item) -> int:
         """Get the row number given a child item"""
 
 
+def prebuild(item: BaseTreeItem, depth: int):
+    """Build the children of a tree item, down to the given depth, so that they don't have to be
+    built when they are first shown"""
+    if isinstance(item, LazyMappingItem):
+        item.build_index()
+    if depth <= 0:
+        return
+
+    for row in range(item.fetched_count()):
+        prebuild(item.child(row), depth - 1)
+
+
 class DataTreeItem(BaseTreeItem):
     """Tree item that directly sores the required data internally"""
 
-    def __init__(self, column_data: Sequence, parent=None):
-        super().__init__(column_data, parent)
+    def __init__(self, column_data: Sequence, parent=None, row=0):
+        super().__init__(column_data, parent, row)
         self._children = []
 
-    def append_child(self, child):
+    def append_child(self, child: BaseTreeItem):
+        child._row = len(self._children)  # pylint: disable=protected-access
         self._children.append(child)
 
     def child(self, row: int):
@@ -83,39 +110,94 @@ class DataTreeItem(BaseTreeItem):
         return len(self._children)
 
     def child_row(self, tree_item) -> int:
-        return self._children.index(tree_item)
+        row = tree_item.row()
+        if self.child(row) is not tree_item:
+            raise ValueError("'{}' is not a child".format(tree_item))
+        return row
+
+
+def sorted_keys(mapping: Mapping) -> list:
+    """Get the keys of a mapping in sorted order.  If the keys can't be compared with each other
+    they are ordered using utils.sort_key."""
+    try:
+        return sorted(mapping)
+    except TypeError:
+        return sorted(mapping, key=utils.sort_key)
 
 
 class LazyMappingItem(BaseTreeItem):
+    """Tree item that builds its children from a sequence or mapping only when they are needed.
+    The child builder is called with the key (as a string), the value, the parent item and the
+    row.  Only the first FETCH_SIZE children are fetched to begin with so that views don't build
+    every child of an item that has a great many."""
+    FETCH_SIZE = 256
 
-    def __init__(self, column_data: Sequence, raw_data, child_builder, num_children, parent=None):
-        super(LazyMappingItem, self).__init__(column_data, parent)
+    def __init__(self,
+                 column_data: Sequence,
+                 raw_data,
+                 child_builder,
+                 num_children,
+                 parent=None,
+                 row=0):
+        super(LazyMappingItem, self).__init__(column_data, parent, row)
         self._raw_data = raw_data
         self._child_builder = child_builder
         self._num_children = num_children
+        self._num_fetched = min(num_children, self.FETCH_SIZE)
         self._children = {}
+        # The sorted keys of the raw data, if it is a mapping, so a child can be found by its row
+        self._keys = None  # type: Optional[list]
 
     def child_count(self) -> int:
         return self._num_children
 
+    def fetched_count(self) -> int:
+        return self._num_fetched
+
+    def fetch_more(self, count: int):
+        self._num_fetched = min(self._num_fetched + count, self._num_children)
+
+    def build_index(self):
+        """Build the index used to find the child at a given row.  This is done when the first child
+        is built but can be called beforehand, from any thread, so that it isn't done when the item
+        is first shown."""
+        if self._keys is None and isinstance(self._raw_data, Mapping):
+            self._keys = sorted_keys(self._raw_data)
+
     def child(self, row: int):
         if row < 0 or row >= self.child_count():
             return None
 
         if row not in self._children:
-            self._children[row] = self._child_builder(self._raw_data, row, self)
+            key, value = self._get_entry(row)
+            self._children[row] = self._child_builder(key, value, self, row)
             if len(self._children) == self._num_children:
-                # Can discard the raw data and builder now
+                # Can discard the raw data, index and builder now
                 self._raw_data = None
+                self._keys = None
                 self._child_builder = None
 
         return self._children[row]
 
+    def _get_entry(self, row: int) -> Tuple[str, typing.Any]:
+        """Get the key and value at the given row of the raw data"""
+        if isinstance(self._raw_data, Mapping):
+            self.build_index()
+            key = self._keys[row]
+            return str(key), self._raw_data[key]
+        if isinstance(self._raw_data, Sequence):
+            try:
+                return str(row), self._raw_data[row]
+            except Exception as exc:  # pylint: disable=broad-except
+                return str(row), 'Error getting child: {}'.format(exc)
+
+        raise TypeError("Type '{}' does not support children".format(type(self._raw_data)))
+
     def child_row(self, tree_item) -> int:
-        for row, child in self._children.items():
-            if tree_item is child:
-                return row
-        raise ValueError("'{}' is not a child".format(tree_item))
+        row = tree_item.row()
+        if self._children.get(row, None) is not tree_item:
+            raise ValueError("'{}' is not a child".format(tree_item))
+        return row
 
 
 class EntryDetails(QtCore.QAbstractItemModel):
@@ -139,14 +221,11 @@ class EntryDetails(QtCore.QAbstractItemModel):
               column: int,
               parent: QtCore.QModelIndex = QtCore.QModelIndex()) -> \
             QtCore.QModelIndex:
-        if parent.isValid():
-            parent_item = parent.internalPointer()  # type: BaseTreeItem
-        else:
-            parent_item = self._root_item
-
-        child_item = parent_item.child(row)
-        if child_item is not None:
-            return self.createIndex(row, column, child_item)
+        parent_item = self._get_item(parent)
+        if row < parent_item.fetched_count():
+            child_item = parent_item.child(row)
+            if child_item is not None:
+                return self.createIndex(row, column, child_item)
 
         return QtCore.QModelIndex()
 
@@ -166,12 +245,25 @@ class EntryDetails(QtCore.QAbstractItemModel):
         if parent.column() > 0:
             return 0
 
-        if not parent.isValid():
-            parent_item = self._root_item
-        else:
-            parent_item = parent.internalPointer()
+        return self._get_item(parent).fetched_count()
+
+    def canFetchMore(self, parent: QtCore.QModelIndex) -> bool:
+        if parent.column() > 0:
+            return False
+
+        item = self._get_item(parent)
+        return item.fetched_count() < item.child_count()
+
+    def fetchMore(self, parent: QtCore.QModelIndex):
+        if not self.canFetchMore(parent):
+            return
 
-        return parent_item.child_count()
+        item = self._get_item(parent)
+        first = item.fetched_count()
+        count = min(item.child_count() - first, LazyMappingItem.FETCH_SIZE)
+        self.beginInsertRows(parent, first, first + count - 1)
+        item.fetch_more(count)
+        self.endInsertRows()
 
     def columnCount(self, _parent: QtCore.QModelIndex = ...) -> int:
         return self._root_item.column_count()
@@ -205,22 +297,38 @@ class EntryDetails(QtCore.QAbstractItemModel):
 
     def set_record(self, record: mincepy.DataRecord, obj: object = None, snapshot: object = None):
         """Set the data to visualise, the object instance can optionally be provided"""
+        self.set_tree(record, self.build_tree(record, obj, snapshot))
+
+    def set_tree(self, record: Optional[mincepy.DataRecord], root_item: BaseTreeItem):
+        """Set the data to visualise using a tree that has already been built by build_tree()"""
         self.beginResetModel()
         self._data_record = record
-        # Now build the three
-        if self._data_record is None:
-            self._root_item = DataTreeItem(self.COLUMN_HEADERS)
-        else:
-            tree_dict = {'record': record._asdict()}
-            if obj is not None:
-                tree_dict['obj'] = obj
-            if obj is not None:
-                tree_dict['snapshot'] = snapshot
-
-            self._root_item = LazyMappingItem(self.COLUMN_HEADERS, tree_dict, self._item_builder,
-                                              len(tree_dict))
+        self._root_item = root_item
         self.endResetModel()
 
+    def build_tree(self,
+                   record: Optional[mincepy.DataRecord],
+                   obj: object = None,
+                   snapshot: object = None) -> BaseTreeItem:
+        """Build the tree for the given record, object and snapshot.  This doesn't change the model
+        so it can be called from any thread."""
+        if record is None:
+            return DataTreeItem(self.COLUMN_HEADERS)
+
+        tree_dict = {'record': record._asdict()}
+        if obj is not None:
+            tree_dict['obj'] = obj
+        if snapshot is not None:
+            tree_dict['snapshot'] = snapshot
+
+        return LazyMappingItem(self.COLUMN_HEADERS, tree_dict, self._item_builder, len(tree_dict))
+
+    def _get_item(self, index: QtCore.QModelIndex) -> BaseTreeItem:
+        if index.isValid():
+            return index.internalPointer()
+
+        return self._root_item
+
     def reset(self):
         if self._data_record is not None:
             self.beginResetModel()
@@ -228,19 +336,7 @@ class EntryDetails(QtCore.QAbstractItemModel):
             self._data_record = None
             self.endResetModel()
 
-    def _item_builder(self, build_from, row, parent=None) -> BaseTreeItem:
-        if isinstance(build_from, Sequence):
-            key = str(row)
-            try:
-                child = build_from[row]
-            except Exception as exc:  # pylint: disable=broad-except
-                child = 'Error getting child: {}'.format(exc)
-        elif isinstance(build_from, Mapping):
-            entry = sorted(build_from.items(), key=operator.itemgetter(0))[row]
-            key, child = str(entry[0]), entry[1]
-        else:
-            raise TypeError("Type '{}' does not support children")
-
+    def _item_builder(self, key: str, child, parent=None, row=0) -> BaseTreeItem:
         column_data = (key, utils.pretty_type_string(type(child)), child)
 
         # Is the child nested?
@@ -259,29 +355,84 @@ class EntryDetails(QtCore.QAbstractItemModel):
         if nested_child_data is not None:
             # We have a nested child so get a lazy item
             return LazyMappingItem(column_data, nested_child_data, self._item_builder,
-                                   len(nested_child_data), parent)
+                                   len(nested_child_data), parent, row)
 
         # Fall back to a plain unnested item
-        return DataTreeItem(column_data, parent)
+        return DataTreeItem(column_data, parent, row)
 
 
 class EntryDetailsController(QtCore.QObject):
-    """Controller that set what is displayed in the details tree"""
+    """Controller that set what is displayed in the details tree.
+
+    When the current row changes the record is shown straight away while the object and snapshot
+    are loaded on the executor.  Loading only starts once the current row has settled for the
+    debounce interval, the result of any load for a row that the user has since moved past is
+    discarded.
+
+    Once the current row is shown, the trees of the neighbouring rows are built in the background
+    so that stepping to the next (or previous) row shows its details immediately.  The historian
+    isn't thread safe so loads, including prefetches, are queued and only one runs at a time with
+    the current row taking priority."""
+    DEFAULT_DEBOUNCE_INTERVAL = 100  # ms
+    DEFAULT_PREFETCH_ROWS = 2
+    # How many levels of the prefetched trees to build in the background
+    PREBUILD_DEPTH = 2
 
     context_menu_requested = QtCore.Signal(dict, QtCore.QPoint)
 
+    # Signal used to deliver a load from the executor: generation, row, record, object, snapshot
+    _loaded = QtCore.Signal(int, int, object, object, object)
+    # Signal used to deliver a prefetched tree (None on failure) from the executor: historian,
+    # record, tree
+    _prefetched = QtCore.Signal(object, object, object)
+
+    # pylint: disable=too-many-arguments
     def __init__(self,
-                 entries_table: entry_table.ConstEntryTable,
+                 entries_table: paged_table.ConstEntryTable,
                  entries_table_view: QtWidgets.QTableView,
                  entry_details_view: QtWidgets.QTreeWidget,
                  details_tree: EntryDetails = None,
+                 executor=common.default_executor,
+                 debounce_interval=DEFAULT_DEBOUNCE_INTERVAL,
+                 object_cache: caching.ObjectCache = None,
+                 prefetch_rows=DEFAULT_PREFETCH_ROWS,
                  parent=None):
+        """
+        :param executor: the executor to load objects and snapshots on
+        :param debounce_interval: how long (in ms) the current row has to stay the same before
+            loading starts
+        :param object_cache: the cache of loaded objects and snapshots, one is created if not
+            supplied
+        :param prefetch_rows: the number of rows either side of the current one to prefetch, 0
+            disables prefetching
+        """
         super().__init__(parent)
         self._entries_table = entries_table
         self._entries_table_view = entries_table_view
         self._details_tree_view = entry_details_view
         self._details_tree = details_tree or EntryDetails(self)
         self._historian = None
+        self._executor = executor
+        self._object_cache = object_cache or caching.ObjectCache()
+
+        # Incremented each time the row changes so that loads for previous rows are discarded
+        self._generation = 0
+        self._to_load = None  # type: Optional[Tuple[int, mincepy.DataRecord]]
+        self._loading = False
+        # Set when the current row wasn't loaded in the table, its details are shown once it is
+        self._awaiting_row = False
+        self._debounce = QtCore.QTimer(self)
+        self._debounce.setSingleShot(True)
+        self._debounce.setInterval(debounce_interval)
+        self._debounce.timeout.connect(self._start_next)
+        self._loaded.connect(self._handle_loaded)
+
+        self._prefetch_rows = prefetch_rows
+        self._to_prefetch = collections.deque()
+        # (obj_id, version) -> (record, tree) of the most recently built trees
+        self._trees = collections.OrderedDict()
+        self._max_trees = 2 * prefetch_rows + 1
+        self._prefetched.connect(self._handle_prefetched)
 
         # Configure the view
         self._details_tree_view.setContextMenuPolicy(QtGui.Qt.CustomContextMenu)
@@ -290,6 +441,7 @@ class EntryDetailsController(QtCore.QObject):
         # Connect everything
         self._entries_table_view.selectionModel().currentRowChanged.connect(
             self._handle_row_changed)
+        self._entries_table.dataChanged.connect(self._handle_data_changed)
 
     def handle_copy(self, copier: callable):
         objects = self._get_currently_selected_objects()
@@ -318,25 +470,193 @@ class EntryDetailsController(QtCore.QObject):
 
     def reset(self, historian: Optional[mincepy.Historian]):
         self._historian = historian
+        self._cancel_load()
+        self._trees.clear()
         self._details_tree.reset()
 
     def _handle_row_changed(self, current, _previous):
+        self._cancel_load()
+        # Set before asking for the record as, if the row isn't loaded, asking starts loading it and
+        # that may finish, and be handled by _handle_data_changed(), before get_record() returns
+        self._awaiting_row = current.isValid()
         record = self._entries_table.get_record(current.row())
         if record is None:
-            self._details_tree.reset()
+            if self._awaiting_row or not current.isValid():
+                # Shown once the row is loaded
+                self._details_tree.reset()
             return
 
-        obj = snapshot = None
+        self._awaiting_row = False
+
         if self._historian is not None:
-            try:
-                # obj = self._historian.load(record.obj_id)
-                obj = record.load()
-            except TypeError:
-                pass
-            try:
-                # snapshot = self._historian.load(record.snapshot_id)
-                snapshot = record.load_snapshot()
-            except TypeError:
-                pass
+            # If we've seen it before then there is nothing to load
+            if self._show_tree(_tree_key(record)):
+                self._prefetch(current.row())
+                return
+
+            full_record = self._object_cache.get_full_record(self._historian, record, load=False)
+            if full_record is not None:
+                obj = self._object_cache.get_object(full_record, load=False)
+                snapshot = self._object_cache.get_snapshot(full_record, load=False)
+                if obj is not None and snapshot is not None:
+                    self._set_record(full_record, obj, snapshot)
+                    self._prefetch(current.row())
+                    return
+
+        # Show what we have now and fill in the rest once loaded
+        self._details_tree.set_record(record)
+        if self._historian is not None:
+            self._to_load = current.row(), record
+            self._debounce.start()
+
+    @QtCore.Slot(QtCore.QModelIndex, QtCore.QModelIndex)
+    def _handle_data_changed(self, top_left: QtCore.QModelIndex, bottom_right: QtCore.QModelIndex,
+                             *_args):
+        if not self._awaiting_row:
+            return
+
+        current = self._entries_table_view.selectionModel().currentIndex()
+        if top_left.row() <= current.row() <= bottom_right.row():
+            self._handle_row_changed(current, current)
+
+    def _cancel_load(self):
+        self._generation += 1
+        self._to_load = None
+        self._to_prefetch.clear()
+        self._debounce.stop()
+
+    @QtCore.Slot()
+    def _start_next(self):
+        """Start the next load, if there isn't one running, the current row goes first"""
+        if self._loading:
+            # Will be started once the running load finishes
+            return
+
+        if self._to_load is not None:
+            if self._debounce.isActive():
+                # Wait for the row to settle
+                return
+
+            row, record = self._to_load
+            self._to_load = None
+            self._loading = True
+            self._executor(functools.partial(self._load, self._generation, self._historian, row,
+                                             record),
+                           blocking=False)
+            return
+
+        while self._to_prefetch:
+            record = self._to_prefetch.popleft()
+            if _tree_key(record) not in self._trees:
+                self._loading = True
+                self._executor(functools.partial(self._prefetch_record, self._historian, record),
+                               blocking=False)
+                return
+
+    def _load(self, generation: int, historian: mincepy.Historian, row: int,
+              record: mincepy.DataRecord):
+        """Load the full record, object and snapshot.  Called on the executor."""
+        obj = snapshot = None
+        try:
+            # The table may only have part of the record so get the full one
+            record = self._object_cache.get_full_record(historian, record)
+            if record is not None and generation == self._generation:
+                try:
+                    obj = self._object_cache.get_object(record)
+                except TypeError:
+                    pass
+            if record is not None and generation == self._generation:
+                try:
+                    snapshot = self._object_cache.get_snapshot(record)
+                except TypeError:
+                    pass
+            logger.debug('Object cache hit rate is %.2f', self._object_cache.hit_rate)
+        finally:
+            self._loaded.emit(generation, row, record, obj, snapshot)
+
+    @QtCore.Slot(int, int, object, object, object)
+    def _handle_loaded(self, generation: int, row: int, record: Optional[mincepy.DataRecord], obj,
+                       snapshot):
+        self._loading = False
+        if generation == self._generation:
+            if record is None:
+                self._details_tree.reset()
+            else:
+                self._set_record(record, obj, snapshot)
+                self._prefetch(row)
+
+        self._start_next()
+
+    def _set_record(self, record: mincepy.DataRecord, obj, snapshot):
+        """Show the given record keeping its tree in case we come back to it"""
+        tree = self._details_tree.build_tree(record, obj, snapshot)
+        self._add_tree(record, tree)
+        self._details_tree.set_tree(record, tree)
+
+    def _show_tree(self, key) -> bool:
+        """Show the tree with the given key if we have it, returns True if it was shown"""
+        entry = self._trees.get(key, None)
+        if entry is None:
+            return False
+
+        self._trees.move_to_end(key)
+        self._details_tree.set_tree(*entry)
+        return True
+
+    def _add_tree(self, record: mincepy.DataRecord, tree: BaseTreeItem):
+        self._trees[_tree_key(record)] = record, tree
+        while len(self._trees) > self._max_trees:
+            self._trees.popitem(last=False)
+
+    def _prefetch(self, row: int):
+        """Queue building the trees of the rows either side of the given one, nearest first"""
+        if self._historian is None:
+            return
 
-        self._details_tree.set_record(record, obj, snapshot)
+        self._to_prefetch.clear()
+        for offset in range(1, self._prefetch_rows + 1):
+            for neighbour in (row + offset, row - offset):
+                record = self._entries_table.get_record(neighbour)
+                if record is not None and _tree_key(record) not in self._trees:
+                    self._to_prefetch.append(record)
+        self._start_next()
+
+    def _prefetch_record(self, historian: mincepy.Historian, record: mincepy.DataRecord):
+        """Load a record and build its tree.  Called on the executor."""
+        tree = None
+        try:
+            full_record = self._object_cache.get_full_record(historian, record)
+            if full_record is not None:
+                record = full_record
+                obj = snapshot = None
+                try:
+                    obj = self._object_cache.get_object(record)
+                except TypeError:
+                    pass
+                try:
+                    snapshot = self._object_cache.get_snapshot(record)
+                except TypeError:
+                    pass
+
+                tree = self._details_tree.build_tree(record, obj, snapshot)
+                prebuild(tree, self.PREBUILD_DEPTH)
+        finally:
+            self._prefetched.emit(historian, record, tree)
+
+    @QtCore.Slot(object, object, object)
+    def _handle_prefetched(self, historian: mincepy.Historian, record: mincepy.DataRecord,
+                           tree: Optional[BaseTreeItem]):
+        self._loading = False
+        if historian is self._historian and tree is not None:
+            self._add_tree(record, tree)
+            if self._to_load is not None and _tree_key(self._to_load[1]) == _tree_key(record):
+                # The user has arrived at this row while it was being prefetched
+                self._to_load = None
+                self._debounce.stop()
+                self._details_tree.set_tree(record, tree)
+
+        self._start_next()
+
+
+def _tree_key(record: mincepy.DataRecord):
+    return record.obj_id, record.version
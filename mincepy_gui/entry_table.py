@@ -1,146 +1,69 @@
 # -*- coding: utf-8 -*-
+import collections
 import itertools
 import logging
-from typing import Iterator, Any, List, Optional, Callable, Sequence
+from typing import Any, Iterator, FrozenSet, Iterable, List, Optional, Callable, Sequence, Tuple
 
 from PySide2 import QtCore, QtWidgets, QtGui
 import mincepy
 
+from . import columnar
 from . import columns as cols
 from . import common
+from . import header_menu
+from . import paged_table
+from . import schema
+from . import sources
 
-__all__ = ('EntryTableModel',)
+__all__ = 'EntryTableModel', 'StateKeyIndex'
 
 logger = logging.getLogger(__name__)
 
 
-class ConstEntryTable(QtCore.QAbstractTableModel):
-    """Read-only view of the entries table model"""
-    DEFAULT_BATCH_SIZE = 64
-
-    sort_requested = QtCore.Signal(str, QtCore.Qt.SortOrder)
-
-    def __init__(self, parent=None):
-        super().__init__(parent)
-        self._historian = None  # type: Optional[mincepy.Historian]
-        self._records = []  # type: List[mincepy.DataRecord]
-        self._columns = []  # type: List[cols.Column]
-        self._data_source = None  # type: Optional[Iterator[mincepy.DataRecord]]
-        self.batch_size = self.DEFAULT_BATCH_SIZE
-
-    @property
-    def columns(self):
-        return self._columns
-
-    @property
-    def records(self) -> List[mincepy.DataRecord]:
-        return self._records
-
-    def get_record(self, row):
-        if row < 0 or row >= len(self._records):
-            return None
-
-        return self._records[row]
-
-    def headerData(self, section: int, orientation: QtCore.Qt.Orientation, role: int = ...) -> Any:
-        if role != QtCore.Qt.DisplayRole:
-            return None
-
-        if orientation == QtCore.Qt.Orientation.Horizontal:
-            if section < 0 or section >= len(self._columns):
-                return None
-            return self._columns[section].name
-
-        if orientation == QtCore.Qt.Orientation.Vertical:
-            if section < 0 or section >= len(self._records):
-                return None
-            return str(section)
-
-        return None
-
-    def rowCount(self, _parent: QtCore.QModelIndex = ...) -> int:
-        return len(self._records)
-
-    def columnCount(self, _parent: QtCore.QModelIndex = ...) -> int:
-        return len(self._columns)
-
-    def data(self, index: QtCore.QModelIndex, role: int = ...) -> Any:
-        if not index.isValid():
-            return None
-
-        if index.row() >= len(self._records) or index.row() < 0:
-            return None
-
-        if index.column() >= len(self._columns) or index.column() < 0:
-            return None
-
-        col = self._columns[index.column()]
-        return col.data(self._records[index.row()], role, self._historian)
-
-    def sort(self, column: int, order: QtCore.Qt.SortOrder = ...):
-        if column < 0 or column > len(self._columns):
-            return
-
-        col = self._columns[column]
-        if not isinstance(col, cols.DataColumn):
-            return
-
-        self.sort_requested.emit('.'.join(col.path), order)
-
-
-class EntryTableModel(ConstEntryTable):
+class EntryTableModel(paged_table.PagedEntryTable):
     """Mutable entries table to be used by controllers"""
+    # Bulk removals made up of more separate ranges than this are done with a model reset
+    BULK_RESET_THRESHOLD = 32
+
+    # Emitted before a bulk removal with the list of [start, end) row ranges that will be removed
+    rows_about_to_be_bulk_removed = QtCore.Signal(object)
+    # Emitted once a bulk removal has finished
+    rows_bulk_removed = QtCore.Signal()
 
     @staticmethod
     def get_default_columns() -> List[cols.Column]:
         return [cols.OBJ_TYPE, cols.CTIME, cols.MTIME, cols.VERSION]
 
-    def __init__(self, parent=None):
-        super().__init__(parent)
+    def __init__(self, *args, **kwargs):
+        """Takes the same arguments as paged_table.PagedEntryTable"""
+        super().__init__(*args, **kwargs)
         # Append the default columns
         self.append_columns(*self.get_default_columns())
 
-    def canFetchMore(self, _parent: QtCore.QModelIndex) -> bool:
-        return self._data_source is not None
-
-    def fetchMore(self, _parent: QtCore.QModelIndex):
-        # Fetch the new records
-        if self._data_source is None:
-            return
-
-        new_records = []
-        try:
-            for _ in range(self.batch_size):
-                new_records.append(next(self._data_source))
-        except StopIteration:
-            # No more data
-            self._data_source = None
-
-        if new_records:
-            # Insert the new records
-            num_records = len(self._records)
-            self.beginInsertRows(QtCore.QModelIndex(), num_records,
-                                 num_records + len(new_records) - 1)
-            self._records.extend(new_records)
-            self.endInsertRows()
-
-    def set_source(self, source: Optional[Iterator[mincepy.DataRecord]],
-                   historian: Optional[mincepy.Historian]):
-        """Set a new data source, can be None.  This resets the records contained in the list and
-        sets it to be populated from the new source"""
-        self.beginRemoveRows(QtCore.QModelIndex(), 0, len(self._records) - 1)
-        self._records = []
-        self._data_source = source
-        self._historian = historian
-        self.endRemoveRows()
-        if source is not None:
-            self.fetchMore(QtCore.QModelIndex())
-
-    def append_columns(self, *columns: cols.Column):
+    def append_columns(self,
+                       *columns: cols.Column,
+                       may_have: Callable[[Any, Sequence[cols.Column]], bool] = None) -> int:
+        """Append columns to the table.  Rows that don't have the values of the new columns, because
+        their records were projected without them, are evicted so that they are loaded again.  This
+        only applies to sources that can be paged, other rows keep what they have.
+
+        :param may_have: an optional callable that is given a row's record (or row handle) and the
+            new columns that it lacks and returns False if the record is known not to have them, in
+            which case it isn't loaded again
+        :return: the number of rows evicted
+        """
         self.beginInsertColumns(QtCore.QModelIndex(), len(self._columns),
                                 len(self._columns) + len(columns) - 1)
         self._columns.extend(columns)
         self.endInsertColumns()
+        if self._source is None:
+            return 0
+
+        def evict(record) -> bool:
+            lacking = [col for col in columns if _lacks(record, col)]
+            return bool(lacking) and (may_have is None or may_have(record, lacking))
+
+        return self._records.evict_matching(evict)
 
     def remove_columns(self, *columns: cols.Column):
         for col in columns:
@@ -148,6 +71,8 @@ class EntryTableModel(ConstEntryTable):
             self.beginRemoveColumns(QtCore.QModelIndex(), idx, idx)
             self._columns.pop(idx)
             self.endRemoveColumns()
+        self._display_cache.clear()
+        self._prune_columnar()
 
     def set_columns(self, columns: Sequence[cols.Column]):
         self.clear_columns()
@@ -155,8 +80,24 @@ class EntryTableModel(ConstEntryTable):
 
     def clear_columns(self):
         self.beginRemoveColumns(QtCore.QModelIndex(), 0, len(self._columns) - 1)
-        self._columns = []
+        self._columns.clear()
         self.endRemoveColumns()
+        self._display_cache.clear()
+        self._sort_keys.clear()
+        self._prune_columnar()
+
+    def _prune_columnar(self):
+        """Discard the values of columns that are no longer in the table"""
+        if not self._columnar_rows:
+            return
+
+        batches = {
+            id(record.batch): record.batch
+            for record in map(self._records.__getitem__, self._records.resident_rows())
+            if isinstance(record, columnar.RowHandle)
+        }
+        for batch in batches.values():
+            batch.prune(self._columns)
 
     def remove_records(self, index: int, count: int) -> bool:
         """Remove 'count' records starting at the given index"""
@@ -165,24 +106,177 @@ class EntryTableModel(ConstEntryTable):
 
         end_idx = min(len(self._records), index + count)
         self.beginRemoveRows(QtCore.QModelIndex(), index, end_idx - 1)
-        for i in range(index, end_idx):
-            del self._records[i]
+        self._records.remove(index, end_idx - index)
+        self._rows_removed([(index, end_idx)])
         self.endRemoveRows()
 
         return True
 
+    def remove_matching_records(self, match_filter: Callable[[mincepy.DataRecord], bool]) -> int:
+        """Remove all the loaded records that match the given filter, rows that aren't resident
+        can't be checked.  Contiguous runs of matching rows are removed together and if there are
+        many runs a single model reset is used instead.  Rows held as columns are passed to the
+        filter as PartialRecords with just the identity fields.  Returns the number of records
+        removed."""
+        runs = []
+        for row in self._records.resident_rows():
+            record = self._records[row]
+            if isinstance(record, columnar.RowHandle):
+                record = record.to_record()
+            if match_filter(record):
+                if runs and runs[-1][1] == row:
+                    runs[-1][1] = row + 1
+                else:
+                    runs.append([row, row + 1])
+
+        if not runs:
+            return 0
+
+        runs = [tuple(run) for run in runs]
+        self.rows_about_to_be_bulk_removed.emit(runs)
+        if len(runs) > self.BULK_RESET_THRESHOLD:
+            self.beginResetModel()
+            num_removed = self._records.remove_ranges(runs)
+            self._rows_removed(runs)
+            self.endResetModel()
+        else:
+            # Go backwards so that the rows of the runs still to be removed don't shift
+            num_removed = 0
+            for start, end in reversed(runs):
+                self.beginRemoveRows(QtCore.QModelIndex(), start, end - 1)
+                num_removed += self._records.remove_ranges([(start, end)])
+                self.endRemoveRows()
+            self._rows_removed(runs)
+        self.rows_bulk_removed.emit()
+
+        return num_removed
+
     def remove_record(self, index: int) -> bool:
         """Remove the record at the given index"""
         return self.remove_records(index, 1)
 
     def reset(self):
         self.beginResetModel()
-        self._records = []
-        self._columns = self.get_default_columns()
-        self._data_source = None
+        self._records.clear()
+        self._display_cache.clear()
+        self._columns[:] = self.get_default_columns()
+        self._set_source(None)
         self.endResetModel()
 
 
+def _lacks(record, column: cols.Column) -> bool:
+    """Returns True if the given record (or row handle) doesn't have the value of the column because
+    it is a partial record that may have been fetched without it"""
+    if isinstance(record, columnar.RowHandle):
+        return record.lacks(column)
+    if not isinstance(record, sources.PartialRecord):
+        return False
+    if isinstance(column, cols.DataColumn) and sources.is_always_fetched('.'.join(column.path)):
+        return False
+    return column.data(record, common.DataRole) is None
+
+
+class StateKeyIndex:
+    """A reference counted index of the state keys of the rows in the table.  Each key maps to the
+    number of rows that have it so keeping the index up to date costs time proportional to the number
+    of rows that change, not the number of rows in the table."""
+
+    def __init__(self):
+        self._counts = collections.Counter()
+        self._row_keys = []  # type: List[FrozenSet[str]]
+        # Rows tend to share the same keys so keep just one copy of each set
+        self._interned = {}
+
+    def __len__(self) -> int:
+        """Get the number of rows in the index"""
+        return len(self._row_keys)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._counts
+
+    def count(self, key: str) -> int:
+        """Get the number of rows that have the given key"""
+        return self._counts[key]
+
+    def most_common(self, num: int = None) -> List[str]:
+        """Get the keys in order of the number of rows that have them"""
+        return [key for key, _ in self._counts.most_common(num)]
+
+    def clear(self):
+        self._counts.clear()
+        self._row_keys = []
+        self._interned = {}
+
+    def insert(self, row: int, row_keys: Iterable[Iterable[str]]) -> List[str]:
+        """Insert rows, with the given keys, at the given row.  Returns the keys that were not
+        in the index before."""
+        new_rows = [self._intern(keys) for keys in row_keys]
+        self._row_keys[row:row] = new_rows
+
+        added = []
+        for keys in new_rows:
+            for key in keys:
+                if key not in self._counts:
+                    added.append(key)
+                self._counts[key] += 1
+        return added
+
+    def set_keys(self, start: int,
+                 row_keys: Iterable[Iterable[str]]) -> Tuple[List[str], List[str]]:
+        """Replace the keys of the rows starting at the given row.  Returns the keys that were added
+        to and removed from the index."""
+        added = []
+        removed = []
+        for row, keys in enumerate(row_keys, start):
+            keys = self._intern(keys)
+            old_keys = self._row_keys[row]
+            if keys is old_keys:
+                continue
+
+            self._row_keys[row] = keys
+            for key in old_keys:
+                self._counts[key] -= 1
+                if self._counts[key] == 0:
+                    del self._counts[key]
+                    removed.append(key)
+            for key in keys:
+                if key not in self._counts:
+                    added.append(key)
+                self._counts[key] += 1
+
+        # A key could have gone and come back (or vice versa) so only report the net changes
+        return ([key for key in added if key in self._counts],
+                [key for key in removed if key not in self._counts])
+
+    def remove(self, start: int, end: int) -> List[str]:
+        """Remove the rows in the range [start, end).  Returns the keys that are no longer in the
+        index."""
+        return self.remove_ranges([(start, end)])
+
+    def remove_ranges(self, ranges: Iterable[Tuple[int, int]]) -> List[str]:
+        """Remove the rows in the given [start, end) ranges, which must not overlap, in one go.
+        Returns the keys that are no longer in the index."""
+        kept = []
+        removed = []
+        previous = 0
+        for start, end in sorted(ranges):
+            kept.extend(self._row_keys[previous:start])
+            for keys in self._row_keys[start:end]:
+                for key in keys:
+                    self._counts[key] -= 1
+                    if self._counts[key] == 0:
+                        del self._counts[key]
+                        removed.append(key)
+            previous = max(previous, end)
+        kept.extend(self._row_keys[previous:])
+        self._row_keys = kept
+        return removed
+
+    def _intern(self, keys: Iterable[str]) -> FrozenSet[str]:
+        keys = frozenset(keys)
+        return self._interned.setdefault(keys, keys)
+
+
 class EntryTableController(QtCore.QObject):
     """Controller for the table showing database entries"""
     DATA_RECORDS = 'Data Record(s)'
@@ -194,19 +288,32 @@ class EntryTableController(QtCore.QObject):
                  entries_table: EntryTableModel,
                  entries_table_view: QtWidgets.QTableView,
                  show_as_objects_checkbox: QtWidgets.QCheckBox = None,
+                 max_auto_columns: int = None,
                  parent=None):
         """
         :param entries_table: the entries table model
         :param entries_table_view: the entries table view
+        :param max_auto_columns: the maximum number of state columns to add automatically, if
+            there are more state keys than this then the most common ones are shown
         :param parent: the parent widget
         """
         super().__init__(parent)
         self._entry_table = entries_table  # type: EntryTableModel
         self._entry_table_view = entries_table_view
-        self._columns_to_remove = []
+        self._state_keys = StateKeyIndex()
+        self._max_auto_columns = max_auto_columns
+        self._schema_index = None  # type: Optional[schema.SchemaIndex]
+        # Type id -> state keys found in the schema index
+        self._schema_keys = {}
+        # True while a bulk removal is in progress, the index is updated in one go for these
+        self._bulk_removing = False
+        self._header_menu = header_menu.HeaderMenuController(entries_table,
+                                                             entries_table_view,
+                                                             parent=self)
 
         # Disable for now, not supported
-        show_as_objects_checkbox.setEnabled(False)
+        if show_as_objects_checkbox is not None:
+            show_as_objects_checkbox.setEnabled(False)
 
         # Configure the view
         self._entry_table_view.setModel(self._entry_table)
@@ -215,30 +322,44 @@ class EntryTableController(QtCore.QObject):
         # Connect everything
         self._entry_table_view.customContextMenuRequested.connect(self._entries_context_menu)
         self._entry_table.rowsInserted.connect(self._handle_rows_inserted)
+        self._entry_table.dataChanged.connect(self._handle_data_changed)
+        self._entry_table.layoutChanged.connect(self._handle_layout_changed)
         self._entry_table.rowsAboutToBeRemoved.connect(self._handle_rows_about_to_be_removed)
+        self._entry_table.modelReset.connect(self._handle_model_reset)
+        self._entry_table.rows_about_to_be_bulk_removed.connect(
+            self._handle_rows_about_to_be_bulk_removed)
+        self._entry_table.rows_bulk_removed.connect(self._handle_rows_bulk_removed)
+        self._entry_table.row_found.connect(self._show_row)
+        self._entry_table_view.verticalScrollBar().valueChanged.connect(
+            self._handle_viewport_changed)
 
     @property
-    def entry_table(self) -> ConstEntryTable:
+    def entry_table(self) -> paged_table.ConstEntryTable:
         """Returns a read-only view of the entry table"""
         return self._entry_table
 
-    def get_selected(self) -> dict:
-        """Get the currently selected data records (row(s)) and values (cell(s))"""
-        groups = {}
-        selected = self._entry_table_view.selectionModel().selectedIndexes()
-
-        rows = {index.row() for index in selected}
-        rows = sorted(tuple(rows))
-        data_records = tuple(self._entry_table.get_record(row) for row in rows)
-
-        if data_records:
-            groups[self.DATA_RECORDS] = data_records if len(data_records) > 1 else data_records[0]
+    @property
+    def header_menu(self) -> header_menu.HeaderMenuController:
+        """The controller of the header context menu, used to suggest columns"""
+        return self._header_menu
 
+    def get_selected(self, callback: Callable[[dict], None]):
+        """Get the currently selected data records (row(s)) and values (cell(s)).  The full records
+        may have to be loaded, which is done in the background, so these are passed to the callback.
+        """
+        selected = self._entry_table_view.selectionModel().selectedIndexes()
         objects = tuple(self._entry_table.data(index, role=common.DataRole) for index in selected)
-        if objects:
-            groups[self.VALUES] = objects if len(objects) > 1 else objects[0]
 
-        return groups
+        def got_records(data_records: List[mincepy.DataRecord]):
+            groups = {}
+            if data_records:
+                groups[self.DATA_RECORDS] = \
+                    data_records if len(data_records) > 1 else data_records[0]
+            if objects:
+                groups[self.VALUES] = objects if len(objects) > 1 else objects[0]
+            callback(groups)
+
+        self._entry_table.load_records(sorted({index.row() for index in selected}), got_records)
 
     def handle_copy(self, copier: callable):
         if not copier:
@@ -246,11 +367,13 @@ class EntryTableController(QtCore.QObject):
 
         selected = self._entry_table_view.selectionModel().selectedIndexes()
         if selected:
-            rows = {index.row() for index in selected}
-            data_records = tuple(self._entry_table.get_record(row) for row in rows)
-            # Convert to scalar if needed
-            data_records = data_records if len(data_records) > 1 else data_records[0]
-            copier(data_records)
+
+            def got_records(data_records: List[mincepy.DataRecord]):
+                if data_records:
+                    # Convert to scalar if needed
+                    copier(tuple(data_records) if len(data_records) > 1 else data_records[0])
+
+            self._entry_table.load_records({index.row() for index in selected}, got_records)
 
     def set_source(self, source: Optional[Iterator[mincepy.DataRecord]],
                    historian: mincepy.Historian):
@@ -262,67 +385,189 @@ class EntryTableController(QtCore.QObject):
 
     def remove_matching_records(self, match_filter: Callable[[mincepy.DataRecord], bool]) -> bool:
         """Delete the records that match the given filter criteria"""
-        deleted = False
-        idx = 0
-        while idx < len(self._entry_table.records):
-            record = self._entry_table.records[idx]
-            if match_filter(record):
-                self._entry_table.remove_record(idx)
-                deleted = True
-                # Don't up the counter as everything will have shifted by one in deleting
-            else:
-                idx += 1
-        return deleted
+        return self._entry_table.remove_matching_records(match_filter) > 0
+
+    def go_to_row(self, row: int) -> bool:
+        """Scroll to, and select, the given row without loading the rows in between"""
+        row = self._entry_table.go_to_row(row)
+        self._show_row(row)
+        return row >= 0
+
+    def go_to_value(self, value) -> bool:
+        """Scroll to, and select, the first row with a sort key value at or after the given one.
+        This happens once the row has been found in the background."""
+        return self._entry_table.go_to_value(value)
+
+    @QtCore.Slot(int)
+    def _show_row(self, row: int):
+        if row < 0:
+            return
+
+        self._entry_table_view.scrollTo(self._entry_table.index(row, 0),
+                                        QtWidgets.QAbstractItemView.PositionAtTop)
+        self._entry_table_view.selectRow(row)
+
+    @property
+    def state_keys(self) -> StateKeyIndex:
+        """Get the index of the state keys of the rows in the table"""
+        return self._state_keys
+
+    def set_schema_index(self, index: Optional[schema.SchemaIndex]):
+        """Set the index of the sampled schema.  Rows that were projected only have the state
+        entries of the columns that are shown so the keys that the index has for their type are used
+        to find the other columns."""
+        self._schema_index = index
+        self._schema_keys = {}
+
+        # Bring the keys of the loaded rows up to date
+        records = self._entry_table.records
+        added, removed = [], []
+        resident = records.resident_rows()
+        for _, group in itertools.groupby(enumerate(resident), lambda entry: entry[1] - entry[0]):
+            rows = [entry[1] for entry in group]
+            run_added, run_removed = self._state_keys.set_keys(
+                rows[0], [self._get_state_keys(records[row]) for row in rows])
+            added.extend(run_added)
+            removed.extend(run_removed)
+        self._update_auto_columns(added=added, removed=removed)
 
     @QtCore.Slot(QtCore.QModelIndex, int, int)
     def _handle_rows_inserted(self, _parent: QtCore.QModelIndex, start_row: int, end_row: int):
         """Find which new columns are needed now that these new records have been inserted"""
-        state_keys = set()
-        for row in range(start_row, end_row + 1):
-            record = self._entry_table.get_record(row)
-            if isinstance(record.state, dict):
-                state_keys.update(record.state.keys())
-
-        for col in self._entry_table.columns:
-            if isinstance(col, cols.DataColumn) \
-                    and len(col.path) == 2 \
-                    and col.path[0] == mincepy.STATE:
-                state_keys.discard(col.path[1])
-
-        new_cols = []
-        for new_state_key in state_keys:
-            path = mincepy.STATE, new_state_key
-            new_cols.append(cols.DataColumn('.'.join(path), path))
-        self._entry_table.append_columns(*new_cols)
+        row_keys = [
+            self._get_state_keys(self._entry_table.records[row])
+            for row in range(start_row, end_row + 1)
+        ]
+        added = self._state_keys.insert(start_row, row_keys)
+        self._update_auto_columns(added=added)
+
+    @QtCore.Slot(QtCore.QModelIndex, QtCore.QModelIndex)
+    def _handle_data_changed(self, top_left: QtCore.QModelIndex, bottom_right: QtCore.QModelIndex,
+                             *_args):
+        """Rows that were loaded after being inserted (or reloaded) may have different keys"""
+        start_row, end_row = top_left.row(), bottom_right.row()
+        row_keys = [
+            self._get_state_keys(self._entry_table.records[row])
+            for row in range(start_row, end_row + 1)
+        ]
+        added, removed = self._state_keys.set_keys(start_row, row_keys)
+        self._update_auto_columns(added=added, removed=removed)
+
+    @QtCore.Slot()
+    def _handle_layout_changed(self, *_args):
+        """The rows may have been reordered so bring the index up to date"""
+        row_keys = [self._get_state_keys(record) for record in self._entry_table.records]
+        added, removed = self._state_keys.set_keys(0, row_keys)
+        self._update_auto_columns(added=added, removed=removed)
 
     @QtCore.Slot(QtCore.QModelIndex, int, int)
     def _handle_rows_about_to_be_removed(self, _parent: QtCore.QModelIndex, start_row: int,
                                          end_row: int):
         """Find and remove the columns that will no longer be needed once these records are removed
         """
-        to_remove = set()
-        for row in range(start_row, end_row + 1):
-            record = self._entry_table.get_record(row)
-            if isinstance(record.state, dict):
-                to_remove.update(record.state.keys())
-
-        for row in itertools.chain(range(0, start_row),
-                                   range(end_row + 1, len(self._entry_table.records))):
-            record = self._entry_table.get_record(row)
-            to_remove -= record.state.keys()
-            if not to_remove:
-                break
-
-        for col in self._entry_table.columns:
-            if isinstance(col, cols.DataColumn) \
-                    and len(col.path) == 2 \
-                    and col.path[0] == mincepy.STATE \
-                    and col.path[1] in to_remove:
-                self._columns_to_remove.append(col)
-        self._entry_table.remove_columns(*self._columns_to_remove)
-        self._columns_to_remove = []
+        if self._bulk_removing:
+            # Already dealt with
+            return
+
+        removed = self._state_keys.remove(start_row, end_row + 1)
+        self._update_auto_columns(removed=removed)
+
+    @QtCore.Slot(object)
+    def _handle_rows_about_to_be_bulk_removed(self, ranges: list):
+        """Update the index and columns once for all the rows that are about to be removed"""
+        self._bulk_removing = True
+        self._update_auto_columns(removed=self._state_keys.remove_ranges(ranges))
+
+    @QtCore.Slot()
+    def _handle_rows_bulk_removed(self):
+        self._bulk_removing = False
+
+    @QtCore.Slot()
+    def _handle_model_reset(self):
+        if not self._bulk_removing:
+            self._state_keys.clear()
+
+    def _update_auto_columns(self, added: Sequence[str] = (), removed: Sequence[str] = ()):
+        """Add and remove state columns given the keys that were added and removed from the index"""
+        existing = {
+            col.path[1]: col for col in self._entry_table.columns if
+            isinstance(col, cols.DataColumn) and len(col.path) == 2 and col.path[0] == mincepy.STATE
+        }
+
+        if self._max_auto_columns is None:
+            to_add = [key for key in added if key not in existing]
+            to_remove = [existing[key] for key in removed if key in existing]
+        elif added or removed:
+            wanted = self._state_keys.most_common(self._max_auto_columns)
+            to_add = [key for key in wanted if key not in existing]
+            wanted = set(wanted)
+            to_remove = [col for key, col in existing.items() if key not in wanted]
+        else:
+            return
+
+        if to_remove:
+            self._entry_table.remove_columns(*to_remove)
+        if to_add:
+            new_columns = [
+                cols.DataColumn('.'.join((mincepy.STATE, key)), (mincepy.STATE, key))
+                for key in to_add
+            ]
+            # Only rows that might have the new entries are loaded again
+            self._entry_table.append_columns(*new_columns, may_have=self._may_have)
+
+    def _may_have(self, record, columns: Sequence[cols.DataColumn]) -> bool:
+        """Returns False if the record is known not to have the state entries of any of the given
+        state columns, i.e. the sampled schema doesn't have them for its type"""
+        if self._schema_index is None:
+            return True
+
+        keys = self._get_state_keys(record)
+        return any(col.path[1] in keys for col in columns)
+
+    def _get_state_keys(self, record) -> Iterable[str]:
+        if record is None:
+            return ()
+
+        if isinstance(record, columnar.RowHandle):
+            keys, partial = record.state_keys, record.partial
+        else:
+            keys = record.state.keys() if isinstance(record.state, dict) else ()
+            partial = isinstance(record, sources.PartialRecord)
+        if partial and self._schema_index is not None:
+            keys = self._get_schema_keys(record.type_id).union(keys)
+        return keys
+
+    def _get_schema_keys(self, type_id) -> FrozenSet[str]:
+        """Get the top level state keys that the schema index has for the given type"""
+        try:
+            return self._schema_keys[type_id]
+        except KeyError:
+            pass
+        except TypeError:
+            # Unhashable, so not a type id that the index has
+            return frozenset()
+
+        prefix = mincepy.STATE + '.'
+        keys = frozenset(path[len(prefix):]
+                         for path, _ in self._schema_index.get_paths(type_id)
+                         if path.startswith(prefix) and '.' not in path[len(prefix):])
+        self._schema_keys[type_id] = keys
+        return keys
+
+    @QtCore.Slot(int)
+    def _handle_viewport_changed(self, _value: int):
+        """Let the model know which rows are visible so it can evict ones that are far away"""
+        first_row = self._entry_table_view.rowAt(0)
+        if first_row < 0:
+            return
+
+        last_row = self._entry_table_view.rowAt(self._entry_table_view.viewport().height() - 1)
+        if last_row < 0:
+            last_row = self._entry_table.rowCount() - 1
+
+        self._entry_table.set_viewport(first_row, last_row)
 
     @QtCore.Slot(QtCore.QPoint)
     def _entries_context_menu(self, point: QtCore.QPoint):
-        groups = self.get_selected()
-        self.context_menu_requested.emit(groups, self._entry_table_view.mapToGlobal(point))
+        position = self._entry_table_view.mapToGlobal(point)
+        self.get_selected(lambda groups: self.context_menu_requested.emit(groups, position))
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""Module for the context menu of the results table header"""
+import functools
+from typing import List, Sequence, Tuple
+
+from PySide2 import QtCore, QtGui, QtWidgets
+
+from . import columns as cols
+
+__all__ = ('HeaderMenuController',)
+
+
+class HeaderMenuController(QtCore.QObject):
+    """Controller for the context menu of the entries table header which offers suggested record
+    paths (e.g. from sampling the schema) to be added as columns"""
+    # The maximum number of column suggestions offered in the menu
+    MAX_COLUMN_SUGGESTIONS = 30
+
+    def __init__(self, entries_table, entries_table_view: QtWidgets.QTableView, parent=None):
+        """
+        :param entries_table: the entries table model (an entry_table.EntryTableModel)
+        :param entries_table_view: the entries table view
+        :param parent: the parent object
+        """
+        super().__init__(parent)
+        self._entry_table = entries_table
+        self._entry_table_view = entries_table_view
+        self._column_suggestions = []  # type: List[Tuple[str, float]]
+
+        header = self._entry_table_view.horizontalHeader()
+        header.setContextMenuPolicy(QtGui.Qt.CustomContextMenu)
+        header.customContextMenuRequested.connect(self._header_context_menu)
+
+    def set_column_suggestions(self, suggestions: Sequence[Tuple[str, float]]):
+        """Set the record paths (e.g. 'state.colour') that are suggested as columns along with the
+        fraction of records that have them, most relevant first"""
+        self._column_suggestions = list(suggestions)
+
+    def get_column_suggestions(self) -> List[Tuple[str, float]]:
+        """Get the suggested columns that aren't already shown"""
+        shown = set(self._entry_table.get_projection())
+        return [
+            (path, frequency) for path, frequency in self._column_suggestions if path not in shown
+        ][:self.MAX_COLUMN_SUGGESTIONS]
+
+    def add_column(self, path: str):
+        """Add a column showing the value at the given (dot separated) record path"""
+        # Records that were projected without the new column are loaded again
+        self._entry_table.append_columns(cols.DataColumn(path, tuple(path.split('.'))))
+
+    @QtCore.Slot(QtCore.QPoint)
+    def _header_context_menu(self, point: QtCore.QPoint):
+        header = self._entry_table_view.horizontalHeader()
+        menu = QtWidgets.QMenu(self._entry_table_view)
+        add_menu = menu.addMenu('Add column')
+        for path, frequency in self.get_column_suggestions():
+            action = add_menu.addAction('{} ({:.0%})'.format(path, frequency))
+            action.triggered.connect(functools.partial(self.add_column, path))
+        add_menu.setEnabled(not add_menu.isEmpty())
+        menu.exec_(header.mapToGlobal(point))
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""Module for keeping a persistent history of the queries that have been executed on each database"""
+import collections
+import math
+import pathlib
+import sqlite3
+import threading
+import time
+from typing import List, Optional, Sequence
+from urllib import parse
+
+__all__ = 'QueryHistory', 'QueryStats', 'redact_uri'
+
+DEFAULT_PATH = pathlib.Path.home() / '.mincepy_gui' / 'query_history.sqlite'
+
+QueryStats = collections.namedtuple(
+    'QueryStats', 'query text count last_executed latency_p50 latency_p95 num_results')
+QueryStats.__doc__ = """The statistics of a query executed on a database.  The latencies are in
+seconds and num_results is the number of results the last time it was executed (None if this
+isn't known)."""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS queries (
+    uri TEXT NOT NULL,
+    query TEXT NOT NULL,
+    text TEXT NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    last_executed REAL,
+    PRIMARY KEY (uri, query)
+);
+CREATE TABLE IF NOT EXISTS executions (
+    uri TEXT NOT NULL,
+    query TEXT NOT NULL,
+    executed REAL NOT NULL,
+    latency REAL,
+    num_results INTEGER
+);
+CREATE INDEX IF NOT EXISTS executions_by_query ON executions (uri, query, executed);
+"""
+
+
+def redact_uri(uri: str) -> str:
+    """Remove any password from a database URI so that it isn't written to disk"""
+    parts = parse.urlsplit(uri)
+    if parts.password is None:
+        return uri
+
+    netloc = parts.netloc.rsplit('@', 1)[-1]
+    if parts.username is not None:
+        netloc = '{}@{}'.format(parts.username, netloc)
+    return parse.urlunsplit(parts._replace(netloc=netloc))
+
+
+def percentile(values: Sequence[float], fraction: float) -> Optional[float]:
+    """Get the given percentile (as a fraction) of the values using the nearest rank method"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(math.ceil(fraction * len(ordered)) - 1, 0)]
+
+
+class QueryHistory:
+    """A history of the queries executed on each database (identified by URI) kept in an SQLite
+    file.  Queries are identified by their normalised form while the text (as shown in the query
+    line) is kept so that they can be recalled.  This can be used from any thread, and calls made
+    after it has been closed are ignored."""
+    # The number of executions of each query kept to calculate the latency percentiles
+    MAX_EXECUTIONS = 200
+
+    def __init__(self, path=DEFAULT_PATH):
+        """
+        :param path: the path to the SQLite file, ':memory:' can be used to not persist anything
+        """
+        if path != ':memory:':
+            path = pathlib.Path(path)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path = str(path)
+
+        self._lock = threading.Lock()
+        self._closed = False
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.executescript(SCHEMA)
+
+    def close(self):
+        """Close the history, any calls still to be made from other threads will do nothing"""
+        with self._lock:
+            self._closed = True
+            self._connection.close()
+
+    def record(self,
+               uri: str,
+               query: str,
+               text: str,
+               latency: Optional[float],
+               num_results: Optional[int],
+               executed: float = None):
+        """Record an execution of a query
+
+        :param uri: the URI of the database the query was executed on
+        :param query: the normalised query
+        :param text: the text of the query as it would be entered in the query line
+        :param latency: the time it took to get the first results (in seconds), if known
+        :param num_results: the number of results, if known
+        :param executed: the time it was executed, defaults to now
+        """
+        uri = redact_uri(uri)
+        executed = time.time() if executed is None else executed
+        with self._lock:
+            if self._closed:
+                return
+
+            with self._connection:
+                self._record(uri, query, text, latency, num_results, executed)
+
+    def _record(self, uri: str, query: str, text: str, latency: Optional[float],
+                num_results: Optional[int], executed: float):
+        """Record an execution of a query, the lock must be held"""
+        cursor = self._connection.cursor()
+        cursor.execute('INSERT OR IGNORE INTO queries (uri, query, text) VALUES (?, ?, ?)',
+                       (uri, query, text))
+        cursor.execute(
+            'UPDATE queries SET text = ?, count = count + 1, last_executed = ? '
+            'WHERE uri = ? AND query = ?', (text, executed, uri, query))
+        cursor.execute(
+            'INSERT INTO executions (uri, query, executed, latency, num_results) '
+            'VALUES (?, ?, ?, ?, ?)', (uri, query, executed, latency, num_results))
+        # Only keep the most recent executions
+        cursor.execute(
+            'DELETE FROM executions WHERE uri = ? AND query = ? AND rowid NOT IN ('
+            'SELECT rowid FROM executions WHERE uri = ? AND query = ? '
+            'ORDER BY executed DESC LIMIT ?)', (uri, query, uri, query, self.MAX_EXECUTIONS))
+
+    def get_stats(self, uri: str, limit: int = None) -> List[QueryStats]:
+        """Get the statistics of the queries executed on the given database, most frequently
+        executed first"""
+        uri = redact_uri(uri)
+        limit = -1 if limit is None else limit
+        with self._lock:
+            if self._closed:
+                return []
+
+            cursor = self._connection.cursor()
+            rows = cursor.execute(
+                'SELECT query, text, count, last_executed FROM queries WHERE uri = ? '
+                'ORDER BY count DESC, last_executed DESC LIMIT ?', (uri, limit)).fetchall()
+            # The executions of all of those queries in one go, most recent first
+            executions = collections.defaultdict(list)
+            for query, latency, num_results in cursor.execute(
+                    'SELECT executions.query, latency, num_results FROM executions JOIN ('
+                    'SELECT query FROM queries WHERE uri = ? '
+                    'ORDER BY count DESC, last_executed DESC LIMIT ?) AS top '
+                    'ON executions.query = top.query WHERE executions.uri = ? '
+                    'ORDER BY executed DESC', (uri, limit, uri)):
+                executions[query].append((latency, num_results))
+
+        stats = []
+        for query, text, count, last_executed in rows:
+            latencies = [latency for latency, _ in executions[query] if latency is not None]
+            num_results = next(
+                (num_results for _, num_results in executions[query] if num_results is not None),
+                None)
+            stats.append(
+                QueryStats(query, text, count, last_executed, percentile(latencies, 0.5),
+                           percentile(latencies, 0.95), num_results))
+
+        return stats
+
+    def clear(self, uri: str = None):
+        """Clear the history of the given database, or of all of them if None"""
+        with self._lock:
+            if self._closed:
+                return
+
+            with self._connection:
+                self._clear(uri)
+
+    def _clear(self, uri: Optional[str]):
+        """Clear the history of the given database, or all, the lock must be held"""
+        if uri is None:
+            self._connection.execute('DELETE FROM queries')
+            self._connection.execute('DELETE FROM executions')
+        else:
+            uri = redact_uri(uri)
+            self._connection.execute('DELETE FROM queries WHERE uri = ?', (uri,))
+            self._connection.execute('DELETE FROM executions WHERE uri = ?', (uri,))
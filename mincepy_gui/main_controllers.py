@@ -1,20 +1,30 @@
 # -*- coding: utf-8 -*-
 from concurrent import futures
 from functools import partial
+import json
 import logging
+import sqlite3
+from typing import Iterable, List, Tuple
 
 from PySide2 import QtGui, QtCore, QtWidgets
 from PySide2.QtCore import Qt
 import mincepy
 
 from . import action_controllers
+from . import caching
 from . import db
 from . import extend
 from . import executors
 from . import entry_details
+from . import history
 from . import entry_table
+from . import paged_table
+from . import profiling
 from . import query
+from . import schema
+from . import sources
 from . import types_controller
+from . import utils
 
 __all__ = ('MainController',)
 
@@ -22,8 +32,16 @@ logger = logging.getLogger(__name__)
 
 
 class MainController(QtCore.QObject):
-
-    def __init__(self, window, default_uri=''):
+    # The maximum (approximate) number of bytes of query results to keep in the cache
+    QUERY_CACHE_BYTES = 128 * 1024 * 1024
+    # How long query results are cached for (in seconds) as others could be changing the database
+    QUERY_CACHE_TTL = 120.
+    # The number of the most frequently executed queries whose results are cached on connecting
+    NUM_PREWARM_QUERIES = 3
+    # The number of previous queries that can be recalled in the query line
+    NUM_RECENT_QUERIES = 50
+
+    def __init__(self, window, default_uri='', history_path=history.DEFAULT_PATH):
         super().__init__(window)
         self._window = window
         self._default_uri = default_uri
@@ -33,12 +51,35 @@ class MainController(QtCore.QObject):
         self._executor.task_started.connect(self._task_started)
         self._executor.task_ended.connect(self._task_ended)
 
+        # Objects and snapshots loaded from the database, shared by everything that loads them
+        self._object_cache = caching.ObjectCache()
+
         self._action_manager = extend.ActionManager()
         self._action_context = {
             action_controllers.ActionContext.PARENT: self._window,
-            action_controllers.ActionContext.CLIPBOARD: QtGui.QGuiApplication.clipboard()
+            action_controllers.ActionContext.CLIPBOARD: QtGui.QGuiApplication.clipboard(),
+            action_controllers.ActionContext.OBJECT_CACHE: self._object_cache
         }
         self._copier = None
+        # Incremented each time a query is executed so that results of superseded ones are dropped
+        self._query_generation = 0
+        # The future of the query being executed, if any
+        self._query_future = None
+        # (Normalised query, record paths fetched) -> list of records
+        self._query_cache = caching.LRUCache(self.QUERY_CACHE_BYTES, ttl=self.QUERY_CACHE_TTL)
+        # Incremented whenever the cache is invalidated so results fetched before then aren't cached
+        self._query_cache_epoch = 0
+        # The profiles of the queries that have been executed
+        self._query_profiles = profiling.QueryHistoryModel(parent=self)
+        # The query profiler dialog, created when first shown
+        self._profiler_dialog = None
+        # The record paths that the results table needs, updated on the GUI thread as its columns
+        # change so that worker threads fetching results can read it
+        self._table_projection = ()  # type: Tuple[str, ...]
+        self._query_history = self._create_query_history(history_path)
+        # The URI and profile of the current query, this is recorded in the history once superseded
+        self._unrecorded = None
+        self._schema_sampler = schema.SchemaSampler(executor=self._executor.execute, parent=self)
         self._load_plugins()
 
         # Keep reference to our status bar
@@ -48,9 +89,25 @@ class MainController(QtCore.QObject):
         self._create_controllers(window)
 
         self._init_shortcuts()
-        window.refresh_button.clicked.connect(self._execute_current_query)
+        window.refresh_button.clicked.connect(self._refresh_current_query)
+        window.keep_obj_id_order.toggled.connect(self._handle_keep_order_toggled)
+        self._recent_queries_ready.connect(self._query_controller.set_recent_queries)
+        self._schema_sampler.updated.connect(self._update_schema_suggestions)
+        self._query_controller.query_model.type_restriction_changed.connect(
+            lambda _type_id: self._update_schema_suggestions())
+        app = QtWidgets.QApplication.instance()
+        if app is not None:
+            app.aboutToQuit.connect(self._handle_about_to_quit)
         self._status_bar.showMessage('Ready')
 
+    @staticmethod
+    def _create_query_history(path) -> history.QueryHistory:
+        try:
+            return history.QueryHistory(path)
+        except (OSError, sqlite3.Error):
+            logger.exception('Unable to open the query history at %s, it will not be saved', path)
+            return history.QueryHistory(':memory:')
+
     def _load_plugins(self):
         logger.info('Starting loading plugins')
         self._action_manager.load_plugins()
@@ -64,6 +121,14 @@ class MainController(QtCore.QObject):
     def _init_shortcuts(self):
         ctrl_c = QtGui.QKeySequence('Ctrl+C')
         QtWidgets.QShortcut(ctrl_c, self._window.splitter, self._copy)
+        ctrl_g = QtGui.QKeySequence('Ctrl+G')
+        QtWidgets.QShortcut(ctrl_g, self._window.splitter, self._go_to_row)
+        ctrl_shift_g = QtGui.QKeySequence('Ctrl+Shift+G')
+        QtWidgets.QShortcut(ctrl_shift_g, self._window.splitter, self._go_to_value)
+        ctrl_shift_p = QtGui.QKeySequence('Ctrl+Shift+P')
+        QtWidgets.QShortcut(ctrl_shift_p, self._window, self._show_query_profiler)
+        ctrl_r = QtGui.QKeySequence('Ctrl+R')
+        QtWidgets.QShortcut(ctrl_r, self._window, self._show_recent_queries)
 
     def _create_controllers(self, window):
         # Database
@@ -76,6 +141,7 @@ class MainController(QtCore.QObject):
             window, action_controller, self._db_controller.database_model)
         # Query
         self._query_controller = self._create_query_controller(window)
+        self._query_scheduler = self._create_query_scheduler(self._query_controller.query_model)
         # Type filter
         self._type_filter_controller = self._create_type_filter_controller(
             window, self._query_controller)
@@ -108,7 +174,11 @@ class MainController(QtCore.QObject):
 
     def _create_results_table(self, window, action_controller, db_model: db.ConstDatabaseModel):
         # Create the model
-        results_table_model = entry_table.EntryTableModel(parent=self)
+        results_table_model = entry_table.EntryTableModel(executor=self._executor.execute,
+                                                          adaptive_batching=True,
+                                                          presize=True,
+                                                          columnar_rows=True,
+                                                          parent=self)
 
         # Create the controller
         results_table_controller = entry_table.EntryTableController(results_table_model,
@@ -119,7 +189,7 @@ class MainController(QtCore.QObject):
         # Connect everything up
 
         # When a query completes, update the results table
-        self._query_completed.connect(results_table_controller.set_source)
+        self._query_completed.connect(self._handle_query_completed)
 
         # Respond to context menu requests from the results table
         results_table_controller.context_menu_requested.connect(
@@ -130,12 +200,46 @@ class MainController(QtCore.QObject):
             to_check = set(obj_ids)
             results_table_controller.remove_matching_records(
                 lambda record: record.obj_id in to_check)
+            if results_table_model.num_loaded < results_table_model.rowCount():
+                # Rows that aren't loaded can't be checked so count the results to find out if any
+                # of those were deleted as well, in which case the results are got again
+                results_table_model.verify_count()
 
         db_model.objects_deleted.connect(handle_objects_deleted)
+        results_table_model.out_of_date.connect(self._refresh_current_query)
+        # Cached results could contain any of the deleted objects
+        db_model.objects_deleted.connect(lambda _obj_ids: self._invalidate_query_cache())
+        db_model.objects_deleted.connect(self._object_cache.invalidate)
+
+        def update_table_projection(*_args):
+            self._table_projection = tuple(results_table_model.get_projection())
+
+        for signal in (results_table_model.columnsInserted, results_table_model.columnsRemoved,
+                       results_table_model.modelReset):
+            signal.connect(update_table_projection)
+        update_table_projection()
 
         # Respond to requests to sort the results table
         window.entries_table.setSortingEnabled(True)
         results_table_model.sort_requested.connect(self._handle_query_sort_requested)
+        results_table_model.sorted_locally.connect(self._handle_sorted_locally)
+
+        # Show how many of the results have been loaded
+        results_label = QtWidgets.QLabel(self._window)
+        self._status_bar.addPermanentWidget(results_label)
+
+        def update_results_label(*_args):
+            total = results_table_model.total_count
+            if total is None:
+                results_label.setText('')
+            else:
+                results_label.setText('Loaded {} of {}'.format(results_table_model.num_loaded,
+                                                               total))
+
+        for signal in (results_table_model.total_count_changed, results_table_model.rowsInserted,
+                       results_table_model.rowsRemoved, results_table_model.modelReset,
+                       results_table_model.dataChanged):
+            signal.connect(update_results_label)
 
         return results_table_controller
 
@@ -149,11 +253,13 @@ class MainController(QtCore.QObject):
                                                  window.obj_id_line,
                                                  parent=self)
 
-        # Connect everything up
-        query_model.query_changed.connect(lambda _new_query: self._execute_current_query())
-
         return query_controller
 
+    def _create_query_scheduler(self, query_model: query.QueryModel):
+        query_scheduler = query.QueryScheduler(query_model, parent=self)
+        query_scheduler.execute_requested.connect(lambda _new_query: self._execute_current_query())
+        return query_scheduler
+
     def _create_type_filter_controller(self, window, query_controller):
         # Create the controller (using internal model from view)
         type_filter_controller = types_controller.TypeFilterController(
@@ -166,18 +272,21 @@ class MainController(QtCore.QObject):
         return type_filter_controller
 
     def _create_entry_details(self, window, action_controller,
-                              results_table: entry_table.ConstEntryTable):
+                              results_table: paged_table.ConstEntryTable):
         # Create the model
         entry_details_model = entry_details.EntryDetails(parent=self)
         # Link model and view
         window.entry_details.setModel(entry_details_model)
 
         # Create the controller
-        entry_details_controller = entry_details.EntryDetailsController(results_table,
-                                                                        window.entries_table,
-                                                                        window.entry_details,
-                                                                        entry_details_model,
-                                                                        parent=self)
+        entry_details_controller = entry_details.EntryDetailsController(
+            results_table,
+            window.entries_table,
+            window.entry_details,
+            entry_details_model,
+            executor=self._executor.execute,
+            object_cache=self._object_cache,
+            parent=self)
 
         # Connect everything up
         entry_details_controller.context_menu_requested.connect(
@@ -212,6 +321,10 @@ class MainController(QtCore.QObject):
         elif current_override != cursor:
             app.setOverrideCursor(cursor)
 
+        if future.cancelled():
+            # Superseded, e.g. by a newer query, so there is nothing to report
+            return
+
         try:
             new_msg = future.result()
             if new_msg is not None:
@@ -220,7 +333,8 @@ class MainController(QtCore.QObject):
             QtWidgets.QErrorMessage(self._window).showMessage(str(exc))
 
     # Signals
-    _query_completed = QtCore.Signal(object, mincepy.Historian)
+    _query_completed = QtCore.Signal(int, object, mincepy.Historian)
+    _recent_queries_ready = QtCore.Signal(list)
 
     @QtCore.Slot()
     def _copy(self):
@@ -232,26 +346,281 @@ class MainController(QtCore.QObject):
         elif self._window.entry_details.hasFocus():
             self._entry_details_controller.handle_copy(self._copier)
 
+    @QtCore.Slot()
+    def _go_to_row(self):
+        row, accepted = QtWidgets.QInputDialog.getInt(self._window, 'Go to row', 'Row:', 1, 1)
+        if accepted:
+            self._results_table_controller.go_to_row(row - 1)
+
+    @QtCore.Slot()
+    def _go_to_value(self):
+        text, accepted = QtWidgets.QInputDialog.getText(
+            self._window, 'Go to value', 'Go to the first result with a sort value of at least:')
+        if not accepted:
+            return
+
+        try:
+            value = json.loads(text, cls=utils.UUIDDecoder)
+        except json.decoder.JSONDecodeError:
+            # Treat it as a string
+            value = text
+
+        if not self._results_table_controller.go_to_value(value):
+            self._status_bar.showMessage('The current results can\'t be searched by value', 2000)
+
+    @QtCore.Slot()
+    def _show_query_profiler(self):
+        if self._profiler_dialog is None:
+            self._profiler_dialog = profiling.QueryProfilerDialog(
+                self._query_profiles,
+                lambda: self._db_controller.database_model.historian,
+                executor=self._executor.execute,
+                parent=self._window)
+
+        self._profiler_dialog.show()
+        self._profiler_dialog.raise_()
+
+    @QtCore.Slot()
+    def _show_recent_queries(self):
+        self._query_controller.show_recent_queries()
+
     @QtCore.Slot()
     def _execute_current_query(self):
         historian = self._db_controller.database_model.historian
         if historian is None:
             return
 
+        # Take what is needed from the GUI now, rather than on the worker thread
+        current_query = self._query_controller.query_model.get_query()
+        paths = self._table_projection
+        keep_order = self._window.keep_obj_id_order.isChecked()
+        self._query_scheduler.mark_executed(current_query)
+
+        self._query_generation += 1
+        generation = self._query_generation
+        if self._query_future is not None:
+            # Don't bother if it hasn't started yet
+            self._query_future.cancel()
+
         def execute_query():
-            query_model = self._query_controller.query_model
-            results = historian.records.find(**query_model.get_query())
-            self._query_completed.emit(iter(results), historian)
+            if generation != self._query_generation:
+                # Already superseded
+                return
+
+            cache_key = self._get_cache_key(current_query, paths, keep_order)
+            cached = self._query_cache.get(cache_key)
+            profile = profiling.QueryProfile(current_query, cached=cached is not None)
+            if cached is not None:
+                logger.debug('Using cached results for query: %s', cache_key)
+                source = sources.ListRecordSource(cached)
+            else:
+                source = self._create_query_source(historian, current_query, keep_order)
+                # Kept so that the query can be explained if it is looked at in the profiler
+                profile.first_query = profiling.get_first_query(source)
+            self._query_completed.emit(generation, profiling.profile_source(source, profile),
+                                       historian)
+
+        self._query_future = self._executor.execute(execute_query, 'Querying...', blocking=False)
+
+    def _create_query_source(self,
+                             historian: mincepy.Historian,
+                             current_query: dict,
+                             keep_order=True) -> sources.CachingIterable:
+        """Create the source of the results of a query that isn't cached
+
+        :param keep_order: if True, the results of a lookup of a list of object ids are in the order
+            of the ids (unless sorted)
+        """
+        # Only fetch what the results table needs to show.  The columns can change while the
+        # results are being fetched so keep track of the paths that were asked for.
+        requested = []  # type: List[List[str]]
+
+        def get_projection() -> List[str]:
+            paths = list(self._table_projection)
+            requested.append(paths)
+            return paths
+
+        on_complete = partial(self._cache_query_results, self._query_cache_epoch, current_query,
+                              keep_order, requested)
+        if _is_obj_id_lookup(current_query):
+            # Too many to look up in one go
+            other_criteria = current_query.copy()
+            obj_ids = other_criteria.pop('obj_id')
+            source = sources.ObjIdLookupSource(historian,
+                                               obj_ids,
+                                               other_criteria,
+                                               preserve_order=keep_order,
+                                               projection=get_projection)
+            return sources.CachingIterable(source, on_complete)
+
+        source = sources.KeysetRecordSource(historian,
+                                            current_query,
+                                            projection=get_projection,
+                                            keyset=self._is_sorted_on_single_type(current_query))
+        return sources.CachingRecordSource(source, on_complete)
+
+    def _is_sorted_on_single_type(self, current_query: dict) -> bool:
+        """Keyset paging relies on the database comparing the values of the sort key, which it only
+        does for values of the same type.  The fields of the record itself always are, for anything
+        else the sampled schema has to have found just one type."""
+        sort = current_query.get('sort', None) or {}
+        if len(sort) != 1:
+            # Not paged by key anyway
+            return True
+
+        path = next(iter(sort))
+        if path in mincepy.DataRecord._fields:
+            return True
+
+        return self._schema_sampler.index.is_single_type(path, current_query.get('obj_type', None))
+
+    def _get_cache_key(self,
+                       current_query: dict,
+                       paths: Iterable[str] = None,
+                       keep_order=True) -> tuple:
+        """Get the key of the cached results of a query.  The records may have been projected so this
+        includes the record paths that were fetched, by default those the results table shows."""
+        if paths is None:
+            paths = self._table_projection
+        # Whether the order of the object ids was kept only matters when looking them up
+        ordered = keep_order or not _is_obj_id_lookup(current_query)
+        return query.normalise_query(current_query), tuple(sorted(set(paths))), ordered
+
+    def _cache_query_results(self, epoch: int, current_query: dict, keep_order: bool,
+                             requested: List[List[str]], records: list):
+        """Called (possibly from a worker thread) once all the results of a query have been fetched
+        """
+        if epoch != self._query_cache_epoch:
+            return
+
+        requested = list(requested)
+        # Only the paths that every record was fetched with can be relied on
+        paths = set.intersection(*map(set, requested)) if requested else None
+        self._query_cache.put(self._get_cache_key(current_query, paths, keep_order), records)
+
+    def _invalidate_query_cache(self):
+        self._query_cache_epoch += 1
+        self._query_cache.clear()
+
+    @QtCore.Slot(bool)
+    def _handle_keep_order_toggled(self, _checked: bool):
+        if _is_obj_id_lookup(self._query_controller.query_model.get_query()):
+            self._execute_current_query()
+
+    @QtCore.Slot()
+    def _refresh_current_query(self):
+        """Execute the current query making sure that the results come from the database"""
+        normalised = query.normalise_query(self._query_controller.query_model.get_query())
+        for key in self._query_cache.keys():
+            if key[0] == normalised:
+                self._query_cache.pop(key)
+        self._execute_current_query()
+
+    @QtCore.Slot(int, object, mincepy.Historian)
+    def _handle_query_completed(self, generation: int, source, historian: mincepy.Historian):
+        if generation != self._query_generation:
+            # A newer query has been executed since, so drop these results
+            logger.debug('Dropping the results of superseded query %i', generation)
+            return
+
+        self._query_profiles.add_profile(source.profile)
+        # The previous query is done with so record how it went
+        self._record_query()
+        self._unrecorded = self._db_controller.uri, source.profile
+        self._results_table_controller.set_source(source, historian)
+
+    def _record_query(self, blocking=False):
+        """Record the current query in the history
 
-        self._executor.execute(execute_query, 'Querying...', blocking=False)
+        :param blocking: if True the query is recorded before returning, otherwise it's done on the
+            executor
+        """
+        if self._unrecorded is None:
+            return
+
+        uri, profile = self._unrecorded
+        self._unrecorded = None
+        # Superseded, so there is no need to keep track of the records that were delivered
+        profile.forget_delivered()
+        if uri is None:
+            return
+
+        text = json.dumps(profile.query, cls=utils.UUIDEncoder)
+        # Cached results say nothing about how long the query takes
+        latency = None if profile.cached else profile.latency
+        if blocking:
+            self._query_history.record(uri, profile.normalised, text, latency, profile.num_results)
+            return
+
+        def record():
+            self._query_history.record(uri, profile.normalised, text, latency, profile.num_results)
+            self._recent_queries_ready.emit(self._get_recent_queries(uri))
+
+        self._executor.execute(record, blocking=False)
+
+    @QtCore.Slot()
+    def _handle_about_to_quit(self):
+        # The event loop has finished so anything put on the executor now may never get done
+        self._record_query(blocking=True)
+        # Any history tasks still on the executor are ignored by the history once it's closed
+        self._query_history.close()
+
+    def _get_recent_queries(self, uri: str) -> List[str]:
+        return [stats.text for stats in self._query_history.get_stats(uri, self.NUM_RECENT_QUERIES)]
+
+    def _load_query_history(self, historian: mincepy.Historian, uri: str):
+        """Offer the queries previously executed on this database for recall and cache the results
+        of the most frequent ones.  Called on the executor."""
+        stats = self._query_history.get_stats(uri, self.NUM_RECENT_QUERIES)
+        self._recent_queries_ready.emit([entry.text for entry in stats])
+
+        codec = utils.QueryCodec()
+        for entry in stats[:self.NUM_PREWARM_QUERIES]:
+            if entry.num_results is None or \
+                    entry.num_results > sources.CachingRecordSource.DEFAULT_MAX_RECORDS:
+                # Too many to cache (or we don't know)
+                continue
+
+            try:
+                prewarm_query = codec.decode(entry.text)
+            except ValueError:
+                continue
+            cache_key = self._get_cache_key(prewarm_query)
+            if cache_key in self._query_cache:
+                continue
+
+            logger.debug('Pre-warming the cache with the results of: %s', cache_key)
+            for _ in self._create_query_source(historian, prewarm_query):
+                if historian is not self._db_controller.database_model.historian:
+                    # Connected to something else since
+                    return
 
     @QtCore.Slot(mincepy.Historian)
     def _handle_historian_created(self, historian: mincepy.Historian):
         mincepy.set_historian(historian)
+        self._record_query()
+        self._schema_sampler.set_historian(historian)
+        self._results_table_controller.set_schema_index(self._schema_sampler.index)
+        self._invalidate_query_cache()
+        self._object_cache.clear()
         self._results_table_controller.reset()
         self._entry_details_controller.reset(historian)
         self._type_filter_controller.update(historian)
         self._execute_current_query()
+        if self._db_controller.uri is not None:
+            self._executor.execute(partial(self._load_query_history, historian,
+                                           self._db_controller.uri),
+                                   blocking=False)
+
+    @QtCore.Slot()
+    def _update_schema_suggestions(self):
+        """Offer the paths of the sampled schema, of the type being queried if there is one, for
+        completion in the query line and as columns"""
+        self._results_table_controller.set_schema_index(self._schema_sampler.index)
+        paths = self._schema_sampler.index.get_paths(
+            self._query_controller.query_model.get_type_restriction())
+        self._query_controller.set_completion_paths([path for path, _ in paths])
+        self._results_table_controller.header_menu.set_column_suggestions(paths)
 
     @QtCore.Slot(dict)
     def _handle_query_changed(self, _new_query: dict):
@@ -267,3 +636,19 @@ class MainController(QtCore.QObject):
             return
 
         self._query_controller.set_sort(sort)
+
+    @QtCore.Slot(str, QtCore.Qt.SortOrder)
+    def _handle_sorted_locally(self, path, order):
+        """The results table sorted its records itself so update the query to match without running
+        it again"""
+        # If other changes are waiting to be executed then the results will be replaced anyway
+        pending = self._query_scheduler.pending
+        self._handle_query_sort_requested(path, order)
+        if not pending:
+            self._query_scheduler.mark_executed(self._query_controller.query_model.get_query())
+
+
+def _is_obj_id_lookup(current_query: dict) -> bool:
+    """Does the query have too many object ids to look up in one go?"""
+    obj_ids = current_query.get('obj_id', None)
+    return isinstance(obj_ids, list) and len(obj_ids) > sources.ObjIdLookupSource.DEFAULT_CHUNK_SIZE
@@ -0,0 +1,735 @@
+# -*- coding: utf-8 -*-
+"""Module containing the table models that load the records of a source, in the background, as they
+are needed"""
+import functools
+import itertools
+import logging
+import time
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from PySide2 import QtCore
+import mincepy
+
+from . import caching
+from . import columnar
+from . import columns as cols
+from . import common
+from . import prefetch
+from . import record_store
+from . import sources
+from . import utils
+
+__all__ = 'ConstEntryTable', 'PagedEntryTable'
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class ConstEntryTable(QtCore.QAbstractTableModel):
+    """Read-only view of the entries table model"""
+    DEFAULT_BATCH_SIZE = 64
+    DEFAULT_DISPLAY_CACHE_BYTES = 16 * 1024 * 1024
+    # What to show in place of records that are still being loaded
+    LOADING_TEXT = '...'
+
+    sort_requested = QtCore.Signal(str, QtCore.Qt.SortOrder)
+    # Emitted when the total number of records in the source becomes known (or unknown, None)
+    total_count_changed = QtCore.Signal(object)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._historian = None  # type: Optional[mincepy.Historian]
+        self._records = record_store.RecordStore()
+        self._columns = []  # type: List[cols.Column]
+        self._prefetcher = None  # type: Optional[prefetch.RecordPrefetcher]
+        self._total_count = None  # type: Optional[int]
+        self._batcher = prefetch.AdaptiveBatcher(self.DEFAULT_BATCH_SIZE, adaptive=False)
+        # Cache of display strings keyed by (row, column, role), the only place that cell data is
+        # memoised.  When windowed, the strings of rows that are evicted are dropped too.
+        self._display_cache = caching.LRUCache(self.DEFAULT_DISPLAY_CACHE_BYTES)
+
+    @property
+    def batcher(self) -> prefetch.AdaptiveBatcher:
+        """Get the batcher, this exposes the current batch size and the observed throughput"""
+        return self._batcher
+
+    @property
+    def batch_size(self) -> int:
+        """The number of records that will be fetched in the next batch"""
+        return self._batcher.batch_size
+
+    @batch_size.setter
+    def batch_size(self, value: int):
+        self._batcher.batch_size = value
+
+    @property
+    def columns(self):
+        return self._columns
+
+    @property
+    def total_count(self) -> Optional[int]:
+        """The total number of records in the source, None if not (yet) known"""
+        return self._total_count
+
+    @property
+    def num_loaded(self) -> int:
+        """The number of records currently loaded"""
+        return self._records.num_resident
+
+    def get_projection(self) -> List[str]:
+        """Get the (dot separated) record paths that the columns need to show their data"""
+        return [
+            '.'.join(map(str, col.path))
+            for col in tuple(self._columns)
+            if isinstance(col, cols.DataColumn)
+        ]
+
+    @property
+    def records(self) -> record_store.RecordStore:
+        """Get the records store, rows that are not resident are None and rows that are held as
+        columns are columnar.RowHandles"""
+        return self._records
+
+    def get_record(self, row) -> Optional[mincepy.DataRecord]:
+        """Get the record at the given row.  Returns None if the row is out of range or the record
+        is not loaded (in which case it will be loaded).  This never goes to the archive so the
+        record may be partial, e.g. rows that are held as columns give a PartialRecord with just the
+        identity fields.  Use PagedEntryTable.load_records() to get the full records."""
+        if row < 0 or row >= len(self._records):
+            return None
+
+        record = self._record_at(row)
+        if isinstance(record, columnar.RowHandle):
+            record = record.to_record()
+        return record
+
+    def headerData(self, section: int, orientation: QtCore.Qt.Orientation, role: int = ...) -> Any:
+        if role != QtCore.Qt.DisplayRole:
+            return None
+
+        if orientation == QtCore.Qt.Orientation.Horizontal:
+            if section < 0 or section >= len(self._columns):
+                return None
+            return self._columns[section].name
+
+        if orientation == QtCore.Qt.Orientation.Vertical:
+            if section < 0 or section >= len(self._records):
+                return None
+            return str(section)
+
+        return None
+
+    def rowCount(self, _parent: QtCore.QModelIndex = ...) -> int:
+        return len(self._records)
+
+    def columnCount(self, _parent: QtCore.QModelIndex = ...) -> int:
+        return len(self._columns)
+
+    def data(self, index: QtCore.QModelIndex, role: int = ...) -> Any:
+        if not index.isValid():
+            return None
+
+        if index.row() >= len(self._records) or index.row() < 0:
+            return None
+
+        if index.column() >= len(self._columns) or index.column() < 0:
+            return None
+
+        record = self._record_at(index.row())
+        if record is None:
+            return self.LOADING_TEXT if role == QtCore.Qt.DisplayRole else None
+
+        col = self._columns[index.column()]
+        if role != QtCore.Qt.DisplayRole:
+            return self._cell_data(record, col, role)
+
+        key = index.row(), col, role
+        value = self._display_cache.get(key, _MISSING)
+        if value is _MISSING:
+            value = self._cell_data(record, col, role)
+            self._display_cache.put(key, value)
+        return value
+
+    def _cell_data(self, record, col: cols.Column, role: int) -> Any:
+        """Get the data of a cell given the (resident) record or row handle of its row"""
+        if isinstance(record, columnar.RowHandle):
+            if col not in record:
+                # Added since the row was loaded, it will be loaded again
+                return None
+            return record.data(col, role, self._historian)
+
+        return col.data(record, role, self._historian)
+
+    def sort(self, column: int, order: QtCore.Qt.SortOrder = ...):
+        col = self._get_sort_column(column)
+        if col is None:
+            return
+
+        self.sort_requested.emit('.'.join(col.path), order)
+
+    def _get_sort_column(self, column: int) -> Optional[cols.DataColumn]:
+        """Get the column with the given index if it can be sorted on, otherwise None"""
+        if column < 0 or column >= len(self._columns):
+            return None
+
+        col = self._columns[column]
+        if not isinstance(col, cols.DataColumn):
+            return None
+
+        return col
+
+    def _record_at(self, row: int) -> Optional[mincepy.DataRecord]:
+        return self._records[row]
+
+
+class PagedEntryTable(ConstEntryTable):
+    """An entries table that loads the records of its source in the background.  Sources that
+    support paging have their rows loaded (and evicted) as they are needed, can be presized, gone to
+    by row or sort value and sorted locally if there are few enough records."""
+    # The number of records either side of the viewport that will be kept in memory
+    DEFAULT_WINDOW_MARGIN = 2048
+    # Tables with up to this many records, about as many as are kept either side of the viewport, are
+    # sorted locally (loading any that aren't resident first), otherwise on the server
+    MAX_LOCAL_SORT = 2 * DEFAULT_WINDOW_MARGIN
+
+    # Emitted when the records were sorted locally (rather than by sort_requested) with the path
+    # that was sorted on and the order
+    sorted_locally = QtCore.Signal(str, QtCore.Qt.SortOrder)
+    # Emitted with the row found by go_to_value(), -1 if there wasn't one
+    row_found = QtCore.Signal(int)
+
+    # Emitted when the source turns out to hold a different number of records to the rows, e.g.
+    # because records that weren't resident were deleted, so the rows no longer line up with it
+    out_of_date = QtCore.Signal()
+
+    # Signal used to deliver pages loaded on the executor: generation, start row, count, records
+    _page_loaded = QtCore.Signal(int, int, int, object)
+    # Signal used to report a page that failed to load: generation, start row, count
+    _page_failed = QtCore.Signal(int, int, int)
+    # Signal used to deliver the total count from the executor: source, count
+    _count_ready = QtCore.Signal(object, object)
+    # Signal used to deliver a recount from the executor: source, count
+    _recounted = QtCore.Signal(object, object)
+    # Signal used to deliver the result of a seek: generation, (position, records)
+    _seek_done = QtCore.Signal(int, object)
+    # Signal used to deliver the rows loaded so that they can be sorted locally: generation, ranges,
+    # [(start row, count, records)], column, order
+    _sort_rows_loaded = QtCore.Signal(int, object, object, object, QtCore.Qt.SortOrder)
+    # Signal used to deliver the records loaded by load_records(): callback, records
+    _records_loaded = QtCore.Signal(object, object)
+
+    def __init__(self,
+                 executor=common.default_executor,
+                 adaptive_batching=False,
+                 window_margin=DEFAULT_WINDOW_MARGIN,
+                 presize=False,
+                 columnar_rows=False,
+                 parent=None):
+        """
+        :param executor: the executor used to fetch records in the background
+        :param adaptive_batching: if True the batch size will be adapted to the observed fetch
+            latency and record size
+        :param window_margin: the number of records either side of the viewport to keep in memory,
+            records further away are evicted and reloaded when needed.  Only applies to sources that
+            support paging.
+        :param presize: if True, once the total number of records is known the table is grown to
+            that size with placeholder rows that are loaded when they are scrolled to.  Only applies
+            to sources that support paging.
+        :param columnar_rows: if True the values of the columns are extracted from each batch of
+            records as it arrives and only these, the state and the identity of each record, are
+            kept.  The values of state columns added later are extracted from the state, rows are
+            only loaded again if their records were projected without them.  Only applies to
+            sources that support paging.
+        :param parent: the parent object
+        """
+        super().__init__(parent)
+        self._executor = executor
+        self._batcher.adaptive = adaptive_batching
+        self.window_margin = window_margin
+        self._presize = presize
+        self._columnar_rows = columnar_rows
+        # Set once rows are loaded as they are needed rather than being streamed in
+        self._windowed = False
+        # Set when a fetch was requested but no batch was ready, the next batch to arrive will be
+        # inserted straight away
+        self._fetch_requested = False
+        # The source if it supports paging, otherwise None
+        self._source = None  # type: Optional[sources.RecordSource]
+        # Incremented whenever rows are reset or shift so that stale pages can be discarded
+        self._generation = 0
+        # Rows that are currently being (re)loaded
+        self._loading = set()
+        # Column -> sort key of each row, computed when first sorting on a column
+        self._sort_keys = {}
+        self._page_loaded.connect(self._handle_page_loaded)
+        self._page_failed.connect(self._handle_page_failed)
+        self._count_ready.connect(self._handle_count_ready)
+        self._recounted.connect(self._handle_recounted)
+        self._seek_done.connect(self._handle_seek_done)
+        self._sort_rows_loaded.connect(self._handle_sort_rows_loaded)
+        self._records_loaded.connect(self._handle_records_loaded)
+
+    def canFetchMore(self, _parent: QtCore.QModelIndex) -> bool:
+        return self._prefetcher is not None and not self._prefetcher.exhausted
+
+    def fetchMore(self, parent: QtCore.QModelIndex):
+        """Insert the next prefetched batch of records.  If none is ready yet then the batch will
+        be inserted as soon as it arrives, this never touches the database."""
+        if not self.canFetchMore(parent):
+            return
+
+        new_records = self._prefetcher.take()
+        if new_records is None:
+            self._fetch_requested = True
+            return
+
+        self._fetch_requested = False
+        # Insert the new records
+        num_records = len(self._records)
+        self.beginInsertRows(QtCore.QModelIndex(), num_records, num_records + len(new_records) - 1)
+        self._records.extend(self._to_rows(new_records))
+        self._sort_keys = {}
+        self.endInsertRows()
+        self._maybe_presize()
+
+    def set_source(self, source: Optional[Iterator[mincepy.DataRecord]],
+                   historian: Optional[mincepy.Historian]):
+        """Set a new data source, can be None.  This resets the records contained in the list and
+        sets it to be populated from the new source.  If the source is a sources.RecordSource then
+        records far from the viewport will be evicted and reloaded on demand."""
+        self.beginRemoveRows(QtCore.QModelIndex(), 0, len(self._records) - 1)
+        self._records.clear()
+        self._display_cache.clear()
+        self._historian = historian
+        self._set_source(source)
+        self.endRemoveRows()
+        if source is not None:
+            self.fetchMore(QtCore.QModelIndex())
+
+    def load_records(self, rows: Iterable[int], callback: Callable[[list], None]):
+        """Get the full records of the given rows and pass them to the callback.  Records that are
+        partial, e.g. rows held as columns, are loaded from the archive with one query in the
+        background.  Rows that aren't resident are skipped (and will be loaded)."""
+        records = [record for record in map(self.get_record, rows) if record is not None]
+        if self._historian is None or \
+                not any(isinstance(record, sources.PartialRecord) for record in records):
+            callback(records)
+            return
+
+        self._executor(functools.partial(self._load_records, self._historian, records, callback),
+                       'Loading records...',
+                       blocking=True)
+
+    def _load_records(self, historian: mincepy.Historian, records: List[mincepy.DataRecord],
+                      callback: Callable):
+        """Load the full records.  Called on the executor."""
+        try:
+            records = sources.load_full_records(historian, records)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Failed to load the full records, using what is loaded')
+        self._records_loaded.emit(callback, records)
+
+    @QtCore.Slot(object, object)
+    def _handle_records_loaded(self, callback: Callable, records: list):
+        callback([record for record in records if record is not None])
+
+    def set_viewport(self, first_row: int, last_row: int):
+        """Tell the model which rows are currently visible.  Records that are further than the
+        window margin away will be evicted if they can be reloaded later."""
+        if self._source is None:
+            return
+
+        start, end = first_row - self.window_margin, last_row + 1 + self.window_margin
+        evicted = self._records.evict_outside(start, end)
+        if evicted:
+            # Only resident rows have cached display values
+            for row in evicted:
+                for col in self._columns:
+                    self._display_cache.pop((row, col, QtCore.Qt.DisplayRole))
+            logger.debug('Evicted %i records, %i still resident', len(evicted),
+                         self._records.num_resident)
+
+    def _set_source(self, source: Optional[Iterator[mincepy.DataRecord]]):
+        self._source = source if isinstance(source, sources.RecordSource) else None
+        self._generation += 1
+        self._loading = set()
+        self._sort_keys = {}
+        self._windowed = False
+        self._set_total_count(None)
+        self._set_prefetcher(None if source is None else iter(source))
+        if self._source is not None:
+            # Count in parallel with fetching the first batch
+            self._executor(functools.partial(self._count, self._source), blocking=False)
+
+    def _set_total_count(self, total: Optional[int]):
+        if total != self._total_count:
+            self._total_count = total
+            self.total_count_changed.emit(total)
+
+    def _count(self, source: sources.RecordSource):
+        """Count the records in the source.  Called on the executor."""
+        try:
+            total = source.count()
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Failed to count the records in the source')
+        else:
+            self._count_ready.emit(source, total)
+
+    @QtCore.Slot(object, object)
+    def _handle_count_ready(self, source: sources.RecordSource, total: Optional[int]):
+        if source is not self._source:
+            # Stale
+            return
+
+        self._set_total_count(total)
+        self._maybe_presize()
+
+    def verify_count(self):
+        """Count the records of the source again, in the background, and emit out_of_date if there
+        are more or fewer than there are rows.  Use this after records have been removed from the
+        source as rows that weren't resident can't be checked."""
+        if self._source is None or self._total_count is None:
+            # Nothing that isn't resident
+            return
+
+        self._executor(functools.partial(self._recount, self._source), blocking=False)
+
+    def _recount(self, source: sources.RecordSource):
+        """Count the records in the source again.  Called on the executor."""
+        try:
+            total = source.count()
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Failed to recount the records in the source')
+            total = None
+        self._recounted.emit(source, total)
+
+    @QtCore.Slot(object, object)
+    def _handle_recounted(self, source: sources.RecordSource, total: Optional[int]):
+        if source is not self._source:
+            # Stale
+            return
+
+        if total is None or total != self._total_count:
+            self.out_of_date.emit()
+
+    def _maybe_presize(self):
+        """If presizing, the total is known and the first batch has arrived, then stop streaming
+        and add placeholder rows for all the remaining records"""
+        if self._total_count is None or not self._records:
+            return
+
+        if self._windowed or (self._presize and self._prefetcher is not None):
+            self._grow_to(self._total_count)
+
+    def _grow_to(self, length: int):
+        """Stop streaming and add placeholder rows, that are loaded when needed, up to the given
+        length"""
+        self._windowed = True
+        self._set_prefetcher(None)
+        num_records = len(self._records)
+        if length > num_records:
+            self.beginInsertRows(QtCore.QModelIndex(), num_records, length - 1)
+            self._records.resize(length)
+            self.endInsertRows()
+
+    def go_to_row(self, row: int) -> int:
+        """Make sure that the given row exists, adding placeholder rows if needed, and start loading
+        it without loading the rows in between.  Rows beyond those loaded can only be reached if
+        the source supports paging and the total number of records is known.  Returns the row that
+        was gone to (which is clamped to the rows available), -1 if there are none."""
+        if self._source is None or self._total_count is None:
+            row = min(row, len(self._records) - 1)
+        else:
+            row = min(row, self._total_count - 1)
+            if row >= len(self._records):
+                self._grow_to(self._total_count)
+
+        if row < 0:
+            return -1
+
+        self._record_at(row)
+        return row
+
+    def go_to_value(self, value) -> bool:
+        """Go to the first record whose sort key value comes at, or after, the given value in the
+        current sort order.  This is done with a seek query in the background and row_found is
+        emitted with the row once it is known (-1 if there isn't one).  Returns False if the source
+        can't seek."""
+        if self._source is None:
+            return False
+
+        self._executor(functools.partial(self._seek, self._generation, self._source, value,
+                                         self.batch_size),
+                       blocking=False)
+        return True
+
+    def _seek(self, generation: int, source: sources.RecordSource, value, limit: int):
+        """Seek to a value in the source.  Called on the executor."""
+        try:
+            result = source.seek(value, limit)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Failed to seek to %r', value)
+            result = None
+        self._seek_done.emit(generation, result)
+
+    @QtCore.Slot(int, object)
+    def _handle_seek_done(self, generation: int, result: Optional[Tuple[int, list]]):
+        if generation != self._generation:
+            # Stale
+            return
+
+        if not result or not result[1]:
+            self.row_found.emit(-1)
+            return
+
+        position, records = result
+        # Splice the records in, the rows before them will be loaded if they are scrolled to
+        self._grow_to(position + len(records) if self._total_count is None else self._total_count)
+        self._handle_page_loaded(generation, position, len(records), records)
+        self.row_found.emit(position)
+
+    def _set_prefetcher(self, source: Optional[Iterator[mincepy.DataRecord]]):
+        """Stop any current prefetching and start prefetching from the new source (if not None)"""
+        if self._prefetcher is not None:
+            self._prefetcher.batch_ready.disconnect(self._handle_batch_ready)
+            self._prefetcher.close()
+            self._prefetcher = None
+        self._fetch_requested = False
+
+        if source is not None:
+            self._prefetcher = prefetch.RecordPrefetcher(source,
+                                                         self._batcher,
+                                                         executor=self._executor,
+                                                         parent=self)
+            self._prefetcher.batch_ready.connect(self._handle_batch_ready)
+            self._prefetcher.start()
+
+    @QtCore.Slot()
+    def _handle_batch_ready(self):
+        if self._fetch_requested:
+            self.fetchMore(QtCore.QModelIndex())
+
+    @property
+    def fully_loaded(self) -> bool:
+        """True if all the records of the source are loaded"""
+        return (self._prefetcher is None or self._prefetcher.exhausted) and \
+            self._records.num_resident == len(self._records)
+
+    def sort(self, column: int, order: QtCore.Qt.SortOrder = QtCore.Qt.AscendingOrder):
+        """Sort the records locally if they are all loaded, or can be loaded because there are no
+        more than MAX_LOCAL_SORT, otherwise ask for them to be sorted by the source (see
+        sort_requested)"""
+        col = self._get_sort_column(column)
+        if col is None:
+            return
+
+        if len(self._records) > self.MAX_LOCAL_SORT:
+            super().sort(column, order)
+        elif self.fully_loaded:
+            self._sort_locally(col, order)
+            self.sorted_locally.emit('.'.join(col.path), order)
+        elif self._source is not None and self._total_count is not None and \
+                self._total_count <= self.MAX_LOCAL_SORT:
+            self._load_all_then_sort(col, order)
+        else:
+            super().sort(column, order)
+
+    def _load_all_then_sort(self, col: cols.DataColumn, order: QtCore.Qt.SortOrder):
+        """Load the rows that aren't resident in the background and sort once they arrive"""
+        if len(self._records) < self._total_count:
+            self._grow_to(self._total_count)
+
+        missing = self._records.missing(0, len(self._records))
+        for start, end in missing:
+            self._loading.update(range(start, end))
+        self._executor(functools.partial(self._load_rows, self._generation, self._source, missing,
+                                         col, order),
+                       'Loading results to sort...',
+                       blocking=False)
+
+    def _load_rows(self, generation: int, source: sources.RecordSource, ranges: list,
+                   col: cols.DataColumn, order: QtCore.Qt.SortOrder):
+        """Load the given [start, end) ranges of rows for sorting.  Called on the executor."""
+        pages = []
+        try:
+            for start, end in ranges:
+                pages.append((start, end - start, source.page(start, end - start)))
+        except Exception:  # pylint: disable=broad-except
+            # Deliver what was loaded, the sort will be left to the source
+            logger.exception('Failed to load the rows to sort')
+        self._sort_rows_loaded.emit(generation, ranges, pages, col, order)
+
+    @QtCore.Slot(int, object, object, object, QtCore.Qt.SortOrder)
+    def _handle_sort_rows_loaded(self, generation: int, ranges: list, pages: list,
+                                 col: cols.DataColumn, order: QtCore.Qt.SortOrder):
+        if generation != self._generation:
+            # Stale
+            return
+
+        for start, end in ranges:
+            self._loading.difference_update(range(start, end))
+        for start, count, records in pages:
+            self._handle_page_loaded(generation, start, count, records)
+
+        if self.fully_loaded:
+            self._sort_locally(col, order)
+            self.sorted_locally.emit('.'.join(col.path), order)
+        else:
+            # Some were evicted while loading
+            self.sort_requested.emit('.'.join(col.path), order)
+
+    def _sort_locally(self, col: cols.DataColumn, order: QtCore.Qt.SortOrder):
+        keys = self._sort_keys.get(col, None)
+        if keys is None:
+            keys = [utils.sort_key(_raw_value(record, col)) for record in self._records]
+            self._sort_keys[col] = keys
+
+        new_order = sorted(range(len(keys)),
+                           key=keys.__getitem__,
+                           reverse=order == QtCore.Qt.DescendingOrder)
+
+        self.layoutAboutToBeChanged.emit()
+        new_rows = [0] * len(new_order)
+        for new_row, old_row in enumerate(new_order):
+            new_rows[old_row] = new_row
+        persistent = self.persistentIndexList()
+        self.changePersistentIndexList(
+            persistent, [self.index(new_rows[index.row()], index.column()) for index in persistent])
+
+        self._records.reorder(new_order)
+        for column, column_keys in self._sort_keys.items():
+            self._sort_keys[column] = [column_keys[row] for row in new_order]
+        self._display_cache.clear()
+        # The rows no longer match the order of the source so page them in by their identity
+        self._source = self._get_sorted_source()
+        self._generation += 1
+        self.layoutChanged.emit()
+
+    def _get_sorted_source(self) -> Optional[sources.RecordSource]:
+        """Get a source of the records in the current order of the rows, which must all be
+        resident.  Returns None if the records can't be looked up."""
+        if self._source is None or self._historian is None:
+            return None
+
+        # Only fetch what the columns need if that's all the rows have
+        partial = any(
+            isinstance(record, (sources.PartialRecord, columnar.RowHandle))
+            for record in self._records)
+        return sources.ObjIdListSource(self._historian, [record.obj_id for record in self._records],
+                                       projection=self.get_projection if partial else None)
+
+    def _record_at(self, row: int) -> Optional[mincepy.DataRecord]:
+        record = self._records[row]
+        if record is None:
+            self._request_rows(row)
+        return record
+
+    def _to_rows(self, records: Sequence[mincepy.DataRecord]) -> Sequence:
+        """Get what should be stored for the rows of the given records"""
+        if not self._columnar_rows or self._source is None:
+            return records
+
+        return columnar.ColumnarBatch.create_handles(records, self._columns, self._historian)
+
+    def _request_rows(self, row: int):
+        """Request that the page containing the given row be loaded in the background"""
+        if self._source is None:
+            return
+
+        page_size = self.batch_size
+        page_start = row - row % page_size
+        to_load = [
+            missing_row for start, end in self._records.missing(page_start, page_start + page_size)
+            for missing_row in range(start, end) if missing_row not in self._loading
+        ]
+        for _, group in itertools.groupby(enumerate(to_load), lambda entry: entry[1] - entry[0]):
+            rows = [entry[1] for entry in group]
+            self._loading.update(rows)
+            # Only whole pages are measured
+            measure = len(rows) == page_size
+            self._executor(functools.partial(self._load_page, self._generation, self._source,
+                                             rows[0], len(rows), measure),
+                           blocking=False)
+
+    def _load_page(self, generation: int, source: sources.RecordSource, start: int, count: int,
+                   measure: bool):
+        """Load a page of records.  Called on the executor.
+
+        :param measure: if True, the time taken is given to the batcher.  Only whole pages should be
+            measured as the time to get a few missing rows is mostly the round trip.
+        """
+        started = time.perf_counter()
+        try:
+            records = source.page(start, count)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Failed to load rows %i to %i', start, start + count - 1)
+            self._page_failed.emit(generation, start, count)
+            return
+
+        if measure:
+            self._batcher.measure(records, time.perf_counter() - started)
+        self._page_loaded.emit(generation, start, count, records)
+
+    @QtCore.Slot(int, int, int, object)
+    def _handle_page_loaded(self, generation: int, start: int, count: int, records: list):
+        if generation != self._generation:
+            # Stale
+            return
+
+        self._loading.difference_update(range(start, start + count))
+        records = records[:max(len(self._records) - start, 0)]
+        if len(records) < count and start + len(records) < len(self._records):
+            # The source ended sooner than expected, drop the rows that can't be loaded otherwise
+            # they would be asked for again every time they are shown
+            self._truncate(start + len(records))
+        if records:
+            self._records.set_range(start, self._to_rows(records))
+            self._sort_keys = {}
+            for row in range(start, start + len(records)):
+                for col in self._columns:
+                    self._display_cache.pop((row, col, QtCore.Qt.DisplayRole))
+            self.dataChanged.emit(self.index(start, 0),
+                                  self.index(start + len(records) - 1,
+                                             len(self._columns) - 1))
+
+    @QtCore.Slot(int, int, int)
+    def _handle_page_failed(self, generation: int, start: int, count: int):
+        if generation != self._generation:
+            # Stale
+            return
+
+        # Let the rows be asked for again the next time they are shown
+        self._loading.difference_update(range(start, start + count))
+
+    def _rows_removed(self, ranges: Sequence[Tuple[int, int]]):
+        """Bring everything up to date after the given [start, end) ranges of rows have been removed
+        from the store"""
+        num_removed = sum(end - start for start, end in ranges)
+        if self._source is not None:
+            self._source.removed(ranges)
+        self._sort_keys = {}
+        if self._total_count is not None:
+            self._set_total_count(max(self._total_count - num_removed, len(self._records)))
+        self._display_cache.clear()
+        # Rows have shifted so any pages being loaded are out of date
+        self._generation += 1
+        self._loading = set()
+
+    def _truncate(self, length: int):
+        """Remove all the rows from the given one onwards, the source has no records for them"""
+        self.beginRemoveRows(QtCore.QModelIndex(), length, len(self._records) - 1)
+        self._records.resize(length)
+        self._loading = {row for row in self._loading if row < length}
+        self._sort_keys = {}
+        self.endRemoveRows()
+        if self._total_count is not None:
+            self._set_total_count(length)
+
+
+def _raw_value(record, col: cols.DataColumn) -> Any:
+    """Get the raw value of a column for a record or row handle, i.e. without a historian, as this is
+    what the server sorts on.  Rows held as columns only have the values of the columns shown."""
+    if isinstance(record, columnar.RowHandle):
+        return record.raw_value(col)
+    return col.data(record, common.DataRole)
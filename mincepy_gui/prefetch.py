@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""Module for fetching records in the background so the GUI thread never waits on the database"""
+import collections
+import logging
+import threading
+import time
+from typing import Iterator, List, Optional
+
+from PySide2 import QtCore
+import mincepy
+
+from . import common
+from . import utils
+
+__all__ = 'AdaptiveBatcher', 'RecordPrefetcher'
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveBatcher:
+    """Decides how many records to fetch per batch.  When adaptive, the measured latency and payload
+    size of each batch is used to grow or shrink the batch size towards the target latency while
+    keeping the payload of a batch below a maximum number of bytes."""
+    DEFAULT_TARGET_LATENCY = 0.03  # seconds
+    DEFAULT_MIN_BATCH_SIZE = 8
+    DEFAULT_MAX_BATCH_SIZE = 4096
+    DEFAULT_MAX_BATCH_BYTES = 8 * 1024 * 1024
+    # The weight given to the newest measurement in the running averages
+    SMOOTHING = 0.3
+    # The number of records from each batch that are sized to estimate the payload
+    SIZE_SAMPLES = 8
+
+    def __init__(self,
+                 batch_size: int,
+                 adaptive=True,
+                 target_latency=DEFAULT_TARGET_LATENCY,
+                 min_batch_size=DEFAULT_MIN_BATCH_SIZE,
+                 max_batch_size=DEFAULT_MAX_BATCH_SIZE,
+                 max_batch_bytes=DEFAULT_MAX_BATCH_BYTES):
+        self._lock = threading.Lock()
+        self._batch_size = batch_size
+        self.adaptive = adaptive
+        self.target_latency = target_latency
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.max_batch_bytes = max_batch_bytes
+
+        # Running averages
+        self._throughput = None  # records / s
+        self._byte_rate = None  # bytes / s
+        self._record_bytes = None  # bytes / record
+        self._latency = None  # s / batch
+
+    @property
+    def batch_size(self) -> int:
+        """The number of records to fetch in the next batch"""
+        with self._lock:
+            return self._batch_size
+
+    @batch_size.setter
+    def batch_size(self, value: int):
+        with self._lock:
+            self._batch_size = value
+
+    @property
+    def throughput(self) -> Optional[float]:
+        """The observed throughput in records per second (None if nothing has been measured)"""
+        return self._throughput
+
+    @property
+    def byte_rate(self) -> Optional[float]:
+        """The observed throughput in (approximate) bytes per second"""
+        return self._byte_rate
+
+    @property
+    def latency(self) -> Optional[float]:
+        """The observed time to fetch a batch in seconds"""
+        return self._latency
+
+    def measure(self, batch: List, duration: float):
+        """Record how long it took to fetch the given batch and adapt the batch size"""
+        if not batch:
+            return
+
+        samples = batch[::max(1, len(batch) // self.SIZE_SAMPLES)]
+        record_bytes = sum(utils.approx_size(record) for record in samples) / len(samples)
+        duration = max(duration, 1e-6)
+
+        with self._lock:
+            self._throughput = self._average(self._throughput, len(batch) / duration)
+            self._byte_rate = self._average(self._byte_rate, len(batch) * record_bytes / duration)
+            self._record_bytes = self._average(self._record_bytes, record_bytes)
+            self._latency = self._average(self._latency, duration)
+
+            if self.adaptive:
+                # Aim for the target latency but never more than halve or double in one go
+                new_size = self._throughput * self.target_latency
+                new_size = min(new_size, self.max_batch_bytes / self._record_bytes)
+                new_size = max(self._batch_size / 2, min(new_size, self._batch_size * 2))
+                self._batch_size = int(
+                    max(self.min_batch_size, min(round(new_size), self.max_batch_size)))
+
+        logger.debug('Fetched %i records (~%i bytes each) in %.3fs, batch size is now %i',
+                     len(batch), record_bytes, duration, self._batch_size)
+
+    def _average(self, current: Optional[float], new: float) -> float:
+        if current is None:
+            return new
+        return (1. - self.SMOOTHING) * current + self.SMOOTHING * new
+
+
+class RecordPrefetcher(QtCore.QObject):
+    """Drains a record iterator on an executor into a bounded queue of batches.  Batches can then be
+    taken from the GUI thread without doing any I/O.  The prefetcher keeps at most `max_batches`
+    batches ready and only ever has one fetch in flight as iterators are not thread safe."""
+    DEFAULT_MAX_BATCHES = 2
+
+    # Emitted whenever a fetch finishes, i.e. a new batch is ready or the source is exhausted.
+    # This can be emitted from a worker thread.
+    batch_ready = QtCore.Signal()
+
+    def __init__(self,
+                 source: Iterator[mincepy.DataRecord],
+                 batcher: AdaptiveBatcher,
+                 executor=common.default_executor,
+                 max_batches=DEFAULT_MAX_BATCHES,
+                 parent=None):
+        super().__init__(parent)
+        self._source = source
+        self._batcher = batcher
+        self._executor = executor
+        self._max_batches = max_batches
+
+        self._lock = threading.Lock()
+        self._batches = collections.deque()
+        self._fetching = False
+        self._source_exhausted = False
+        self._closed = False
+        self._future = None
+
+        # Top up the queue whenever a fetch finishes, this is a queued connection if the batch was
+        # fetched on another thread so scheduling always happens on the thread we live in
+        self.batch_ready.connect(self._fill)
+
+    @property
+    def exhausted(self) -> bool:
+        """True if the source has been completely drained and all batches have been taken"""
+        with self._lock:
+            return self._closed or (self._source_exhausted and not self._batches)
+
+    @property
+    def num_ready(self) -> int:
+        """The number of batches that are ready to be taken"""
+        with self._lock:
+            return len(self._batches)
+
+    def start(self):
+        """Start prefetching batches"""
+        self._fill()
+
+    def take(self) -> Optional[List[mincepy.DataRecord]]:
+        """Take the next batch of records if one is ready, otherwise return None.  This never
+        blocks."""
+        with self._lock:
+            batch = self._batches.popleft() if self._batches else None
+        self._fill()
+        return batch
+
+    def close(self):
+        """Stop prefetching, discard any batches that have not been taken and close the source (if
+        it can be closed) so that any database cursor it holds is released"""
+        with self._lock:
+            self._closed = True
+            self._batches.clear()
+            fetching = self._fetching
+
+        future, self._future = self._future, None
+        if future is not None and future.cancel():
+            # Never started, so it won't be touching the source
+            fetching = False
+
+        if not fetching:
+            self._close_source()
+        # Otherwise the fetch will close the source once it finishes
+
+    def _close_source(self):
+        close = getattr(self._source, 'close', None)
+        if close is not None:
+            try:
+                close()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Failed to close the record source')
+
+    @QtCore.Slot()
+    def _fill(self):
+        """Schedule the next fetch if there is room in the queue"""
+        with self._lock:
+            if self._closed or self._fetching or self._source_exhausted or \
+                    len(self._batches) >= self._max_batches:
+                return
+            self._fetching = True
+
+        self._future = self._executor(self._fetch_batch, blocking=False)
+
+    def _fetch_batch(self):
+        """Fetch a batch from the source.  Called on the executor."""
+        batch = []
+        exhausted = False
+        start = time.perf_counter()
+        try:
+            for _ in range(self._batcher.batch_size):
+                batch.append(next(self._source))
+        except StopIteration:
+            exhausted = True
+        except Exception:
+            # Don't try to fetch from a broken source again
+            exhausted = True
+            raise
+        finally:
+            self._batcher.measure(batch, time.perf_counter() - start)
+            with self._lock:
+                closed = self._closed
+                if not closed:
+                    if batch:
+                        self._batches.append(batch)
+                    self._source_exhausted = exhausted
+                self._fetching = False
+
+            if closed:
+                self._close_source()
+            else:
+                self.batch_ready.emit()
@@ -0,0 +1,580 @@
+# -*- coding: utf-8 -*-
+"""Module for profiling the queries that are executed and keeping a history of how they performed"""
+import collections
+import json
+import logging
+import threading
+import time
+import typing
+import weakref
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from PySide2 import QtCore, QtWidgets
+import mincepy
+
+from . import common
+from . import query as query_
+from . import sources
+from . import utils
+
+__all__ = ('QueryProfile', 'ProfilingRecordSource', 'profile_source', 'get_first_query', 'explain',
+           'explain_source', 'QueryHistoryModel', 'QueryProfilerDialog')
+
+logger = logging.getLogger(__name__)
+
+# The entries of a MongoDB explanation that are about plans that weren't used
+UNUSED_PLAN_KEYS = 'rejectedPlans', 'allPlansExecution'
+
+
+class QueryProfile:
+    """The measurements made while the results of a query were being delivered.  This is updated
+    from whichever threads the records are fetched on.  Records that are delivered more than once
+    (e.g. paged and then iterated, or reloaded after being evicted) are only counted once.  To spot
+    these the keys of up to MAX_TRACKED_RECORDS records are kept until the profile is complete (after
+    which every record is a repeat) or forget_delivered() is called."""
+    # Every this many records one is sized to estimate the number of bytes transferred
+    SIZE_SAMPLE_INTERVAL = 16
+    # The most records whose keys are kept to spot repeats, records past this are always counted
+    MAX_TRACKED_RECORDS = 100000
+
+    def __init__(self, query: dict, cached=False, clock=time.perf_counter):
+        """
+        :param query: the query that was executed
+        :param cached: True if the results came from the cache rather than the database
+        :param clock: the clock used to time things
+        """
+        self.query = query
+        self.normalised = query_.normalise_query(query)
+        self.shape = query_.query_shape(query)
+        self.cached = cached
+        self.executed = time.time()
+        self._clock = clock
+        self._start = clock()
+        self._lock = threading.Lock()
+
+        self.time_to_first_record = None  # type: Optional[float]
+        self.num_records = 0
+        # The number of records delivered that had already been delivered before
+        self.num_repeated = 0
+        self.fetch_time = 0.
+        self.complete = False
+        self.total_count = None  # type: Optional[int]
+        self._last_delivery = None  # type: Optional[float]
+        self._completed = None  # type: Optional[float]
+        self._sampled_bytes = 0
+        self._num_sampled = 0
+        # The (obj_id, version) of the records delivered so far, None once no longer tracked
+        self._seen = set()  # type: Optional[set]
+
+        # The query (and projection) that fetched the first of the records, this is what gets
+        # explained, if set
+        self.first_query = None  # type: Optional[Tuple[dict, Optional[dict]]]
+        # From the archive, if it can explain queries
+        self.server_time = None  # type: Optional[float]
+        self.plan = None  # type: Optional[str]
+        self.indexes = None  # type: Optional[List[str]]
+        self.explanation = None  # type: Optional[dict]
+
+    @property
+    def records_per_second(self) -> Optional[float]:
+        """The rate that records were delivered at, from when the query was executed to when the
+        last record was delivered"""
+        with self._lock:
+            if self._last_delivery is None:
+                return None
+            return self.num_records / max(self._last_delivery - self._start, 1e-6)
+
+    @property
+    def latency(self) -> Optional[float]:
+        """The time it took to get the first record or, if there were none, to find that out"""
+        if self.time_to_first_record is not None:
+            return self.time_to_first_record
+        if self._completed is not None:
+            return self._completed - self._start
+        return None
+
+    @property
+    def num_results(self) -> Optional[int]:
+        """The total number of results of the query, if known"""
+        if self.total_count is not None:
+            return self.total_count
+        return self.num_records if self.complete else None
+
+    @property
+    def bytes_transferred(self) -> int:
+        """The (approximate) number of bytes of records that have been delivered"""
+        with self._lock:
+            if not self._num_sampled:
+                return 0
+            return int(self._sampled_bytes / self._num_sampled * self.num_records)
+
+    def delivered(self, records: Sequence[mincepy.DataRecord], fetch_time: float):
+        """Note that the given records were delivered having taken 'fetch_time' to get from the
+        source"""
+        now = self._clock()
+        with self._lock:
+            self.fetch_time += fetch_time
+            if not records:
+                return
+
+            if self.time_to_first_record is None:
+                self.time_to_first_record = now - self._start
+            self._last_delivery = now
+            for record in records:
+                if self.complete:
+                    # They have all been delivered already
+                    self.num_repeated += 1
+                    continue
+
+                key = _record_key(record)
+                if key is not None and self._seen is not None:
+                    if key in self._seen:
+                        self.num_repeated += 1
+                        continue
+                    if len(self._seen) < self.MAX_TRACKED_RECORDS:
+                        self._seen.add(key)
+
+                if self.num_records % self.SIZE_SAMPLE_INTERVAL == 0:
+                    self._sampled_bytes += utils.approx_size(record)
+                    self._num_sampled += 1
+                self.num_records += 1
+
+    def set_complete(self):
+        """Note that all of the records have been delivered"""
+        with self._lock:
+            self._completed = self._clock()
+            self.complete = True
+            self._seen = None
+
+    def forget_delivered(self):
+        """Stop keeping track of which records have been delivered, e.g. once the results are no
+        longer being looked at.  Any records delivered after this are counted as new."""
+        with self._lock:
+            self._seen = None
+
+    def set_explanation(self, explanation: dict):
+        """Set the explanation of the query given by the archive"""
+        self.explanation = explanation
+        self.plan, self.indexes, self.server_time = summarise_explanation(explanation)
+
+
+def _record_key(record) -> Optional[tuple]:
+    """Get the key that identifies a delivered record, None if it isn't a record"""
+    if isinstance(record, mincepy.DataRecord):
+        return record.obj_id, record.version
+    return None
+
+
+class ProfilingIterable:
+    """Wraps an iterable of records and profiles them being delivered"""
+
+    def __init__(self, source: Iterable[mincepy.DataRecord], profile: QueryProfile):
+        self._source = source
+        self._profile = profile
+
+    @property
+    def source(self) -> Iterable[mincepy.DataRecord]:
+        """The source being profiled"""
+        return self._source
+
+    @property
+    def profile(self) -> QueryProfile:
+        return self._profile
+
+    def __iter__(self) -> Iterator[mincepy.DataRecord]:
+        iterator = iter(self._source)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    record = next(iterator)
+                except StopIteration:
+                    self._profile.delivered((), time.perf_counter() - start)
+                    self._profile.set_complete()
+                    return
+
+                self._profile.delivered((record,), time.perf_counter() - start)
+                yield record
+        finally:
+            # Make sure the source is closed if we are
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()
+
+
+class ProfilingRecordSource(ProfilingIterable, sources.RecordSource):
+    """Wraps a record source and profiles the records it delivers, whether by iteration or
+    paging"""
+
+    def page(self, skip: int, limit: int) -> List[mincepy.DataRecord]:
+        start = time.perf_counter()
+        records = self._source.page(skip, limit)
+        self._profile.delivered(records, time.perf_counter() - start)
+        return records
+
+    def count(self) -> Optional[int]:
+        count = self._source.count()
+        self._profile.total_count = count
+        return count
+
+    def seek(self, value, limit: int) -> Optional[Tuple[int, List[mincepy.DataRecord]]]:
+        start = time.perf_counter()
+        result = self._source.seek(value, limit)
+        self._profile.delivered(() if result is None else result[1], time.perf_counter() - start)
+        return result
+
+    def removed(self, ranges: Sequence[Tuple[int, int]]):
+        self._source.removed(ranges)
+
+
+def profile_source(source: Iterable[mincepy.DataRecord],
+                   profile: QueryProfile) -> ProfilingIterable:
+    """Wrap the given source so that the records it delivers are profiled.  If it is a record
+    source then so is the returned wrapper."""
+    if isinstance(source, sources.RecordSource):
+        return ProfilingRecordSource(source, profile)
+    return ProfilingIterable(source, profile)
+
+
+def get_first_query(source: Iterable[mincepy.DataRecord]) -> Optional[Tuple[dict, Optional[dict]]]:
+    """Get the query, as passed to historian.records.find(), and the projection dictionary that a
+    source uses to fetch the first of its records.  None is returned if it isn't a query source."""
+    while isinstance(source, (ProfilingIterable, sources.CachingIterable)):
+        source = source.source
+    if not isinstance(source, sources.QueryRecordSource):
+        return None
+
+    return source.first_query()
+
+
+def explain_source(source: Iterable[mincepy.DataRecord],
+                   verbosity='queryPlanner') -> Optional[dict]:
+    """Explain the query that a source uses to fetch the first of its records.  None is returned if
+    it isn't a query source or the query can't be explained (see explain())."""
+    first_query = get_first_query(source)
+    if first_query is None:
+        return None
+
+    query, projection = first_query
+    return explain(source.historian, query, projection=projection, verbosity=verbosity)
+
+
+def explain(historian: mincepy.Historian,
+            query: dict,
+            projection: dict = None,
+            verbosity='queryPlanner') -> Optional[dict]:
+    """Ask the archive to explain how it would execute the given query.  This is only supported by
+    MongoDB archives, for others (or if the server can't explain it) None is returned.  MongoDB
+    archives run finds as aggregation pipelines so this explains the same pipeline, built in the
+    same way as the archive's record collection does.
+
+    :param historian: the historian whose archive to ask
+    :param query: the query, as would be passed to historian.records.find()
+    :param projection: the projection dictionary, if the records are projected
+    :param verbosity: the MongoDB explain verbosity, 'executionStats' runs the query to get the
+        time it takes on the server
+    """
+    collection = getattr(historian.archive, 'data_collection', None)
+    if collection is None:
+        return None
+
+    try:
+        pipeline = _get_find_pipeline(historian, query, projection)
+        return collection.database.command({
+            'explain': {
+                'aggregate': collection.name,
+                'pipeline': pipeline,
+                'allowDiskUse': True,
+                'cursor': {}
+            },
+            'verbosity': verbosity
+        })
+    except Exception:  # pylint: disable=broad-except
+        logger.debug('Unable to explain query: %s', query, exc_info=True)
+        return None
+
+
+def _get_find_pipeline(historian: mincepy.Historian, query: dict, projection: dict = None) -> list:
+    """Get the aggregation pipeline that a MongoDB archive runs for the given query"""
+    from mincepy.mongo import db
+    from mincepy.mongo import queries
+
+    results = historian.records.find(**query)
+    pipeline = []
+    query_filter = results.query.get_filter()
+    if query_filter:
+        pipeline.append({'$match': query_filter})
+    meta = query.get('meta', None)
+    if meta:
+        pipeline.extend(
+            queries.pipeline_match_metadata(meta, historian.archive.META_COLLECTION, db.OBJ_ID))
+    sort = results.query.sort
+    if sort:
+        pipeline.append({'$sort': db.remap(sort if isinstance(sort, dict) else {sort: 1})})
+    if results.query.skip:
+        pipeline.append({'$skip': results.query.skip})
+    if results.query.limit:
+        pipeline.append({'$limit': results.query.limit})
+    if projection:
+        pipeline.append({'$project': db.remap(projection)})
+    return pipeline
+
+
+def summarise_explanation(explanation: dict) -> Tuple[str, List[str], Optional[float]]:
+    """Get a summary of the winning plan (e.g. 'FETCH < IXSCAN'), the names of the indexes it uses
+    and the execution time in seconds (if the query was executed) from an explanation"""
+    stages = []
+    indexes = []
+    millis = []
+
+    def visit(entry):
+        if isinstance(entry, list):
+            for child in entry:
+                visit(child)
+            return
+        if not isinstance(entry, dict):
+            return
+
+        if 'executionTimeMillis' in entry:
+            millis.append(entry['executionTimeMillis'])
+        if 'stage' in entry:
+            stages.append(entry['stage'])
+            if 'indexName' in entry and entry['indexName'] not in indexes:
+                indexes.append(entry['indexName'])
+
+        for key, value in entry.items():
+            if key not in UNUSED_PLAN_KEYS:
+                visit(value)
+
+    visit(explanation)
+    # The same stages can appear in both the query planner and the execution stats
+    plan = []
+    for stage in stages:
+        if stage not in plan:
+            plan.append(stage)
+    server_time = max(millis) / 1000. if millis else None
+    return ' < '.join(plan), indexes, server_time
+
+
+class QueryHistoryModel(QtCore.QAbstractTableModel):
+    """A table of the profiles of the queries that have been executed, newest last.  The raw value
+    of each cell is available using the data role so that it can be sorted."""
+    DEFAULT_MAX_PROFILES = 500
+    # Longer strings are shortened for display, the full string is available as the tool tip
+    MAX_DISPLAY_LENGTH = 200
+
+    COLUMNS = ('Executed', 'Query', 'Shape', 'Cached', 'Records', 'Refetched',
+               'Time to first record (s)', 'Records/s', 'Bytes', 'Fetch time (s)',
+               'Server time (s)', 'Plan', 'Indexes')
+
+    def __init__(self, max_profiles=DEFAULT_MAX_PROFILES, parent=None):
+        super().__init__(parent)
+        self._max_profiles = max_profiles
+        self._profiles = collections.deque()
+
+    @property
+    def profiles(self) -> Sequence[QueryProfile]:
+        return tuple(self._profiles)
+
+    def add_profile(self, profile: QueryProfile):
+        if len(self._profiles) >= self._max_profiles:
+            self.beginRemoveRows(QtCore.QModelIndex(), 0, 0)
+            self._profiles.popleft()
+            self.endRemoveRows()
+
+        row = len(self._profiles)
+        self.beginInsertRows(QtCore.QModelIndex(), row, row)
+        self._profiles.append(profile)
+        self.endInsertRows()
+
+    def get_profile(self, row: int) -> QueryProfile:
+        return self._profiles[row]
+
+    def refresh(self):
+        """Tell views that the profiles may have changed as they are updated as records are
+        delivered"""
+        if self._profiles:
+            self.dataChanged.emit(self.index(0, 0),
+                                  self.index(len(self._profiles) - 1,
+                                             len(self.COLUMNS) - 1))
+
+    def clear(self):
+        self.beginResetModel()
+        self._profiles.clear()
+        self.endResetModel()
+
+    def rowCount(self, parent: QtCore.QModelIndex = QtCore.QModelIndex()) -> int:
+        if parent.isValid():
+            return 0
+        return len(self._profiles)
+
+    def columnCount(self, parent: QtCore.QModelIndex = QtCore.QModelIndex()) -> int:
+        if parent.isValid():
+            return 0
+        return len(self.COLUMNS)
+
+    def headerData(self,
+                   section: int,
+                   orientation: QtCore.Qt.Orientation,
+                   role: int = QtCore.Qt.DisplayRole) -> typing.Any:
+        if orientation == QtCore.Qt.Horizontal and role == QtCore.Qt.DisplayRole:
+            return self.COLUMNS[section]
+        return None
+
+    def data(self, index: QtCore.QModelIndex, role: int = QtCore.Qt.DisplayRole) -> typing.Any:
+        if not index.isValid():
+            return None
+
+        if role == common.DataRole:
+            return self._get_value(self._profiles[index.row()], index.column())
+        if role == QtCore.Qt.DisplayRole:
+            string = self._get_string(self._profiles[index.row()], index.column())
+            if len(string) > self.MAX_DISPLAY_LENGTH:
+                string = string[:self.MAX_DISPLAY_LENGTH - 3] + '...'
+            return string
+        if role == QtCore.Qt.ToolTipRole:
+            return self._get_string(self._profiles[index.row()], index.column())
+
+        return None
+
+    def _get_value(self, profile: QueryProfile, column: int):
+        return (profile.executed, profile.normalised, profile.shape, profile.cached,
+                profile.num_records, profile.num_repeated, profile.time_to_first_record,
+                profile.records_per_second, profile.bytes_transferred, profile.fetch_time,
+                profile.server_time, profile.plan, profile.indexes)[column]
+
+    def _get_string(self, profile: QueryProfile, column: int) -> str:
+        value = self._get_value(profile, column)
+        if value is None:
+            return ''
+        if column == 0:
+            return time.strftime('%H:%M:%S', time.localtime(value))
+        if column == 4 and not profile.complete:
+            return '{}+'.format(value)
+        if isinstance(value, float):
+            return '{:.3g}'.format(value)
+        if isinstance(value, list):
+            return ', '.join(value) if value else 'None'
+        return str(value)
+
+
+class QueryProfilerDialog(QtWidgets.QDialog):
+    """A dialog that shows the history of query profiles.  Selecting a query asks the archive how it
+    would execute it, and it can be explained again with execution statistics."""
+    REFRESH_INTERVAL = 1000  # ms
+
+    # Emitted (possibly from a worker thread) when a profile has been explained
+    _explained = QtCore.Signal(object)
+
+    def __init__(self,
+                 history: QueryHistoryModel,
+                 get_historian,
+                 executor=common.default_executor,
+                 parent=None):
+        """
+        :param history: the history model to show
+        :param get_historian: a callable that gets the current historian (or None)
+        :param executor: the executor to explain queries on
+        """
+        super().__init__(parent)
+        self.setWindowTitle('Query profiler')
+        self._history = history
+        self._get_historian = get_historian
+        self._executor = executor
+        # The profiles being explained, and those that have been
+        self._explaining = weakref.WeakSet()
+        self._explained_profiles = weakref.WeakSet()
+
+        self._proxy = QtCore.QSortFilterProxyModel(self)
+        self._proxy.setSourceModel(history)
+        self._proxy.setSortRole(common.DataRole)
+
+        self._table = QtWidgets.QTableView(self)
+        self._table.setModel(self._proxy)
+        self._table.setSortingEnabled(True)
+        self._table.setSelectionBehavior(QtWidgets.QAbstractItemView.SelectRows)
+        self._table.setSelectionMode(QtWidgets.QAbstractItemView.SingleSelection)
+        self._table.selectionModel().currentRowChanged.connect(self._show_explanation)
+
+        self._explanation = QtWidgets.QPlainTextEdit(self)
+        self._explanation.setReadOnly(True)
+
+        self._explain_button = QtWidgets.QPushButton('Explain with execution stats', self)
+        self._explain_button.clicked.connect(self._explain_current)
+
+        splitter = QtWidgets.QSplitter(QtCore.Qt.Vertical, self)
+        splitter.addWidget(self._table)
+        splitter.addWidget(self._explanation)
+        layout = QtWidgets.QVBoxLayout(self)
+        layout.addWidget(splitter)
+        layout.addWidget(self._explain_button)
+        self.resize(1000, 600)
+
+        # Profiles are updated as records are delivered so keep refreshing while shown
+        self._timer = QtCore.QTimer(self)
+        self._timer.setInterval(self.REFRESH_INTERVAL)
+        self._timer.timeout.connect(history.refresh)
+        self._explained.connect(self._handle_explained)
+
+    def showEvent(self, event):  # pylint: disable=invalid-name
+        self._timer.start()
+        super().showEvent(event)
+
+    def hideEvent(self, event):  # pylint: disable=invalid-name
+        self._timer.stop()
+        super().hideEvent(event)
+
+    def _current_profile(self) -> Optional[QueryProfile]:
+        index = self._proxy.mapToSource(self._table.currentIndex())
+        if not index.isValid():
+            return None
+        return self._history.get_profile(index.row())
+
+    @QtCore.Slot()
+    def _show_explanation(self, *_args):
+        profile = self._current_profile()
+        if profile is None:
+            self._explanation.setPlainText('')
+        elif profile.explanation is not None:
+            self._explanation.setPlainText(json.dumps(profile.explanation, indent=2, default=str))
+        elif profile in self._explaining:
+            self._explanation.setPlainText('Explaining...')
+        elif profile in self._explained_profiles:
+            self._explanation.setPlainText('The archive can\'t explain this query')
+        elif profile.first_query is not None and self._get_historian() is not None:
+            # Queries are only explained once someone wants to see how they were executed
+            self._explanation.setPlainText('Explaining...')
+            self._explain(profile, 'queryPlanner')
+        else:
+            self._explanation.setPlainText('No plan available')
+
+    @QtCore.Slot()
+    def _explain_current(self):
+        profile = self._current_profile()
+        if profile is not None:
+            self._explain(profile, 'executionStats')
+
+    def _explain(self, profile: QueryProfile, verbosity: str):
+        """Explain the query of the given profile on the executor"""
+        historian = self._get_historian()
+        if historian is None:
+            return
+
+        query, projection = profile.first_query or (profile.query, None)
+        self._explaining.add(profile)
+
+        def do_explain():
+            explanation = explain(historian, query, projection=projection, verbosity=verbosity)
+            if explanation is not None:
+                profile.set_explanation(explanation)
+            self._explained.emit(profile)
+
+        self._executor(do_explain, 'Explaining query...', blocking=False)
+
+    @QtCore.Slot(object)
+    def _handle_explained(self, profile: QueryProfile):
+        self._explaining.discard(profile)
+        self._explained_profiles.add(profile)
+        self._history.refresh()
+        if profile is self._current_profile():
+            self._show_explanation()
@@ -1,16 +1,87 @@
+import datetime
 import json
 import logging
 from typing import List, Optional
+import uuid
 
+import bson
 from PySide2 import QtCore, QtGui, QtWidgets
+import mincepy
 
 from . import utils
 
-__all__ = 'QueryView', 'QueryController'
+__all__ = 'QueryView', 'QueryController', 'QueryScheduler', 'normalise_query', 'query_shape'
 
 logger = logging.getLogger(__name__)
 
 
+def normalise_query(query: dict) -> str:
+    """Get a canonical string for a query such that equivalent queries give the same string.  Keys
+    are sorted (except those of the sort criteria, where the order matters), entries that are None
+    are dropped and UUIDs are always written in the same way."""
+    query = {key: value for key, value in query.items() if value is not None}
+    if isinstance(query.get('sort', None), dict):
+        query['sort'] = list(query['sort'].items())
+    if 'obj_id' in query:
+        obj_ids = query['obj_id']
+        if isinstance(obj_ids, (list, tuple)):
+            query['obj_id'] = [_to_uuid(obj_id) for obj_id in obj_ids]
+        else:
+            query['obj_id'] = _to_uuid(obj_ids)
+
+    return json.dumps(_normalise_value(query), sort_keys=True, separators=(',', ':'), default=repr)
+
+
+def query_shape(query: dict) -> str:
+    """Get the shape of a query, i.e. its normalised form with the values replaced by the names of
+    their types.  Queries with the same shape would need the same indexes to be fast."""
+    query = {key: value for key, value in query.items() if value is not None}
+    sort = query.pop('sort', None)
+    shape = _get_shape(query)
+    if isinstance(sort, dict):
+        # The direction matters to whether an index can be used so keep it
+        shape['sort'] = list(sort.items())
+
+    return json.dumps(shape, sort_keys=True, separators=(',', ':'))
+
+
+def _get_shape(value):
+    if isinstance(value, dict):
+        return {str(key): _get_shape(entry) for key, entry in value.items()}
+    if isinstance(value, (list, tuple)):
+        # Only the distinct shapes matter, not how many entries there are
+        shapes = []
+        for entry in map(_get_shape, value):
+            if entry not in shapes:
+                shapes.append(entry)
+        return shapes
+    return '<{}>'.format(type(value).__name__)
+
+
+def _to_uuid(obj_id):
+    """Object ids given as strings are often UUIDs, if so convert them so they are normalised"""
+    if isinstance(obj_id, str):
+        try:
+            return uuid.UUID(obj_id)
+        except ValueError:
+            pass
+    return obj_id
+
+
+def _normalise_value(value):
+    if isinstance(value, dict):
+        return {str(key): _normalise_value(entry) for key, entry in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalise_value(entry) for entry in value]
+    if isinstance(value, uuid.UUID):
+        return {'$uuid': str(value)}
+    if isinstance(value, bson.ObjectId):
+        return {'$oid': str(value)}
+    if isinstance(value, datetime.datetime):
+        return {'$date': value.isoformat()}
+    return value
+
+
 class QueryView(QtCore.QObject):
     """Read-only view on the query model"""
     # Signals
@@ -89,6 +160,63 @@ class QueryModel(QueryView):
         self.set_query(new_query)
 
 
+class QueryScheduler(QtCore.QObject):
+    """Sits between the query model and query execution.  Changes to the query that happen within a
+    short window of each other are coalesced into a single execution request, and no request is
+    made at all if the (normalised) query is the same as the one last executed."""
+    DEFAULT_DELAY = 50  # ms
+
+    # Emitted with the query when it should be executed
+    execute_requested = QtCore.Signal(dict)
+
+    def __init__(self, query_model: QueryView, delay=DEFAULT_DELAY, parent=None):
+        """
+        :param query_model: the query model to watch for changes
+        :param delay: the time (in milliseconds) to wait, after the first change, for further
+            changes before requesting execution
+        :param parent: the parent object
+        """
+        super().__init__(parent)
+        self._query_model = query_model
+        self._last_executed = None  # type: Optional[str]
+
+        self._timer = QtCore.QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(delay)
+        self._timer.timeout.connect(self.flush)
+
+        self._query_model.query_changed.connect(self.schedule)
+
+    @property
+    def pending(self) -> bool:
+        """True if there are changes that have not been flushed yet"""
+        return self._timer.isActive()
+
+    @QtCore.Slot()
+    def schedule(self, *_args):
+        """Request that the current query be executed once the window has passed"""
+        if not self._timer.isActive():
+            self._timer.start()
+
+    @QtCore.Slot()
+    def flush(self):
+        """Request execution of the current query now, if it has changed since last executed"""
+        self._timer.stop()
+        query = self._query_model.get_query()
+        normalised = normalise_query(query)
+        if normalised == self._last_executed:
+            logger.debug('Skipping execution of unchanged query: %s', normalised)
+            return
+
+        self._last_executed = normalised
+        self.execute_requested.emit(query)
+
+    def mark_executed(self, query: Optional[dict]):
+        """Tell the scheduler that the given query has been executed (or that results matching it
+        are already being shown).  Passing None means that nothing has been executed."""
+        self._last_executed = None if query is None else normalise_query(query)
+
+
 class QueryController(QtCore.QObject):
     """Controller for the query model"""
 
@@ -107,6 +235,8 @@ class QueryController(QtCore.QObject):
         self._query_model = query_model
         self._query_line = query_line
         self._obj_ids_line = obj_id_line
+        # The query is re-encoded on every keystroke so use a codec that remembers the last one
+        self._codec = utils.QueryCodec()
 
         # Initialise everything
         # Query model
@@ -117,6 +247,21 @@ class QueryController(QtCore.QObject):
         self._query_line.textEdited.connect(self._handle_text_edited)
         self._query_line.setText(self._query_to_str(self._query_model.get_query()))
 
+        # Recall of previous queries
+        self._recent_queries = QtCore.QStringListModel(self)
+        self._completer = QtWidgets.QCompleter(self._recent_queries, self)
+        self._completer.setWidget(self._query_line)
+        self._completer.setCaseSensitivity(QtCore.Qt.CaseInsensitive)
+        self._completer.setFilterMode(QtCore.Qt.MatchContains)
+        self._completer.activated[str].connect(self._handle_query_recalled)
+
+        # Completion of the paths in the query
+        self._paths = QtCore.QStringListModel(self)
+        self._path_completer = QtWidgets.QCompleter(self._paths, self)
+        self._path_completer.setWidget(self._query_line)
+        self._path_completer.setCaseSensitivity(QtCore.Qt.CaseInsensitive)
+        self._path_completer.activated[str].connect(self._handle_path_completed)
+
         # Object IDs line
         self._obj_ids_line.returnPressed.connect(self._handle_obj_id_pressed)
 
@@ -141,9 +286,26 @@ class QueryController(QtCore.QObject):
         """Update the query dictionary"""
         self._query_model.update_query(update)
 
-    @staticmethod
-    def _query_to_str(query: dict) -> str:
-        return json.dumps(query, cls=utils.UUIDEncoder)
+    def set_recent_queries(self, texts: List[str]):
+        """Set the texts of the queries that can be recalled in the query line, most relevant
+        first"""
+        self._recent_queries.setStringList(texts)
+
+    def set_completion_paths(self, paths: List[str]):
+        """Set the state paths (e.g. 'state.colour') that can be completed in the query line, most
+        relevant first.  Paths relative to the state can be completed too for use in the state
+        criterion."""
+        relative = [path[len(mincepy.STATE) + 1:] for path in paths]
+        self._paths.setStringList(list(paths) + relative)
+
+    def show_recent_queries(self):
+        """Drop down the list of queries that can be recalled"""
+        self._query_line.setFocus()
+        self._completer.setCompletionPrefix('')
+        self._completer.complete()
+
+    def _query_to_str(self, query: dict) -> str:
+        return self._codec.encode(query)
 
     def _set_query_edited(self):
         """Called when the query is being edited but has not yet been submitted"""
@@ -172,15 +334,60 @@ class QueryController(QtCore.QObject):
     def _handle_query_submitted(self, *_args):
         new_text = self._query_line.text()
         try:
-            query = json.loads(new_text, cls=utils.UUIDDecoder)
+            query = self._codec.decode(new_text)
         except json.decoder.JSONDecodeError as exc:
             QtWidgets.QErrorMessage().showMessage(str(exc))
         else:
             self._query_model.set_query(query)
 
+    def _handle_query_recalled(self, text: str):
+        self._query_line.setText(text)
+        self._handle_query_submitted()
+
+    def _get_key_start(self) -> Optional[int]:
+        """If the cursor is in a (JSON) key of the query get the position the key starts at"""
+        text = self._query_line.text()[:self._query_line.cursorPosition()]
+        if text.count('"') % 2 == 0:
+            # Not in a string
+            return None
+
+        start = text.rfind('"') + 1
+        preceding = text[:start - 1].rstrip()
+        if not preceding or preceding[-1] not in '{,':
+            # A value rather than a key
+            return None
+
+        return start
+
+    def _complete_path(self):
+        start = self._get_key_start()
+        prefix = None if start is None else \
+            self._query_line.text()[start:self._query_line.cursorPosition()]
+        if not prefix:
+            self._path_completer.popup().hide()
+            return
+
+        self._path_completer.setCompletionPrefix(prefix)
+        if self._path_completer.completionCount():
+            self._path_completer.complete()
+        else:
+            self._path_completer.popup().hide()
+
+    def _handle_path_completed(self, path: str):
+        start = self._get_key_start()
+        if start is None:
+            return
+
+        text = self._query_line.text()
+        end = self._query_line.cursorPosition()
+        self._query_line.setText(text[:start] + path + text[end:])
+        self._query_line.setCursorPosition(start + len(path))
+        self._set_query_edited()
+
     def _handle_text_edited(self, _text):
+        self._complete_path()
         try:
-            current_query = json.dumps(self._query_model.get_query(), cls=utils.UUIDEncoder)
+            current_query = self._query_to_str(self._query_model.get_query())
         except json.decoder.JSONDecodeError:
             pass
         else:
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""Module for storing the records shown in the entries table"""
+import bisect
+from typing import Callable, Iterator, List, Optional, Sequence, Tuple
+
+import mincepy
+
+__all__ = ('RecordStore',)
+
+
+class RecordStore:
+    """A sparse, ordered store of records.  Only some rows need to be resident in memory, the rest
+    can be evicted and later put back using set_range().  Asking for a row that is not resident
+    gives None."""
+
+    def __init__(self):
+        self._length = 0
+        self._records = {}  # Row -> record
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __getitem__(self, row: int) -> Optional[mincepy.DataRecord]:
+        if row < 0 or row >= self._length:
+            raise IndexError(row)
+        return self._records.get(row, None)
+
+    def __iter__(self) -> Iterator[Optional[mincepy.DataRecord]]:
+        for row in range(self._length):
+            yield self._records.get(row, None)
+
+    @property
+    def num_resident(self) -> int:
+        """The number of records currently held in memory"""
+        return len(self._records)
+
+    def is_resident(self, row: int) -> bool:
+        return row in self._records
+
+    def resident_rows(self) -> List[int]:
+        """Get the rows that are resident, in order"""
+        return sorted(self._records)
+
+    def clear(self):
+        self._length = 0
+        self._records = {}
+
+    def resize(self, length: int):
+        """Change the number of rows in the store.  New rows are not resident."""
+        if length < self._length:
+            self._records = {row: record for row, record in self._records.items() if row < length}
+        self._length = length
+
+    def extend(self, records: Sequence[mincepy.DataRecord]):
+        """Append records to the end of the store"""
+        self.set_range(self._length, records)
+
+    def set_range(self, start: int, records: Sequence[mincepy.DataRecord]):
+        """Put the given records into the store starting at the given row, growing it if needed"""
+        for row, record in enumerate(records, start):
+            self._records[row] = record
+        self._length = max(self._length, start + len(records))
+
+    def remove(self, start: int, count: int):
+        """Remove 'count' rows starting at 'start', rows after these are shifted down"""
+        self.remove_ranges([(start, start + count)])
+
+    def remove_ranges(self, ranges: Sequence[Tuple[int, int]]) -> int:
+        """Remove the rows in the given [start, end) ranges, which must not overlap, in one go.  The
+        remaining rows are shifted down.  Returns the number of rows removed."""
+        ranges = sorted((start, min(end, self._length)) for start, end in ranges)
+        ranges = [(start, end) for start, end in ranges if end > start]
+        if not ranges:
+            return 0
+
+        starts = [start for start, _ in ranges]
+        # The number of rows removed up to the end of each range
+        removed_by = []
+        total = 0
+        for start, end in ranges:
+            total += end - start
+            removed_by.append(total)
+
+        records = {}
+        for row, record in self._records.items():
+            idx = bisect.bisect_right(starts, row) - 1
+            if idx < 0:
+                records[row] = record
+            elif row >= ranges[idx][1]:
+                records[row - removed_by[idx]] = record
+        self._records = records
+        self._length -= total
+        return total
+
+    def reorder(self, order: Sequence[int]):
+        """Reorder the rows so that the new row i is the old row order[i]"""
+        records = self._records
+        self._records = {new: records[old] for new, old in enumerate(order) if old in records}
+
+    def evict_outside(self, start: int, end: int) -> List[int]:
+        """Evict all the records that are not in the range [start, end).  Returns the rows that
+        were evicted"""
+        to_evict = [row for row in self._records if row < start or row >= end]
+        for row in to_evict:
+            del self._records[row]
+        return to_evict
+
+    def evict_matching(self, predicate: Callable[[mincepy.DataRecord], bool]) -> int:
+        """Evict all the records that match the predicate.  Returns the number of records evicted"""
+        to_evict = [row for row, record in self._records.items() if predicate(record)]
+        for row in to_evict:
+            del self._records[row]
+        return len(to_evict)
+
+    def missing(self, start: int, end: int) -> List[Tuple[int, int]]:
+        """Get a list of the [start, end) ranges of rows within [start, end) that are not
+        resident"""
+        ranges = []
+        run_start = None
+        for row in range(max(start, 0), min(end, self._length)):
+            if row in self._records:
+                if run_start is not None:
+                    ranges.append((run_start, row))
+                    run_start = None
+            elif run_start is None:
+                run_start = row
+
+        if run_start is not None:
+            ranges.append((run_start, min(end, self._length)))
+
+        return ranges
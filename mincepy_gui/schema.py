@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""Module for discovering the schema, i.e. the state paths and their types, of the objects in a
+database by sampling records"""
+import collections
+import functools
+import logging
+import random
+import threading
+from typing import Dict, FrozenSet, Hashable, Iterable, List, Optional, Tuple
+
+from PySide2 import QtCore
+import mincepy
+
+from . import common
+
+__all__ = 'SchemaIndex', 'SchemaSampler'
+
+logger = logging.getLogger(__name__)
+
+# The names of the types whose values MongoDB compares with each other, and what they're compared as
+_COMPARED_AS = {'int': 'number', 'float': 'number'}
+
+
+class _TypeSchema:
+    """The paths (and their types) seen in the sampled records of one type"""
+    __slots__ = 'num_sampled', 'counts', 'types'
+
+    def __init__(self):
+        self.num_sampled = 0.
+        self.counts = collections.Counter()  # Path -> number of records that have it
+        self.types = collections.defaultdict(collections.Counter)  # Path -> type name -> count
+
+
+class SchemaIndex:
+    """An index of the state paths (e.g. 'state.colour') found in records, per type, along with
+    how frequently they appear and the types of their values.  Counts are weighted so that older
+    samples can be decayed as new ones are added.  This is thread safe."""
+    # How deep into nested dictionaries to go
+    MAX_DEPTH = 4
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._schemas = {}  # type: Dict[Hashable, _TypeSchema]
+
+    def type_ids(self) -> List[Hashable]:
+        with self._lock:
+            return list(self._schemas)
+
+    def num_sampled(self, type_id=None) -> float:
+        """The (weighted) number of records sampled of the given type, or of all types if None"""
+        with self._lock:
+            return sum(schema.num_sampled for schema in self._get_schemas(type_id))
+
+    def add(self, type_id, records: Iterable[mincepy.DataRecord]):
+        """Add the paths found in the state of the given records, which should be of the given
+        type"""
+        with self._lock:
+            schema = self._schemas.setdefault(type_id, _TypeSchema())
+            for record in records:
+                schema.num_sampled += 1
+                found = {}
+                if isinstance(record.state, dict):
+                    self._find_paths(mincepy.STATE, record.state, found, self.MAX_DEPTH)
+                for path, type_names in found.items():
+                    schema.counts[path] += 1
+                    schema.types[path].update(type_names)
+
+    def decay(self, type_id, factor: float):
+        """Scale down the weight of what has been sampled so far for the given type"""
+        with self._lock:
+            schema = self._schemas.get(type_id, None)
+            if schema is None:
+                return
+
+            schema.num_sampled *= factor
+            for path in schema.counts:
+                schema.counts[path] *= factor
+                for type_name in schema.types[path]:
+                    schema.types[path][type_name] *= factor
+
+    def path_sets(self) -> Dict[Hashable, FrozenSet[str]]:
+        """Get the set of paths seen so far for each type"""
+        with self._lock:
+            return {type_id: frozenset(schema.counts) for type_id, schema in self._schemas.items()}
+
+    def get_paths(self, type_id=None) -> List[Tuple[str, float]]:
+        """Get the paths of the given type (or list of types, or all types if None) along with the
+        fraction of records that have them, most frequent first"""
+        with self._lock:
+            schemas = self._get_schemas(type_id)
+            num_sampled = sum(schema.num_sampled for schema in schemas)
+            if not num_sampled:
+                return []
+
+            counts = collections.Counter()
+            for schema in schemas:
+                counts.update(schema.counts)
+
+        paths = [(path, count / num_sampled) for path, count in counts.items()]
+        paths.sort(key=lambda entry: (-entry[1], entry[0]))
+        return paths
+
+    def get_types(self, path: str, type_id=None) -> Dict[str, float]:
+        """Get the names of the types of the values found at the given path along with the
+        fraction of values that are of that type"""
+        with self._lock:
+            types = collections.Counter()
+            for schema in self._get_schemas(type_id):
+                types.update(schema.types.get(path, {}))
+
+        total = sum(types.values())
+        return {type_name: count / total for type_name, count in types.items()} if total else {}
+
+    def is_single_type(self, path: str, type_id=None) -> bool:
+        """True if the values found at the given path, ignoring any that are None, are all of one
+        type as far as MongoDB's ordering goes (so integers and floats count as one).  False if
+        there are several or the path hasn't been seen."""
+        kinds = {
+            _COMPARED_AS.get(type_name, type_name)
+            for type_name in self.get_types(path, type_id)
+            if type_name != 'NoneType'
+        }
+        return len(kinds) == 1
+
+    def _get_schemas(self, type_id) -> List[_TypeSchema]:
+        if type_id is None:
+            return list(self._schemas.values())
+        type_ids = type_id if isinstance(type_id, (list, tuple)) else (type_id,)
+        try:
+            return [self._schemas[entry] for entry in type_ids if entry in self._schemas]
+        except TypeError:
+            # Unhashable, so not a type id that we know of
+            return []
+
+    def _find_paths(self, prefix: str, state: dict, found: dict, depth: int):
+        """Find the paths in a state dictionary putting them, and the names of the types of their
+        values, into 'found'"""
+        for key, value in state.items():
+            path = '{}.{}'.format(prefix, key)
+            found.setdefault(path, set()).add(type(value).__name__)
+            if depth <= 1:
+                continue
+
+            if isinstance(value, dict):
+                self._find_paths(path, value, found, depth - 1)
+            elif isinstance(value, list):
+                # Like MongoDB, paths go through lists to the dictionaries that they contain
+                for entry in value:
+                    if isinstance(entry, dict):
+                        self._find_paths(path, entry, found, depth - 1)
+
+
+class SchemaSampler(QtCore.QObject):
+    """Builds a schema index from a bounded random sample of the records of each type in the
+    database.  Sampling is done in rounds on the executor: each round adds a batch of records per
+    type and, once the maximum number of samples is reached, decays the older samples to make room,
+    so the index is refreshed incrementally and never grows beyond a fixed size."""
+    DEFAULT_SAMPLE_SIZE = 200
+    DEFAULT_MAX_SAMPLES = 1000
+    DEFAULT_REFRESH_INTERVAL = 60 * 1000  # ms
+    # The number of random places that the records of each round are taken from, for archives that
+    # can't sample for us
+    NUM_CHUNKS = 4
+
+    # Emitted when the index has been updated, this can be from a worker thread
+    updated = QtCore.Signal()
+
+    def __init__(self,
+                 executor=common.default_executor,
+                 sample_size=DEFAULT_SAMPLE_SIZE,
+                 max_samples=DEFAULT_MAX_SAMPLES,
+                 refresh_interval=DEFAULT_REFRESH_INTERVAL,
+                 parent=None):
+        """
+        :param executor: the executor to sample on
+        :param sample_size: the number of records of each type to sample per round
+        :param max_samples: the maximum number of records of each type in the index
+        :param refresh_interval: the time between rounds in milliseconds
+        """
+        super().__init__(parent)
+        self._executor = executor
+        self._sample_size = sample_size
+        self._max_samples = max_samples
+        self._random = random.Random()
+
+        self._index = SchemaIndex()
+        self._historian = None  # type: Optional[mincepy.Historian]
+        # Incremented each time the historian changes so that stale rounds stop
+        self._generation = 0
+        self._sampling = None
+
+        self._timer = QtCore.QTimer(self)
+        self._timer.setInterval(refresh_interval)
+        self._timer.timeout.connect(self.refresh)
+
+    @property
+    def index(self) -> SchemaIndex:
+        return self._index
+
+    def set_historian(self, historian: Optional[mincepy.Historian]):
+        """Start sampling the given historian, discarding the index of any previous one"""
+        self._generation += 1
+        self._historian = historian
+        self._index = SchemaIndex()
+        self._sampling = None
+        self._timer.stop()
+        if historian is not None:
+            self.refresh()
+            self._timer.start()
+
+    @QtCore.Slot()
+    def refresh(self):
+        """Start a round of sampling, unless one is already running"""
+        if self._historian is None or (self._sampling is not None and not self._sampling.done()):
+            return
+
+        self._sampling = self._executor(functools.partial(self._sample, self._generation,
+                                                          self._historian, self._index),
+                                        blocking=False)
+
+    def _sample(self, generation: int, historian: mincepy.Historian, index: SchemaIndex):
+        """Do one round of sampling, emitting updated if any paths appeared.  Called on the
+        executor."""
+        paths_before = index.path_sets()
+        for type_id in historian.records.distinct(mincepy.TYPE_ID):
+            if generation != self._generation:
+                return
+
+            records = self._sample_type(historian, type_id)
+            # Make room for the new samples, if needed, by decaying the old ones
+            num_sampled = index.num_sampled(type_id)
+            if records and num_sampled + len(records) > self._max_samples:
+                index.decay(type_id, max(self._max_samples - len(records), 0) / num_sampled)
+            index.add(type_id, records)
+
+        logger.debug('Sampled the schema of %i types', len(index.type_ids()))
+        # Only the frequencies changed otherwise, which isn't worth rebuilding suggestions for
+        if index.path_sets() != paths_before:
+            self.updated.emit()
+
+    def _sample_type(self, historian: mincepy.Historian, type_id) -> List[mincepy.DataRecord]:
+        """Get a random sample of the records of the given type"""
+        collection = getattr(historian.archive, 'data_collection', None)
+        if collection is not None:
+            # Let MongoDB pick the sample in a single query
+            from mincepy.mongo import db
+            pipeline = [{'$match': {db.TYPE_ID: type_id}}, {'$sample': {'size': self._sample_size}}]
+            return [db.to_record(entry) for entry in collection.aggregate(pipeline)]
+
+        count = historian.records.find(obj_type=type_id).count()
+        if count <= self._sample_size:
+            return list(historian.records.find(obj_type=type_id))
+
+        # Take whole chunks, at random, so that none of them overlap
+        chunk_size = max(self._sample_size // self.NUM_CHUNKS, 1)
+        num_chunks = count // chunk_size
+        chunks = self._random.sample(range(num_chunks), min(self.NUM_CHUNKS, num_chunks))
+        records = []
+        for chunk in sorted(chunks):
+            records.extend(
+                historian.records.find(obj_type=type_id, skip=chunk * chunk_size, limit=chunk_size))
+        return records
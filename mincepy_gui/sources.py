@@ -0,0 +1,818 @@
+# -*- coding: utf-8 -*-
+"""Module containing sources of records that can be shown in the entries table"""
+from abc import ABCMeta, abstractmethod
+import bisect
+from concurrent import futures
+import functools
+import heapq
+import itertools
+import threading
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+import mincepy
+from mincepy import expr
+from pytray import tree
+
+from . import utils
+
+__all__ = ('RecordSource', 'QueryRecordSource', 'KeysetRecordSource', 'ListRecordSource',
+           'CachingIterable', 'CachingRecordSource', 'ObjIdLookupSource', 'ObjIdListSource',
+           'PartialRecord')
+
+# The record fields that are always fetched, even when projecting, so that records can be identified
+# and the full record (or object) loaded later
+IDENTITY_FIELDS = mincepy.OBJ_ID, mincepy.VERSION, mincepy.TYPE_ID
+
+
+class PartialRecord(mincepy.DataRecord):
+    """A data record that only contains some of the fields of the record in the archive.  Fields
+    that were not fetched are None."""
+    __slots__ = ()
+
+    @classmethod
+    def from_dict(cls, record_dict: dict) -> 'PartialRecord':
+        values = dict.fromkeys(mincepy.DataRecord._fields)
+        values.update(record_dict)
+        return cls(**values)
+
+
+def load_full_record(historian: mincepy.Historian,
+                     record: mincepy.DataRecord) -> Optional[mincepy.DataRecord]:
+    """Given a record that may be partial, get the full record from the archive"""
+    if not isinstance(record, PartialRecord):
+        return record
+
+    return historian.records.find(obj_id=record.obj_id, version=record.version).one()
+
+
+def load_full_records(historian: mincepy.Historian,
+                      records: Sequence[mincepy.DataRecord]) -> List[Optional[mincepy.DataRecord]]:
+    """Given records that may be partial, get the full records from the archive.  The partial ones
+    are looked up with one query, apart from any whose version is no longer the latest."""
+    obj_ids = list({record.obj_id for record in records if isinstance(record, PartialRecord)})
+    if not obj_ids:
+        return list(records)
+
+    found = {
+        (record.obj_id, record.version): record for record in historian.records.find(obj_id=obj_ids)
+    }
+    return [
+        found.get((record.obj_id, record.version), None) or load_full_record(historian, record)
+        if isinstance(record, PartialRecord) else record for record in records
+    ]
+
+
+def is_always_fetched(path: str) -> bool:
+    """Returns True if the given dotted record path is always fetched, even when projecting"""
+    return any(path == field or path.startswith(field + '.') for field in IDENTITY_FIELDS)
+
+
+def get_projection(paths: Iterable[str]) -> dict:
+    """Given the dotted record paths that are needed, get a projection dictionary that includes
+    these and the identity fields"""
+    paths = sorted(set(paths).union(IDENTITY_FIELDS))
+    projection = {}
+    for path in paths:
+        # Skip paths that are already included because a parent path is
+        if not any(path.startswith(included + '.') for included in projection):
+            projection[path] = 1
+    return projection
+
+
+class RecordSource(metaclass=ABCMeta):
+    """A source of records.  As well as being iterable from the start, a source can fetch an
+    arbitrary page of records which means that the records don't have to be kept in memory once
+    loaded."""
+
+    @abstractmethod
+    def __iter__(self) -> Iterator[mincepy.DataRecord]:
+        """Iterate over all the records from the start"""
+
+    @abstractmethod
+    def page(self, skip: int, limit: int) -> List[mincepy.DataRecord]:
+        """Get (up to) 'limit' records starting at position 'skip'"""
+
+    def count(self) -> Optional[int]:  # pylint: disable=no-self-use
+        """Get the total number of records, or None if this isn't known"""
+        return None
+
+    def seek(self, value, limit: int) -> Optional[Tuple[int, List[mincepy.DataRecord]]]:
+        # pylint: disable=no-self-use, unused-argument
+        """Find the first record whose sort key value comes at, or after, the given value in the
+        sort order.  Returns the position of that record along with (up to) 'limit' records
+        starting from it, or None if this source can't seek."""
+        return None
+
+    def removed(self, ranges: Sequence[Tuple[int, int]]):
+        """Called when the records at the given, sorted, [start, end) ranges of positions have been
+        removed from the source (e.g. deleted) so that any positions that are remembered can be
+        brought up to date"""
+
+
+class QueryRecordSource(RecordSource):
+    """A record source that gets records by running a query on the historian.
+
+    Optionally, a projection can be given in which case only the paths returned by it (e.g.
+    'state.colour'), along with the identity fields, are fetched and PartialRecords are produced.
+    State entries that aren't asked for are left out so users of the records that want to know what
+    the state contains should look at a sample of full records (e.g. schema.SchemaIndex)."""
+
+    def __init__(self,
+                 historian: mincepy.Historian,
+                 query: dict,
+                 projection: Optional[Callable[[], Iterable[str]]] = None):
+        """
+        :param historian: the historian to query
+        :param query: the query dictionary that will be passed to historian.records.find()
+        :param projection: an optional callable that returns the record paths to fetch.  It is
+            called each time records are fetched so the paths can change.
+        """
+        self._historian = historian
+        self._query = query
+        self._projection = projection
+
+    @property
+    def historian(self) -> mincepy.Historian:
+        return self._historian
+
+    @property
+    def query(self) -> dict:
+        return self._query
+
+    def __iter__(self) -> Iterator[mincepy.DataRecord]:
+        yield from self._find(0, None)
+
+    def page(self, skip: int, limit: int) -> List[mincepy.DataRecord]:
+        return list(self._find(skip, limit))
+
+    def count(self) -> int:
+        query = self._query.copy()
+        skip = query.pop('skip', None) or 0
+        limit = query.pop('limit', None)
+        query.pop('sort', None)
+
+        total = max(self._historian.records.find(**query).count() - skip, 0)
+        return total if limit is None else min(total, limit)
+
+    def first_query(self) -> Tuple[dict, Optional[dict]]:
+        """Get the query, as passed to historian.records.find(), and the projection dictionary (None
+        if not projecting) that are used to fetch the first of the records"""
+        return self._get_find_query(0, None), self._get_projection()
+
+    def _find(self, skip: int,
+              limit: Optional[int]) -> Iterator[Union[mincepy.DataRecord, PartialRecord]]:
+        query = self._get_find_query(skip, limit)
+        if self._query.get('limit', None) is not None and query['limit'] <= 0:
+            return iter(())
+
+        return self._run(query)
+
+    def _get_find_query(self, skip: int, limit: Optional[int]) -> dict:
+        query = self._query.copy()
+        # Respect any skip or limit that is part of the query itself
+        query['skip'] = (query.get('skip', None) or 0) + skip
+        if query.get('limit', None) is not None:
+            limit = query['limit'] - skip if limit is None else min(limit, query['limit'] - skip)
+        query['limit'] = limit
+        return query
+
+    def _run(self,
+             query: dict,
+             *filters: expr.Expr,
+             projection: dict = None) -> Iterator[Union[mincepy.DataRecord, PartialRecord]]:
+        """Run the given query (with optional additional filter expressions).  If no projection
+        dictionary is given then the one from the projection callable (if any) is used."""
+        if projection is None:
+            projection = self._get_projection()
+        results = self._historian.records.find(*filters, **query)
+        if projection is None:
+            return iter(results)
+
+        # Go to the archive collection so that we can pass the projection
+        found = results.archive_collection.find(results.query.get_filter(),
+                                                projection=projection,
+                                                meta=query.get('meta', None),
+                                                sort=results.query.sort,
+                                                limit=results.query.limit or 0,
+                                                skip=results.query.skip or 0)
+        return map(PartialRecord.from_dict, found)
+
+    def _get_paths(self) -> Iterable[str]:
+        """Get the record paths to fetch when projecting"""
+        return self._projection()
+
+    def _get_projection(self) -> Optional[dict]:
+        """Get the projection dictionary from the projection callable, None if there isn't one"""
+        if self._projection is None:
+            return None
+        return get_projection(self._get_paths())
+
+
+class KeysetRecordSource(QueryRecordSource):
+    """A query source that pages using the value of the sort key, plus the object id to break ties,
+    of the last record seen (rather than skipping records).  Each page is a separate short query so
+    no server cursor has to be kept alive between pages.  The key of the last record of each page is
+    kept as a bookmark so that a page that follows a bookmark can be fetched without skipping.  For a
+    page further on, the key of the record just before it is found first (fetching nothing else) so
+    that the page itself is fetched by key and bookmarked.
+
+    This needs exactly one sort key, and that no skip or limit is given in the query, otherwise it
+    behaves just like a QueryRecordSource.  In particular, without a sort the records are kept in
+    their natural order and paged by skipping.  Values of the sort key should all be of the same type
+    (or missing) as MongoDB only compares values of the same type, if this isn't known to be the
+    case then keyset paging should be turned off."""
+    DEFAULT_PAGE_SIZE = 256
+
+    def __init__(self,
+                 historian: mincepy.Historian,
+                 query: dict,
+                 projection: Optional[Callable[[], Iterable[str]]] = None,
+                 page_size=DEFAULT_PAGE_SIZE,
+                 keyset=True):
+        """
+        :param page_size: the number of records to fetch per query when iterating
+        :param keyset: if False the records are always paged by skipping
+        """
+        super().__init__(historian, query, projection=projection)
+        self._page_size = page_size
+
+        sort = query.get('sort', None) or {}
+        self._keyset = keyset and len(sort) == 1 and not query.get('skip', None) and \
+            query.get('limit', None) is None
+        self._sort_path, self._direction = next(iter(sort.items()), (None, None))
+
+        self._lock = threading.Lock()
+        # Sorted positions of the records that we have bookmarks for, and their keys
+        self._positions = []  # type: List[int]
+        self._bookmarks = {}  # type: dict
+
+    @property
+    def keyset(self) -> bool:
+        """True if this source is using keyset paging"""
+        return self._keyset
+
+    def __iter__(self) -> Iterator[mincepy.DataRecord]:
+        if not self._keyset:
+            yield from super().__iter__()
+            return
+
+        position = 0
+        key = None
+        while True:
+            records = list(self._find_after(key, 0, self._page_size))
+            self._bookmark(position, records)
+            yield from records
+            if len(records) < self._page_size:
+                return
+
+            position += len(records)
+            key = self._get_key(records[-1])
+
+    def page(self, skip: int, limit: int) -> List[mincepy.DataRecord]:
+        if not self._keyset:
+            return super().page(skip, limit)
+
+        with self._lock:
+            idx = bisect.bisect_left(self._positions, skip)
+            if idx:
+                position = self._positions[idx - 1]
+                key = self._bookmarks[position]
+            else:
+                position, key = -1, None
+
+        distance = skip - position - 1
+        if distance >= self._page_size:
+            # Too far from the bookmark to skip over the records themselves so just find the key of
+            # the one before the page
+            before = list(self._find_after(key, distance - 1, 1, projection=self._key_projection()))
+            if not before:
+                return []
+            self._bookmark(skip - 1, before)
+            key, distance = self._get_key(before[0]), 0
+
+        # Skip over whatever is between the bookmark (if any) and the page we want
+        records = list(self._find_after(key, distance, limit))
+        self._bookmark(skip, records)
+        return records
+
+    def seek(self, value, limit: int) -> Optional[Tuple[int, List[mincepy.DataRecord]]]:
+        if not self._keyset:
+            return None
+
+        before, at_or_after = self._get_seek_exprs(value)
+        query = self._query.copy()
+        query.pop('sort', None)
+        position = self._historian.records.find(*before, **query).count() if before else 0
+        records = list(self._find_matching(at_or_after, 0, limit))
+        self._bookmark(position, records)
+        return position, records
+
+    def removed(self, ranges: Sequence[Tuple[int, int]]):
+        with self._lock:
+            bookmarks = {}
+            for position, key in self._bookmarks.items():
+                shift = 0
+                for start, end in ranges:
+                    if position >= end:
+                        shift += end - start
+                    elif position >= start:
+                        # The bookmarked record itself was removed
+                        break
+                else:
+                    bookmarks[position - shift] = key
+            self._bookmarks = bookmarks
+            self._positions = sorted(bookmarks)
+
+    def first_query(self) -> Tuple[dict, Optional[dict]]:
+        if not self._keyset:
+            return super().first_query()
+
+        return self._get_keyset_query(0, self._page_size), self._get_projection()
+
+    def _find_after(self,
+                    key: Optional[Tuple[Any, Any]],
+                    skip: int,
+                    limit: int,
+                    projection: dict = None) -> Iterator[Union[mincepy.DataRecord, PartialRecord]]:
+        """Find the records after the given key (from the start if None)"""
+        return self._find_matching(None if key is None else self._get_after_expr(*key),
+                                   skip,
+                                   limit,
+                                   projection=projection)
+
+    def _find_matching(self,
+                       filter_expr: Optional[expr.Expr],
+                       skip: int,
+                       limit: int,
+                       projection: dict = None
+                      ) -> Iterator[Union[mincepy.DataRecord, PartialRecord]]:
+        """Find the records that match the filter expression in the keyset order"""
+        query = self._get_keyset_query(skip, limit)
+        if filter_expr is None:
+            return self._run(query, projection=projection)
+
+        return self._run(query, filter_expr, projection=projection)
+
+    def _get_keyset_query(self, skip: int, limit: int) -> dict:
+        """Get the query that finds records in the keyset order"""
+        query = self._query.copy()
+        query['sort'] = {self._sort_path: self._direction}
+        if self._sort_path != mincepy.OBJ_ID:
+            query['sort'][mincepy.OBJ_ID] = mincepy.ASCENDING
+        query['skip'] = skip
+        query['limit'] = limit
+        return query
+
+    def _key_projection(self) -> dict:
+        """Get the projection that fetches just what is needed to get the key of a record"""
+        return dict.fromkeys(IDENTITY_FIELDS + (self._sort_path,), 1)
+
+    def _get_seek_exprs(self, value) -> Tuple[List[expr.Expr], Optional[expr.Expr]]:
+        """Get the expressions that match the records that come before the given value (as a list,
+        empty if there are none) and those that come at or after it (None if that is all)"""
+        path = self._sort_path
+        is_null = expr.Comparison(path, expr.Eq(None))
+        not_null = expr.Comparison(path, expr.Ne(None))
+        if self._direction == mincepy.ASCENDING:
+            if value is None:
+                return [], None
+            return [expr.Or([expr.Comparison(path, expr.Lt(value)), is_null])], \
+                expr.Comparison(path, expr.Gte(value))
+
+        if value is None:
+            return [not_null], is_null
+        return [expr.Comparison(path, expr.Gt(value))], \
+            expr.Or([expr.Comparison(path, expr.Lte(value)), is_null])
+
+    def _get_after_expr(self, value, obj_id) -> expr.Expr:
+        """Get the expression that matches all records that come after the given key"""
+        after_obj_id = expr.Comparison(mincepy.OBJ_ID, expr.Gt(obj_id))
+        if self._sort_path == mincepy.OBJ_ID:
+            return after_obj_id
+
+        ascending = self._direction == mincepy.ASCENDING
+        same_value = expr.And([expr.Comparison(self._sort_path, expr.Eq(value)), after_obj_id])
+        if value is None:
+            # Nulls (and missing values) come first when ascending and last when descending
+            if ascending:
+                return expr.Or([same_value, expr.Comparison(self._sort_path, expr.Ne(None))])
+            return same_value
+
+        later = expr.Comparison(self._sort_path, expr.Gt(value) if ascending else expr.Lt(value))
+        if ascending:
+            return expr.Or([later, same_value])
+        return expr.Or([later, same_value, expr.Comparison(self._sort_path, expr.Eq(None))])
+
+    def _get_key(self, record: mincepy.DataRecord) -> Tuple[Any, Any]:
+        return _get_path_value(record, self._sort_path), record.obj_id
+
+    def _bookmark(self, start: int, records: Sequence[mincepy.DataRecord]):
+        """Keep the key of the last of the records (which start at the given position)"""
+        if not records:
+            return
+
+        position = start + len(records) - 1
+        key = self._get_key(records[-1])
+        with self._lock:
+            if position not in self._bookmarks:
+                bisect.insort(self._positions, position)
+            self._bookmarks[position] = key
+
+    def _get_paths(self) -> Iterable[str]:
+        paths = list(super()._get_paths())
+        if self._keyset:
+            # Always need the sort key so that we can bookmark
+            paths.append(self._sort_path)
+        return paths
+
+
+class ObjIdListSource(QueryRecordSource):
+    """A source of the records of a list of objects, in the order the object ids are given.  Each
+    page is looked up with one query on the ids it contains, so this suits lists that are in an order
+    the archive can't produce (e.g. results sorted locally).  Objects that no longer exist are left
+    out."""
+
+    def __init__(self,
+                 historian: mincepy.Historian,
+                 obj_ids: Iterable,
+                 projection: Optional[Callable[[], Iterable[str]]] = None):
+        """
+        :param obj_ids: the ids of the objects in the order their records should be given
+        """
+        self._obj_ids = list(obj_ids)
+        super().__init__(historian, {'obj_id': self._obj_ids}, projection=projection)
+        self._lock = threading.Lock()
+
+    def __iter__(self) -> Iterator[mincepy.DataRecord]:
+        yield from self.page(0, len(self._obj_ids))
+
+    def page(self, skip: int, limit: int) -> List[mincepy.DataRecord]:
+        with self._lock:
+            obj_ids = self._obj_ids[skip:skip + limit]
+        if not obj_ids:
+            return []
+
+        found = {record.obj_id: record for record in self._run({'obj_id': obj_ids})}
+        return [found[obj_id] for obj_id in obj_ids if obj_id in found]
+
+    def count(self) -> int:
+        with self._lock:
+            obj_ids = list(self._obj_ids)
+        return self._historian.records.find(obj_id=obj_ids).count()
+
+    def removed(self, ranges: Sequence[Tuple[int, int]]):
+        with self._lock:
+            for start, end in reversed(ranges):
+                del self._obj_ids[start:end]
+
+
+class ListRecordSource(RecordSource):
+    """A record source for records that are already in memory"""
+
+    def __init__(self, records: Sequence[mincepy.DataRecord]):
+        self._records = records
+
+    def __iter__(self) -> Iterator[mincepy.DataRecord]:
+        return iter(self._records)
+
+    def page(self, skip: int, limit: int) -> List[mincepy.DataRecord]:
+        return list(self._records[skip:skip + limit])
+
+    def count(self) -> int:
+        return len(self._records)
+
+
+class CachingIterable:
+    """Wraps an iterable of records and collects the records it produces.  Once every record has
+    been seen the full list is passed to a callback so that it can be cached.  Nothing is collected
+    if there are more than `max_records`."""
+    DEFAULT_MAX_RECORDS = 10000
+
+    def __init__(self,
+                 source: Iterable[mincepy.DataRecord],
+                 on_complete: Callable[[List[mincepy.DataRecord]], None],
+                 max_records=DEFAULT_MAX_RECORDS):
+        """
+        :param source: the iterable to wrap
+        :param on_complete: the callback that receives the list of records, this will be called
+            from whatever thread fetched the last record
+        :param max_records: the maximum number of records that will be collected
+        """
+        self._source = source
+        self._on_complete = on_complete
+        self._max_records = max_records
+
+        self._lock = threading.Lock()
+        self._collected = {}  # Position -> record, None once collecting has stopped
+        self._count = None
+
+    @property
+    def source(self) -> Iterable[mincepy.DataRecord]:
+        """The iterable being wrapped"""
+        return self._source
+
+    def __iter__(self) -> Iterator[mincepy.DataRecord]:
+        num_records = 0
+        iterator = iter(self._source)
+        try:
+            for record in iterator:
+                self._collect(num_records, (record,))
+                num_records += 1
+                yield record
+        finally:
+            # Make sure the source is closed if we are
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()
+
+        # Got all the way through so now we know how many there are
+        self._set_count(num_records)
+
+    def _collect(self, start: int, records: Sequence[mincepy.DataRecord]):
+        with self._lock:
+            if self._collected is None:
+                return
+
+            for position, record in enumerate(records, start):
+                self._collected[position] = record
+            if len(self._collected) > self._max_records:
+                # Too many, give up on keeping them
+                self._collected = None
+                return
+
+        self._check_complete()
+
+    def _set_count(self, count: int):
+        with self._lock:
+            self._count = count
+            if count > self._max_records:
+                self._collected = None
+                return
+
+        self._check_complete()
+
+    def _check_complete(self):
+        with self._lock:
+            if self._collected is None or self._count is None or \
+                    len(self._collected) != self._count:
+                return
+
+            try:
+                records = [self._collected[position] for position in range(self._count)]
+            except KeyError:
+                # Positions beyond the end, the source must have changed while being fetched
+                records = None
+            self._collected = None
+
+        if records is not None:
+            self._on_complete(records)
+
+
+class CachingRecordSource(CachingIterable, RecordSource):
+    """Wraps another source and collects the records it produces, whether by iteration or paging.
+    Once every record has been seen the full list is passed to a callback so that it can be
+    cached."""
+
+    @property
+    def source(self) -> RecordSource:
+        """The source being wrapped"""
+        return self._source
+
+    def page(self, skip: int, limit: int) -> List[mincepy.DataRecord]:
+        records = self._source.page(skip, limit)
+        self._collect(skip, records)
+        return records
+
+    def count(self) -> Optional[int]:
+        count = self._source.count()
+        if count is not None:
+            self._set_count(count)
+        return count
+
+    def seek(self, value, limit: int) -> Optional[Tuple[int, List[mincepy.DataRecord]]]:
+        result = self._source.seek(value, limit)
+        if result is not None:
+            self._collect(*result)
+        return result
+
+    def removed(self, ranges: Sequence[Tuple[int, int]]):
+        self._source.removed(ranges)
+        with self._lock:
+            # The positions collected so far no longer line up
+            self._collected = None
+
+
+class ObjIdLookupSource:
+    """An iterable of the records for a (potentially very long) list of object ids.  Rather than
+    using one query with a huge list of ids, the ids are split into chunks that are looked up
+    concurrently and records are produced as each chunk completes.  Records either come in the order
+    that the ids were given in or, if the order doesn't need to be preserved, in whatever order the
+    chunks complete.  If the query has a sort then each chunk is fetched sorted, a page at a time,
+    and the chunks are merged as they go so records are produced once the first page of every chunk
+    is in.  Any skip or limit in the query applies to the records of all the chunks together.
+
+    The lookups run on a pool of threads that is shared by all lookup sources, rather than the
+    executor that the GUI uses, as this is usually iterated on a worker thread of that executor and
+    waiting on other work submitted to the same pool could starve it.
+
+    As there may be ids that aren't found, this is not a RecordSource, i.e. it can't be paged."""
+    DEFAULT_CHUNK_SIZE = 500
+    DEFAULT_PAGE_SIZE = 100
+    DEFAULT_MAX_IN_FLIGHT = 4
+
+    _shared_pool = None  # type: Optional[futures.Executor]
+    _shared_pool_lock = threading.Lock()
+
+    def __init__(self,
+                 historian: mincepy.Historian,
+                 obj_ids: Sequence,
+                 query: dict = None,
+                 preserve_order=False,
+                 projection: Optional[Callable[[], Iterable[str]]] = None,
+                 chunk_size=DEFAULT_CHUNK_SIZE,
+                 page_size=DEFAULT_PAGE_SIZE,
+                 max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                 pool: futures.Executor = None):
+        """
+        :param historian: the historian to look the records up in
+        :param obj_ids: the object ids to look up
+        :param query: any other criteria that the records have to meet, including any sort
+        :param preserve_order: if True, records are produced in the order of the object ids.  This
+            is ignored if the query has a sort.
+        :param projection: an optional callable that returns the record paths to fetch, as for
+            QueryRecordSource
+        :param chunk_size: the number of object ids to look up per query
+        :param page_size: the number of records of a chunk to fetch at a time when sorting
+        :param max_in_flight: the maximum number of chunks being looked up at any one time
+        :param pool: the executor to do the lookups on, by default the one shared by all lookup
+            sources
+        """
+        self._historian = historian
+        # Drop repeats, otherwise records would appear more than once if they are in different chunks
+        unique = {}
+        for obj_id in obj_ids:
+            unique.setdefault(_id_key(obj_id), obj_id)
+        self._obj_ids = list(unique.values())
+        self._query = dict(query or {})
+        # These apply to all the records, not those of each chunk
+        self._skip = self._query.pop('skip', None) or 0
+        self._limit = self._query.pop('limit', None)
+        sort = self._query.get('sort', None) or {}
+        if not isinstance(sort, dict):
+            sort = {sort: mincepy.ASCENDING}
+        # The (path, direction) pairs to sort on
+        self._sort = list(sort.items())
+        if self._sort:
+            # Chunks are fetched a page at a time so ties have to come back in the same order
+            self._query['sort'] = dict(sort)
+            self._query['sort'].setdefault(mincepy.OBJ_ID, mincepy.ASCENDING)
+        self._preserve_order = preserve_order and not self._sort
+        self._projection = projection
+        self._chunk_size = chunk_size
+        self._page_size = page_size
+        self._max_in_flight = max_in_flight
+        self._pool = pool or self._get_shared_pool()
+
+    @classmethod
+    def _get_shared_pool(cls) -> futures.Executor:
+        with cls._shared_pool_lock:
+            if cls._shared_pool is None:
+                cls._shared_pool = futures.ThreadPoolExecutor(max_workers=cls.DEFAULT_MAX_IN_FLIGHT,
+                                                              thread_name_prefix='lookup')
+            return cls._shared_pool
+
+    def __iter__(self) -> Iterator[mincepy.DataRecord]:
+        records = self._iter_chunks()
+        try:
+            stop = None if self._limit is None else self._skip + self._limit
+            yield from itertools.islice(records, self._skip, stop)
+        finally:
+            # Stop any lookups that are still going
+            records.close()
+
+    def _iter_chunks(self) -> Iterator[mincepy.DataRecord]:
+        """Iterate over the records of all the chunks"""
+        chunks = (self._obj_ids[start:start + self._chunk_size]
+                  for start in range(0, len(self._obj_ids), self._chunk_size))
+
+        if not self._sort:
+            for _chunk, records in self._lookup_all(chunks, ordered=self._preserve_order):
+                yield from records
+            return
+
+        # Each chunk comes back sorted so the chunks can be merged, fetching the rest of each one as
+        # the merge gets to it
+        chunk_records = [
+            self._iter_sorted_chunk(chunk, first_page)
+            for chunk, first_page in self._lookup_all(chunks, ordered=True, limit=self._page_size)
+        ]
+        merged = heapq.merge(*chunk_records, key=functools.cmp_to_key(self._compare))
+        try:
+            yield from merged
+        finally:
+            for records in chunk_records:
+                records.close()
+
+    def _lookup_all(self,
+                    chunks: Iterator[list],
+                    ordered: bool,
+                    limit: int = None) -> Iterator[Tuple[list, List[mincepy.DataRecord]]]:
+        """Look up the records of each chunk, with at most max_in_flight lookups at once.  Gives
+        (chunk, records) pairs in the order of the chunks, if ordered, otherwise as they complete."""
+        in_flight = {}  # Future -> chunk, in the order they were submitted
+
+        def submit_next():
+            chunk = next(chunks, None)
+            if chunk is not None:
+                in_flight[self._pool.submit(self._lookup, chunk, 0, limit)] = chunk
+
+        for _ in range(self._max_in_flight):
+            submit_next()
+
+        try:
+            while in_flight:
+                if ordered:
+                    future = list(in_flight)[0]
+                else:
+                    done, _ = futures.wait(in_flight, return_when=futures.FIRST_COMPLETED)
+                    future = done.pop()
+
+                records = future.result()
+                chunk = in_flight.pop(future)
+                submit_next()
+                yield chunk, records
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+    def _iter_sorted_chunk(self, chunk: list,
+                           records: List[mincepy.DataRecord]) -> Iterator[mincepy.DataRecord]:
+        """Iterate over the sorted records of a chunk given its first page.  Each following page is
+        fetched while the one before it is being consumed."""
+        # Only the first of the records of each chunk can make it past the merge
+        stop = None if self._limit is None else self._skip + self._limit
+        fetched = 0
+        future = None
+        try:
+            while True:
+                fetched += len(records)
+                if len(records) == self._page_size and (stop is None or fetched < stop):
+                    future = self._pool.submit(self._lookup, chunk, fetched, self._page_size)
+                yield from records
+                if future is None:
+                    return
+                records = future.result()
+                future = None
+        finally:
+            if future is not None:
+                future.cancel()
+
+    def _lookup(self, obj_ids: list, skip: int, limit: Optional[int]) -> List[mincepy.DataRecord]:
+        """Look up (some of) the records of a chunk of object ids.  Called on the lookup pool."""
+        query = self._query.copy()
+        query['obj_id'] = obj_ids
+        query['skip'] = skip
+        query['limit'] = limit
+        projection = None if self._projection is None else self._get_paths
+        records = list(QueryRecordSource(self._historian, query, projection=projection))
+        if self._preserve_order:
+            positions = {}
+            for position, obj_id in enumerate(obj_ids):
+                positions.setdefault(_id_key(obj_id), position)
+            records.sort(key=lambda record: positions.get(_id_key(record.obj_id), len(positions)))
+
+        return records
+
+    def _get_paths(self) -> List[str]:
+        """Get the record paths to fetch when projecting, these include the ones sorted on as they
+        are needed to merge the chunks"""
+        paths = list(self._projection())
+        paths.extend(path for path, _direction in self._sort if path not in paths)
+        return paths
+
+    def _compare(self, record1: mincepy.DataRecord, record2: mincepy.DataRecord) -> int:
+        """Compare two records in the same way as the sort of the query"""
+        for path, direction in self._sort:
+            key1 = utils.sort_key(_get_path_value(record1, path))
+            key2 = utils.sort_key(_get_path_value(record2, path))
+            if key1 != key2:
+                return (-1 if key1 < key2 else 1) * (-1 if direction == mincepy.DESCENDING else 1)
+
+        return 0
+
+
+def _get_path_value(record: mincepy.DataRecord, path: str) -> Any:
+    """Get the value at a dotted path (e.g. 'state.make') of a record, None if there isn't one"""
+    path = path.split('.')
+    value = getattr(record, path[0], None)
+    if len(path) > 1:
+        try:
+            value = tree.get_by_path(value, path[1:])
+        except (KeyError, IndexError, TypeError):
+            value = None
+    return value
+
+
+def _id_key(obj_id) -> str:
+    """Get a key for an object id that is the same whether or not it is given as a string"""
+    return str(obj_id).lower()
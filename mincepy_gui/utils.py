@@ -1,6 +1,8 @@
 import datetime
 import inspect
 import json
+import numbers
+import operator
 import os
 import pprint
 import sys
@@ -9,8 +11,8 @@ import typing
 import uuid
 
 import pytray.pretty
-from pytray import tree
 import bson
+import bson.errors
 
 
 def obj_dict(obj):
@@ -39,29 +41,127 @@ class UUIDEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
+_UUID_PREFIX = 'UUID('
+_OBJECT_ID_PREFIX = 'ObjectId('
+
+
+def _decode_literal(value: str):
+    """Convert a UUID('...') or ObjectId('...') literal string into the corresponding object,
+    anything else is returned unaltered"""
+    if value.startswith(_UUID_PREFIX):
+        try:
+            return uuid.UUID(value[len(_UUID_PREFIX) + 1:-2])
+        except ValueError:
+            pass
+    elif value.startswith(_OBJECT_ID_PREFIX):
+        try:
+            return bson.ObjectId(value[len(_OBJECT_ID_PREFIX) + 1:-2])
+        except (ValueError, bson.errors.InvalidId):
+            pass
+
+    return value
+
+
+def _decode_entry(entry):
+    if isinstance(entry, str):
+        # Cheap check on the first character before trying to decode
+        return _decode_literal(entry) if entry[:1] in ('U', 'O') else entry
+    return entry
+
+
 class UUIDDecoder(json.JSONDecoder):
+    """Decodes JSON converting UUID('...') and ObjectId('...') literals into the corresponding
+    objects.  Only the top level entries of a dictionary or list (or the value itself if it is a
+    string) are converted, literals nested any deeper are left as strings."""
 
     def decode(self, s):  # pylint: disable=arguments-differ
         decoded = super(UUIDDecoder, self).decode(s)
-
-        def to_uuid(entry, path):  # pylint: disable=unused-argument
-            obj_id = 'ObjectId'
-            if isinstance(entry, str):
-                if entry.startswith('UUID('):
-                    try:
-                        return uuid.UUID(entry[6:-2])
-                    except ValueError:
-                        pass
-                elif entry.startswith(obj_id):
-                    try:
-                        # Object id format is ObjectId('...')
-                        return bson.ObjectId(entry[len(obj_id) + 2:-2])
-                    except ValueError:
-                        pass
-
-            return entry
-
-        return tree.transform(to_uuid, decoded)
+        if _UUID_PREFIX not in s and _OBJECT_ID_PREFIX not in s:
+            # Nothing to convert, which is the case for most queries
+            return decoded
+
+        if isinstance(decoded, dict):
+            return {key: _decode_entry(value) for key, value in decoded.items()}
+        if isinstance(decoded, list):
+            return [_decode_entry(value) for value in decoded]
+        return _decode_entry(decoded)
+
+
+class QueryCodec:
+    """Converts queries to and from JSON strings, in the same way as UUIDEncoder and UUIDDecoder.
+    The last query encoded, and its string, are remembered so that encoding the same query again
+    costs nothing.  For this to work queries must not be modified in place, which is the case for
+    those held by the query model."""
+
+    def __init__(self):
+        self._encoder = UUIDEncoder()
+        self._decoder = UUIDDecoder()
+        self._last_encoded = None, None  # (query, string)
+
+    def encode(self, query) -> str:
+        last_query, last_string = self._last_encoded
+        if query is last_query:
+            return last_string
+
+        string = self._encoder.encode(query)
+        self._last_encoded = query, string
+        return string
+
+    def decode(self, string: str):
+        return self._decoder.decode(string)
+
+
+def approx_size(obj, max_depth=8) -> int:
+    """Get an approximate size in bytes of an object including the containers and strings it holds.
+    This is cheap enough to be used for budgeting memory but is not exact."""
+    size = sys.getsizeof(obj, 64)
+    if max_depth <= 0:
+        return size
+
+    if isinstance(obj, (str, bytes, bytearray)):
+        return size
+    if isinstance(obj, dict):
+        return size + sum(
+            approx_size(key, max_depth - 1) + approx_size(value, max_depth - 1)
+            for key, value in obj.items())
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return size + sum(approx_size(entry, max_depth - 1) for entry in obj)
+
+    return size
+
+
+def _to_naive_utc(value: datetime.datetime) -> datetime.datetime:
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value
+
+
+# The types known to sort_key(), in the order they are checked (bools are also numbers), along with
+# the rank of each and a function that gives the value to compare (None if it's the value itself)
+_SORT_RANKS = (
+    (type(None), 0, lambda _value: 0),
+    (bool, 7, None),
+    (numbers.Real, 1, None),
+    (str, 2, None),
+    (dict, 3, lambda value: tuple((str(key), sort_key(entry)) for key, entry in value.items())),
+    ((list, tuple), 4, lambda value: tuple(sort_key(entry) for entry in value)),
+    ((bytes, bytearray), 5, bytes),
+    (uuid.UUID, 5, operator.attrgetter('bytes')),
+    (bson.ObjectId, 6, operator.attrgetter('binary')),
+    (datetime.datetime, 8, _to_naive_utc),
+)
+
+
+def sort_key(value) -> tuple:
+    """Get a key that can be used to sort values of any type.  Values are first ordered by type,
+    approximating the order that MongoDB uses (null, numbers, strings, objects, arrays, binary data,
+    object ids, booleans, dates), and then by value.  Values of unknown types go last and are
+    compared by their string representation."""
+    for types, rank, get_value in _SORT_RANKS:
+        if isinstance(value, types):
+            return rank, value if get_value is None else get_value(value)
+
+    return 9, str(value)
 
 
 def pretty_type_string(obj_type: typing.Type) -> str:
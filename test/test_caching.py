@@ -0,0 +1,64 @@
+# pylint: disable=unused-import, redefined-outer-name
+"""Test the caches"""
+import mincepy
+from mincepy import testing
+from mincepy.testing import archive_uri, historian
+
+from mincepy_gui import caching
+
+
+def test_lru_cache():
+    cache = caching.LRUCache(100, sizeof=lambda value: value)
+    cache.put('a', 40)
+    cache.put('b', 40)
+    assert cache.get('a') == 40  # 'a' is now the most recently used
+    cache.put('c', 40)
+    assert 'b' not in cache
+    assert 'a' in cache and 'c' in cache
+    assert cache.num_bytes == 80
+
+    # Too big to be stored at all
+    cache.put('d', 101)
+    assert 'd' not in cache
+    assert cache.get('d', 'default') == 'default'
+    assert cache.hits == 1
+    assert cache.misses == 1
+    assert cache.hit_rate == 0.5
+
+    assert cache.pop('a') == 40
+    assert cache.num_bytes == 40
+
+
+def test_lru_cache_ttl():
+    now = [0.]
+    cache = caching.LRUCache(100, sizeof=lambda value: value, ttl=10., clock=lambda: now[0])
+    cache.put('a', 40)
+    now[0] = 5.
+    cache.put('b', 40)
+    assert cache.get('a') == 40
+
+    # 'a' has expired but 'b' hasn't
+    now[0] = 10.
+    assert 'a' not in cache
+    assert cache.get('a') is None
+    assert cache.num_bytes == 40
+    assert cache.get('b') == 40
+
+
+def test_object_cache(historian: mincepy.Historian):
+    car = testing.Car(make='ferrari')
+    car_id = car.save()
+    record = next(iter(historian.records.find(obj_id=car_id)))
+
+    cache = caching.ObjectCache()
+    # Just peeking doesn't load anything
+    assert cache.get_object(record, load=False) is None
+    assert cache.get_object(record).make == 'ferrari'
+    assert cache.get_object(record, load=False) is cache.get_object(record)
+    assert cache.get_snapshot(record).make == 'ferrari'
+    assert cache.hits == 2
+    assert cache.misses == 2
+
+    cache.invalidate([car_id])
+    assert cache.get_object(record, load=False) is None
+    assert cache.get_snapshot(record, load=False) is None
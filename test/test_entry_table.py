@@ -1,11 +1,19 @@
 """Test the entry table model and controller"""
+from concurrent import futures
 
-from PySide2 import QtCore
+from PySide2 import QtCore, QtWidgets
 
 import mincepy
+from mincepy_gui import columnar
 from mincepy_gui import columns
 from mincepy_gui import common
 from mincepy_gui import entry_table
+from mincepy_gui import paged_table
+from mincepy_gui import prefetch
+from mincepy_gui import record_store
+from mincepy_gui import schema
+from mincepy_gui import sources
+from mincepy_gui import utils
 
 
 def test_simple_entry_table():
@@ -126,3 +134,652 @@ def test_fetching_more():
         batch += 1
 
     assert table.rowCount() == len(records)
+
+
+def test_background_prefetch(qtbot):
+    """Test that records are prefetched on a background executor and inserted once they arrive"""
+    empty_index = QtCore.QModelIndex()
+    pool = futures.ThreadPoolExecutor()
+
+    def executor(func, msg=None, blocking=False):  # pylint: disable=unused-argument
+        return pool.submit(func)
+
+    table = entry_table.EntryTableModel(executor=executor)
+    table.batch_size = 3
+
+    records = _create_records(10)
+    table.set_source(iter(records), None)
+    # The first batch is inserted as soon as it arrives
+    qtbot.waitUntil(lambda: table.rowCount() == table.batch_size)
+
+    while table.canFetchMore(empty_index):
+        num_rows = table.rowCount()
+        table.fetchMore(empty_index)
+        qtbot.waitUntil(lambda: table.rowCount() > num_rows or  # pylint: disable=cell-var-from-loop
+                        not table.canFetchMore(empty_index))
+
+    assert list(table.records) == records
+
+    # Setting a new source should discard anything prefetched from the old one
+    table.set_source(iter(_create_records(2)), None)
+    qtbot.waitUntil(lambda: table.rowCount() == 2)
+    assert not table.canFetchMore(empty_index)
+
+    # ...and close it, if it can be closed
+    closed = []
+
+    def generate():
+        try:
+            yield from _create_records(10)
+        finally:
+            closed.append(True)
+
+    table.set_source(generate(), None)
+    qtbot.waitUntil(lambda: table.rowCount() == table.batch_size)
+    table.set_source(None, None)
+    qtbot.waitUntil(lambda: closed == [True])
+
+    pool.shutdown()
+
+
+def test_adaptive_batching():
+    batcher = prefetch.AdaptiveBatcher(64, target_latency=0.03, min_batch_size=4)
+    records = _create_records(64)
+
+    # Slow batches should shrink the batch size (but never more than halving it)
+    batcher.measure(records, 0.3)
+    assert batcher.batch_size == 32
+    for _ in range(10):
+        batcher.measure(records[:batcher.batch_size], 0.3)
+    assert batcher.batch_size == 4
+
+    # Fast batches should grow it
+    for _ in range(20):
+        batcher.measure(records[:batcher.batch_size], 0.001)
+    assert batcher.batch_size > 64
+    assert batcher.throughput > 0
+    assert batcher.byte_rate > 0
+
+    # The payload size should limit the batch size
+    batcher.max_batch_bytes = utils.approx_size(records[0]) * 10
+    for _ in range(10):
+        batcher.measure(records, 0.001)
+    assert batcher.batch_size <= 10
+
+    # Non-adaptive batchers just measure
+    fixed = prefetch.AdaptiveBatcher(64, adaptive=False)
+    fixed.measure(records, 1.)
+    assert fixed.batch_size == 64
+    assert fixed.throughput == 64
+
+
+class ListSource(sources.RecordSource):
+    """A pageable source backed by a list that counts how many pages were requested"""
+
+    def __init__(self, records):
+        self.records = records
+        self.pages = []
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def page(self, skip, limit):
+        self.pages.append((skip, limit))
+        return self.records[skip:skip + limit]
+
+    def count(self):
+        return len(self.records)
+
+    def seek(self, value, limit):
+        position = sum(1 for record in self.records if record.state['index'] < value)
+        return position, self.page(position, limit)
+
+
+def test_windowed_records():
+    empty_index = QtCore.QModelIndex()
+    table = entry_table.EntryTableModel(window_margin=4)
+    table.batch_size = 4
+
+    source = ListSource(_create_records(40))
+    table.set_source(source, None)
+    while table.canFetchMore(empty_index):
+        table.fetchMore(empty_index)
+    assert table.rowCount() == 40
+    assert table.records.num_resident == 40
+
+    for row in range(40):
+        table.data(table.index(row, 0), QtCore.Qt.DisplayRole)
+
+    # Only rows 20-23 are visible so all but the margin either side should be evicted
+    table.set_viewport(20, 23)
+    assert table.records.num_resident == 12
+    # Along with their display strings
+    assert len(table._display_cache) == 12  # pylint: disable=protected-access
+    assert table.records[15] is None
+    assert table.records[16] is not None
+
+    # Asking for an evicted record reloads its page
+    assert table.data(table.index(1, 0), QtCore.Qt.DisplayRole) == table.LOADING_TEXT
+    assert source.pages == [(0, 4)]
+    assert table.get_record(1) is source.records[1]
+    assert table.records.num_resident == 16
+
+    # Removing records shifts the evicted rows too
+    table.remove_records(0, 2)
+    assert table.rowCount() == 38
+    assert table.get_record(0) is source.records[2]
+    assert table.records[14] is source.records[16]
+
+
+def test_columnar_rows():
+    empty_index = QtCore.QModelIndex()
+    table = entry_table.EntryTableModel(columnar_rows=True)
+    table.batch_size = 4
+
+    formatted = []
+
+    def formatter(value):
+        formatted.append(value)
+        return str(value)
+
+    records = _create_records(10)
+    column = columns.data_column(('state', 'index'), formatter=formatter)
+    table.set_columns([column, columns.data_column(('state', 'missing')), columns.OBJ_TYPE])
+    source = ListSource(records)
+    table.set_source(source, None)
+    while table.canFetchMore(empty_index):
+        table.fetchMore(empty_index)
+    # Nothing is formatted until it's shown
+    assert not formatted
+
+    # Only the values of the columns, and the identity of the records, are kept
+    handle = table.records[3]
+    assert isinstance(handle, columnar.RowHandle)
+    assert handle.state_keys == {'index'}
+    assert (handle.obj_id, handle.version) == (records[3].obj_id, records[3].version)
+    assert isinstance(table.get_record(3), sources.PartialRecord)
+    # The raw value of the type is the type id, which is what the archive sorts on
+    assert handle.raw_value(columns.OBJ_TYPE) == records[3].type_id
+    assert handle.raw_value(column) == 3
+
+    for _ in range(2):
+        for row in range(10):
+            assert table.data(table.index(row, 0), common.DataRole) == row
+            assert table.data(table.index(row, 0), QtCore.Qt.DisplayRole) == str(row)
+            assert table.data(table.index(row, 1), QtCore.Qt.DisplayRole) is None
+    assert formatted == list(range(10))
+
+    # The values of new state columns are extracted from the batches without loading them again
+    assert table.append_columns(columns.data_column(('state', 'index'), name='again')) == 0
+    assert table.records.num_resident == 10
+    assert table.data(table.index(5, 3), QtCore.Qt.DisplayRole) == '5'
+
+    # Removed columns are discarded from the batches
+    table.remove_columns(columns.OBJ_TYPE)
+    assert columns.OBJ_TYPE not in table.records[5]
+
+    # Unless the records were projected without them
+    partial = sources.PartialRecord.from_dict({
+        'obj_id': 2,
+        'version': 0,
+        'type_id': 'car',
+        'state': {
+            'index': 0
+        }
+    })
+    source = ListSource([partial] * 4)
+    table.set_source(source, None)
+    assert table.append_columns(columns.data_column(('state', 'colour'))) == 4
+    assert table.records.num_resident == 0
+    assert table.data(table.index(0, 0), QtCore.Qt.DisplayRole) == table.LOADING_TEXT
+    assert table.data(table.index(0, 0), QtCore.Qt.DisplayRole) == '0'
+    assert table.data(table.index(0, 3), QtCore.Qt.DisplayRole) is None
+
+
+def test_presize(qtbot):
+    table = entry_table.EntryTableModel(presize=True)
+    controller = entry_table.EntryTableController(table, QtWidgets.QTableView())
+    table.batch_size = 4
+
+    records = _create_records(40)
+    records[30] = mincepy.DataRecord(
+        **dict(records[30]._asdict(), state={
+            'index': 30,
+            'extra': True
+        }))
+    source = ListSource(records)
+    with qtbot.waitSignal(table.total_count_changed):
+        table.set_source(source, None)
+
+    # After the first batch the rest of the table is made of placeholders
+    assert table.total_count == 40
+    assert table.rowCount() == 40
+    assert table.num_loaded == 4
+    assert not table.canFetchMore(QtCore.QModelIndex())
+    assert 'extra' not in controller.state_keys
+
+    # Placeholders are loaded when they are needed and new keys are picked up
+    assert table.get_record(30) is None
+    assert table.get_record(30) is records[30]
+    assert source.pages == [(28, 4)]
+    assert table.num_loaded == 8
+    assert 'extra' in controller.state_keys
+
+    table.remove_records(0, 2)
+    assert table.total_count == 38
+
+
+class ShortSource(ListSource):
+    """A source that claims to have more records than it does"""
+
+    def count(self):
+        return len(self.records) + 10
+
+
+def test_presized_pages(qtbot):
+    table = entry_table.EntryTableModel(presize=True)
+    table.batch_size = 4
+    measured = []
+    measure = table.batcher.measure
+
+    def record_measurement(batch, duration):
+        measured.append(len(batch))
+        measure(batch, duration)
+
+    table.batcher.measure = record_measurement
+
+    source = ShortSource(_create_records(20))
+    with qtbot.waitSignal(table.total_count_changed):
+        table.set_source(source, None)
+    assert table.rowCount() == 30
+
+    # Whole pages that are loaded are measured by the batcher, just like the batches that are
+    # streamed in
+    measured.clear()
+    table.get_record(9)
+    assert measured == [4]
+
+    # A page that comes back short means there are no more records so the rest of the rows go
+    table.get_record(21)
+    assert table.rowCount() == 20
+    assert table.total_count == 20
+    assert source.pages[-1] == (20, 4)
+
+
+class FailingSource(ListSource):
+    """A list source whose pages and seeks fail while fail is set"""
+
+    def __init__(self, records):
+        super().__init__(records)
+        self.fail = False
+
+    def page(self, skip, limit):
+        if self.fail:
+            raise RuntimeError('Lost the connection')
+        return super().page(skip, limit)
+
+
+def test_failed_loads(qtbot):
+    table = entry_table.EntryTableModel(presize=True)
+    table.batch_size = 4
+    source = FailingSource(_create_records(20))
+    with qtbot.waitSignal(table.total_count_changed):
+        table.set_source(source, None)
+
+    # A page that fails to load can be asked for again
+    source.fail = True
+    table.get_record(9)
+    assert table.records[9] is None
+    source.fail = False
+    table.get_record(9)
+    assert table.records[9] is source.records[9]
+
+    # as can the rows that failed to load for sorting, which is then left to the source
+    source.fail = True
+    with qtbot.waitSignal(table.sort_requested):
+        table.sort(0, QtCore.Qt.AscendingOrder)
+    source.fail = False
+    table.get_record(15)
+    assert table.records[15] is source.records[15]
+
+    source.fail = True
+    with qtbot.waitSignal(table.row_found) as blocker:
+        assert table.go_to_value(5)
+    assert blocker.args == [-1]
+
+
+def test_go_to(qtbot):
+    table = entry_table.EntryTableModel()
+    controller = entry_table.EntryTableController(table, QtWidgets.QTableView())
+    table.batch_size = 4
+
+    source = ListSource(_create_records(100))
+    table.set_source(source, None)
+    assert table.rowCount() == 4
+
+    # Jump way past what has been loaded, only the page with the row in it is loaded
+    assert controller.go_to_row(50)
+    assert table.rowCount() == 100
+    assert table.records[50] is source.records[50]
+    assert table.num_loaded == 8
+    assert not table.canFetchMore(QtCore.QModelIndex())
+
+    # Rows past the end can't be gone to
+    assert table.go_to_row(200) == 99
+
+    with qtbot.waitSignal(table.row_found) as blocker:
+        assert controller.go_to_value(70.5)
+    assert blocker.args == [71]
+    assert table.records[71] is source.records[71]
+    assert table.records[70] is None
+
+
+def test_local_sort(qtbot):
+    empty_index = QtCore.QModelIndex()
+    table = entry_table.EntryTableModel()
+    table.batch_size = 4
+
+    values = [3, 'b', None, 1.5, 'a', True, -2, None]
+    records = _create_records(len(values))
+    for idx, value in enumerate(values):
+        records[idx] = mincepy.DataRecord(**dict(records[idx]._asdict(), state={'value': value}))
+    table.set_columns([columns.data_column(('state', 'value'))])
+
+    # Not fully loaded, so ask for a sort on the server
+    table.set_source(iter(records), None)
+    assert not table.fully_loaded
+    with qtbot.waitSignal(table.sort_requested) as blocker:
+        table.sort(0, QtCore.Qt.AscendingOrder)
+    assert blocker.args == ['state.value', QtCore.Qt.AscendingOrder]
+
+    while table.canFetchMore(empty_index):
+        table.fetchMore(empty_index)
+    assert table.fully_loaded
+
+    # Mixed types are ordered by type, then value
+    selected = QtCore.QPersistentModelIndex(table.index(0, 0))
+    with qtbot.assertNotEmitted(table.sort_requested):
+        with qtbot.waitSignal(table.sorted_locally):
+            table.sort(0, QtCore.Qt.AscendingOrder)
+    assert [record.state['value'] for record in table.records] == \
+           [None, None, -2, 1.5, 3, 'a', 'b', True]
+    # Persistent indexes follow their rows
+    assert selected.row() == 4
+
+    table.sort(0, QtCore.Qt.DescendingOrder)
+    assert [record.state['value'] for record in table.records] == \
+           [True, 'b', 'a', 3, 1.5, -2, None, None]
+    assert selected.row() == 3
+
+
+def test_local_sort_presized(qtbot):
+    table = entry_table.EntryTableModel(presize=True)
+    table.batch_size = 4
+    table.window_margin = 2
+    table.set_columns([columns.data_column(('state', 'index'))])
+
+    source = ListSource(_create_records(20))
+    with qtbot.waitSignal(table.total_count_changed):
+        table.set_source(source, None)
+    assert table.rowCount() == 20
+    assert not table.fully_loaded
+
+    # There are few enough results that the missing rows are loaded and then sorted locally
+    with qtbot.assertNotEmitted(table.sort_requested):
+        with qtbot.waitSignal(table.sorted_locally) as blocker:
+            table.sort(0, QtCore.Qt.DescendingOrder)
+    assert blocker.args == ['state.index', QtCore.Qt.DescendingOrder]
+    assert table.fully_loaded
+    assert [record.state['index'] for record in table.records] == list(reversed(range(20)))
+
+    # Once sorted the rows no longer match the source, and without a historian they can't be looked
+    # up, so they aren't evicted
+    table.set_viewport(0, 1)
+    assert table.num_loaded == 20
+
+    # Too many to sort locally
+    table.MAX_LOCAL_SORT = 10
+    table.set_source(ListSource(_create_records(20)), None)
+    with qtbot.waitSignal(table.sort_requested):
+        table.sort(0, QtCore.Qt.AscendingOrder)
+
+
+def test_display_cache():
+    empty_index = QtCore.QModelIndex()
+    table = entry_table.EntryTableModel()
+    table.batch_size = 4
+
+    formatted = []
+
+    def formatter(value):
+        formatted.append(value)
+        return str(value)
+
+    records = _create_records(6)
+    column = columns.data_column(('state', 'index'), formatter=formatter)
+    table.set_columns([column])
+    table.set_source(iter(records), None)
+    while table.canFetchMore(empty_index):
+        table.fetchMore(empty_index)
+
+    for _ in range(3):
+        for row in range(6):
+            assert table.data(table.index(row, 0), QtCore.Qt.DisplayRole) == str(row)
+    assert formatted == list(range(6))
+
+    # Removing records shifts rows so the cache has to be invalidated
+    table.remove_record(0)
+    assert table.data(table.index(0, 0), QtCore.Qt.DisplayRole) == '1'
+    assert formatted[-1] == 1
+
+
+def _create_keyed_record(*keys):
+    return mincepy.DataRecord.new_builder(obj_id=1,
+                                          type_id='car',
+                                          state={
+                                              key: 1 for key in keys
+                                          },
+                                          snapshot_hash=None,
+                                          state_types=None).build()
+
+
+def _state_columns(table: paged_table.ConstEntryTable):
+    return {col.path[1] for col in table.columns if col.path[0] == 'state'}
+
+
+def test_state_key_index():
+    index = entry_table.StateKeyIndex()
+    assert set(index.insert(0, [('a', 'b'), ('a',)])) == {'a', 'b'}
+    assert index.count('a') == 2
+    assert set(index.insert(1, [('a', 'c')])) == {'c'}
+    assert len(index) == 3
+    assert index.most_common(1) == ['a']
+
+    # Rows are now ('a', 'b'), ('a', 'c'), ('a',)
+    assert index.remove(0, 1) == ['b']
+    assert set(index.remove(0, 2)) == {'a', 'c'}
+    assert len(index) == 0
+
+
+def test_auto_columns(qtbot):
+    empty_index = QtCore.QModelIndex()
+    table = entry_table.EntryTableModel()
+    view = QtWidgets.QTableView()
+    qtbot.addWidget(view)
+    controller = entry_table.EntryTableController(table, view)
+
+    records = [_create_keyed_record('a', 'b'), _create_keyed_record('a', 'c')]
+    controller.set_source(iter(records), None)
+    while table.canFetchMore(empty_index):
+        table.fetchMore(empty_index)
+    assert _state_columns(table) == {'a', 'b', 'c'}
+
+    table.remove_record(0)
+    assert _state_columns(table) == {'a', 'c'}
+    assert controller.state_keys.count('a') == 1
+
+    # Check that the number of automatic columns can be capped
+    table = entry_table.EntryTableModel()
+    controller = entry_table.EntryTableController(table, view, max_auto_columns=2)
+    records = [
+        _create_keyed_record('a', 'b'),
+        _create_keyed_record('a', 'c'),
+        _create_keyed_record('a', 'c')
+    ]
+    controller.set_source(iter(records), None)
+    assert _state_columns(table) == {'a', 'c'}
+
+    table.remove_records(1, 2)
+    assert _state_columns(table) == {'a', 'b'}
+
+
+def test_schema_columns(qtbot):
+    table = entry_table.EntryTableModel()
+    view = QtWidgets.QTableView()
+    qtbot.addWidget(view)
+    controller = entry_table.EntryTableController(table, view)
+
+    # A projected record only has the state entries of the columns that are shown
+    full = _create_keyed_record('a', 'b')
+    partial = sources.PartialRecord.from_dict({
+        'obj_id': full.obj_id,
+        'type_id': full.type_id,
+        'version': full.version,
+        'state': {
+            'a': 1
+        }
+    })
+    boat = sources.PartialRecord.from_dict({
+        'obj_id': 2,
+        'type_id': 'boat',
+        'version': 0,
+        'state': {
+            'a': 2
+        }
+    })
+    source = ListSource([partial, boat])
+    controller.set_source(source, None)
+    assert _state_columns(table) == {'a'}
+    # The partial rows were fetched with the entry of the new column so they aren't loaded again
+    assert table.get_record(0) is partial
+
+    # The other keys are found from the schema index and the partial rows that may have them are
+    # evicted so that they are loaded again with the new column
+    index = schema.SchemaIndex()
+    index.add('car', [full])
+    controller.set_schema_index(index)
+    assert _state_columns(table) == {'a', 'b'}
+    assert table.records[0] is None
+    # Boats don't have 'b' so there is no need to load them again
+    assert table.records[1] is boat
+    assert table.data(table.index(1, table.columnCount() - 1), common.DataRole) is None
+
+
+def test_column_suggestions(qtbot):
+    table = entry_table.EntryTableModel()
+    view = QtWidgets.QTableView()
+    qtbot.addWidget(view)
+    controller = entry_table.EntryTableController(table, view)
+    controller.set_source(iter([_create_keyed_record('a')]), None)
+
+    menu = controller.header_menu
+    menu.set_column_suggestions([('state.a', 1.), ('state.b.c', 0.5)])
+    # Columns already shown aren't suggested
+    assert menu.get_column_suggestions() == [('state.b.c', 0.5)]
+
+    menu.add_column('state.b.c')
+    assert 'state.b.c' in table.get_projection()
+    assert not menu.get_column_suggestions()
+
+
+def test_bulk_removal(qtbot):
+    empty_index = QtCore.QModelIndex()
+    table = entry_table.EntryTableModel()
+    view = QtWidgets.QTableView()
+    qtbot.addWidget(view)
+    controller = entry_table.EntryTableController(table, view)
+
+    records = [_create_keyed_record('key{}'.format(idx % 3)) for idx in range(12)]
+    controller.set_source(iter(records), None)
+    while table.canFetchMore(empty_index):
+        table.fetchMore(empty_index)
+
+    removals = []
+    table.rowsAboutToBeRemoved.connect(lambda _parent, start, end: removals.append((start, end)))
+    assert _state_columns(table) == {'key0', 'key1', 'key2'}
+
+    # Remove all the 'key1' records, these are all separate runs
+    to_remove = {id(record) for record in records if 'key1' in record.state}
+    assert controller.remove_matching_records(lambda record: id(record) in to_remove)
+    assert removals == [(10, 10), (7, 7), (4, 4), (1, 1)]
+    assert [record for record in table.records] == \
+           [record for record in records if id(record) not in to_remove]
+    assert _state_columns(table) == {'key0', 'key2'}
+    assert len(controller.state_keys) == 8
+
+    # Now use a reset by lowering the threshold
+    table.BULK_RESET_THRESHOLD = 1
+    removals.clear()
+    assert table.remove_matching_records(lambda record: 'key0' in record.state) == 4
+    assert not removals
+    assert table.rowCount() == 4
+    assert _state_columns(table) == {'key2'}
+    assert len(controller.state_keys) == 4
+
+
+def test_bulk_removal_windowed(qtbot):
+    table = entry_table.EntryTableModel(window_margin=4, presize=True)
+    table.batch_size = 4
+    records = _create_records(40)
+    source = ListSource(records)
+    with qtbot.waitSignal(table.total_count_changed):
+        table.set_source(source, None)
+    for row in range(0, 40, 4):
+        table.get_record(row)
+    # Only rows 16-27 stay loaded
+    table.set_viewport(20, 23)
+
+    counts = []
+    table.total_count_changed.connect(counts.append)
+    table.BULK_RESET_THRESHOLD = 1
+    # Every other row matches but only those that are loaded can be removed
+    assert table.remove_matching_records(lambda record: record.state['index'] % 2 == 0) == 6
+    assert table.rowCount() == 34
+    assert counts == [34]
+    assert [record.state['index'] for record in table.records if record is not None] == \
+           list(range(17, 28, 2))
+    assert table.records[16] is records[17]
+    assert table.records[21] is records[27]
+
+
+def test_verify_count(qtbot):
+    table = entry_table.EntryTableModel(window_margin=4, presize=True)
+    table.batch_size = 4
+    source = ListSource(_create_records(40))
+    with qtbot.waitSignal(table.total_count_changed):
+        table.set_source(source, None)
+    table.get_record(20)
+    table.set_viewport(20, 23)
+
+    out_of_date = []
+    table.out_of_date.connect(lambda: out_of_date.append(True))
+    # Deleting a resident record leaves the rows in line with the source
+    del source.records[21]
+    assert table.remove_matching_records(lambda record: record.state['index'] == 21) == 1
+    table.verify_count()
+    assert not out_of_date
+    assert table.get_record(21).state['index'] == 22
+
+    # but one that isn't resident can't be removed so the rows are out of date
+    del source.records[0]
+    table.verify_count()
+    assert out_of_date == [True]
+
+
+def test_remove_ranges():
+    store = record_store.RecordStore()
+    store.extend(list(range(10)))
+    store.evict_outside(2, 8)
+    assert store.remove_ranges([(6, 7), (0, 3), (4, 5)]) == 5
+    assert len(store) == 5
+    assert list(store) == [3, 5, 7, None, None]
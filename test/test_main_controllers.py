@@ -0,0 +1,85 @@
+# pylint: disable=unused-import, redefined-outer-name
+"""Tests for the main controller"""
+from concurrent import futures
+
+from PySide2 import QtCore, QtWidgets
+from PySide2.QtUiTools import QUiLoader
+from mincepy import testing
+from mincepy.testing import archive_uri, historian
+
+from mincepy_gui import columns
+from mincepy_gui import main
+from mincepy_gui import main_controllers
+from mincepy_gui import sources
+
+
+def _create_controller(qtbot) -> main_controllers.MainController:
+    ui_file = QtCore.QFile(str(main.RESOURCES / 'mainwindow.ui'))
+    ui_file.open(QtCore.QFile.ReadOnly)
+    window = QUiLoader().load(ui_file)
+    ui_file.close()
+    qtbot.addWidget(window)
+    return main_controllers.MainController(window, history_path=':memory:')
+
+
+def test_task_ended_cancelled(qtbot, monkeypatch):
+    controller = _create_controller(qtbot)
+    errors = []
+
+    class ErrorMessage:
+
+        def __init__(self, _parent):
+            pass
+
+        @staticmethod
+        def showMessage(msg):  # pylint: disable=invalid-name
+            errors.append(msg)
+
+    monkeypatch.setattr(QtWidgets, 'QErrorMessage', ErrorMessage)
+
+    # A cancelled task, e.g. a superseded query, isn't an error
+    future = futures.Future()
+    assert future.cancel()
+    controller._task_ended(future, 0, 0)  # pylint: disable=protected-access
+    assert not errors
+
+    # But one that failed is
+    future = futures.Future()
+    future.set_exception(RuntimeError('failed'))
+    controller._task_ended(future, 0, 0)  # pylint: disable=protected-access
+    assert errors == ['failed']
+
+
+def test_obj_id_lookup_source(qtbot, historian):
+    controller = _create_controller(qtbot)
+    obj_ids = [
+        testing.Car(make=str(idx)).save()
+        for idx in range(sources.ObjIdLookupSource.DEFAULT_CHUNK_SIZE + 1)
+    ]
+    obj_ids.reverse()
+    lookup_query = {'obj_id': obj_ids}
+
+    # The lookup only fetches what the table shows and the results are cached
+    source = controller._create_query_source(historian, lookup_query, keep_order=True)  # pylint: disable=protected-access
+    records = list(source)
+    assert isinstance(source.source, sources.ObjIdLookupSource)
+    assert all(isinstance(record, sources.PartialRecord) for record in records)
+    assert [record.obj_id for record in records] == obj_ids
+    assert controller._get_cache_key(lookup_query, keep_order=True) in controller._query_cache  # pylint: disable=protected-access
+
+    # Results in whatever order they come in are cached separately
+    assert controller._get_cache_key(lookup_query, keep_order=False) not in controller._query_cache  # pylint: disable=protected-access
+    # but the order doesn't matter for other queries
+    assert controller._get_cache_key({}, keep_order=False) == controller._get_cache_key({})  # pylint: disable=protected-access
+
+
+def test_table_projection_snapshot(qtbot):
+    controller = _create_controller(qtbot)
+    table = controller._results_table_controller.entry_table  # pylint: disable=protected-access
+    assert controller._table_projection == tuple(table.get_projection())  # pylint: disable=protected-access
+
+    # Worker threads read a snapshot of the paths, that is kept up to date on the GUI thread
+    table.append_columns(columns.DataColumn('colour', ['state', 'colour']))
+    assert controller._table_projection[-1] == 'state.colour'  # pylint: disable=protected-access
+    table.reset()
+    assert 'state.colour' not in controller._table_projection  # pylint: disable=protected-access
@@ -1,12 +1,42 @@
 # pylint: disable=unused-import, redefined-outer-name
 
+from PySide2 import QtCore, QtWidgets
 from mincepy import testing
+import pytest
 from mincepy.testing import archive_uri, historian
 
+from mincepy_gui import columns
+from mincepy_gui import common
 from mincepy_gui import entry_details
+from mincepy_gui import entry_table
+from mincepy_gui import sources
 import mincepy_gui
 
 
+@pytest.fixture
+def details_factory(qtbot, historian):
+    """Get a function that creates a results table (and its view and controller) showing the given
+    source, or all records if None, along with the details model and the controller that shows the
+    details of the current row.  Keyword arguments are passed on to the details controller."""
+
+    def create(source=None, table=None, **kwargs):
+        table = table or entry_table.EntryTableModel()
+        view = QtWidgets.QTableView()
+        qtbot.addWidget(view)
+        entry_table.EntryTableController(table, view)
+        if source is None:
+            source = sources.ListRecordSource(list(historian.records.find()))
+        table.set_source(source, historian)
+
+        details = entry_details.EntryDetails()
+        controller = entry_details.EntryDetailsController(table, view, QtWidgets.QTreeView(),
+                                                          details, **kwargs)
+        controller.reset(historian)
+        return table, view, details, controller
+
+    return create
+
+
 def test_record_tree(historian):
     car = testing.Car()
     car.save()
@@ -25,3 +55,191 @@ def test_record_tree(historian):
             1, entry_details.EntryDetails.COLUMN_HEADERS.index('Value')),
                          role=mincepy_gui.DataRole))
     assert car in data
+
+
+def test_details_controller(qtbot, details_factory):
+    cars = [testing.Car(make=str(idx)) for idx in range(3)]
+    for car in cars:
+        car.save()
+
+    table, view, details, controller = details_factory(debounce_interval=20)
+    loaded = []
+    controller._loaded.connect(lambda *args: loaded.append(args[2]))  # pylint: disable=protected-access
+
+    # Move through the rows quickly, only the last one should be loaded
+    for row in range(3):
+        view.setCurrentIndex(table.index(row, 0))
+        # The record is shown straight away
+        assert details.rowCount(QtCore.QModelIndex()) == 1
+
+    qtbot.waitUntil(lambda: details.rowCount(QtCore.QModelIndex()) == 3)
+    assert [record.obj_id for record in loaded] == [table.get_record(2).obj_id]
+
+
+def test_details_prefetch(qtbot, details_factory):
+    for idx in range(5):
+        testing.Car(make=str(idx)).save()
+
+    table, view, details, controller = details_factory(debounce_interval=20, prefetch_rows=1)
+    loaded = []
+    controller._loaded.connect(lambda *args: loaded.append(args[2]))  # pylint: disable=protected-access
+
+    view.setCurrentIndex(table.index(2, 0))
+    qtbot.waitUntil(lambda: details.rowCount(QtCore.QModelIndex()) == 3)
+
+    # The neighbours were prefetched so they are shown straight away without loading
+    for row in (3, 2, 1):
+        view.setCurrentIndex(table.index(row, 0))
+        assert details.rowCount(QtCore.QModelIndex()) == 3
+    assert len(loaded) == 1
+
+
+def test_details_of_unloaded_row(qtbot, historian, details_factory):
+    for idx in range(10):
+        testing.Car(make=str(idx)).save()
+
+    table = entry_table.EntryTableModel(presize=True)
+    table.batch_size = 2
+    _, view, details, _controller = details_factory(sources.QueryRecordSource(historian, {}),
+                                                    table,
+                                                    debounce_interval=20)
+    qtbot.waitUntil(lambda: table.rowCount() == 10)
+
+    # The details of a row that is still being loaded are shown once it arrives
+    deferred = []
+    table._executor = lambda func, *_args, **_kwargs: deferred.append(func)  # pylint: disable=protected-access
+    view.setCurrentIndex(table.index(7, 0))
+    assert details.rowCount(QtCore.QModelIndex()) == 0
+    for func in deferred:
+        func()
+    assert details.rowCount(QtCore.QModelIndex()) == 1
+    qtbot.waitUntil(lambda: details.rowCount(QtCore.QModelIndex()) == 3)
+
+    # The row can also be loaded before the table has even returned from being asked for it
+    table._executor = common.default_executor  # pylint: disable=protected-access
+    assert table.records[2] is None
+    view.setCurrentIndex(table.index(2, 0))
+    assert details.rowCount(QtCore.QModelIndex()) == 1
+    qtbot.waitUntil(lambda: details.rowCount(QtCore.QModelIndex()) == 3)
+
+
+def test_lazy_mapping_item():
+    details = entry_details.EntryDetails()
+    builder = details._item_builder  # pylint: disable=protected-access
+    headers = entry_details.EntryDetails.COLUMN_HEADERS
+
+    # Keys that can't be compared with each other
+    item = entry_details.LazyMappingItem(headers, {'b': 2, 1: 'a', None: 3}, builder, 3)
+    assert [item.child(row).data(0) for row in range(3)] == ['None', '1', 'b']
+
+    # Children of large mappings are found using the sorted index
+    big = {str(idx): idx for idx in range(10000)}
+    item = entry_details.LazyMappingItem(headers, big, builder, len(big))
+    entry_details.prebuild(item, 0)
+    values = [item.child(row).data(2) for row in range(len(big))]
+    assert values == [big[key] for key in sorted(big)]
+
+
+def test_details_fetch_more():
+    details = entry_details.EntryDetails()
+    builder = details._item_builder  # pylint: disable=protected-access
+    fetch_size = entry_details.LazyMappingItem.FETCH_SIZE
+    big = {str(idx): idx for idx in range(2 * fetch_size + 1)}
+    details.set_tree(
+        None, entry_details.LazyMappingItem(details.COLUMN_HEADERS, {'big': big}, builder, 1))
+    parent = details.index(0, 0)
+
+    # Only the first batch of children is visible to begin with, and only those are built
+    assert details.rowCount(parent) == fetch_size
+    assert not details.index(fetch_size, 0, parent).isValid()
+    entry_details.prebuild(parent.internalPointer(), 1)
+    assert len(parent.internalPointer()._children) == fetch_size  # pylint: disable=protected-access
+
+    num_fetches = 0
+    while details.canFetchMore(parent):
+        details.fetchMore(parent)
+        num_fetches += 1
+    assert num_fetches == 2
+    assert details.rowCount(parent) == len(big)
+    assert details.data(details.index(len(big) - 1, 2, parent), common.DataRole) == \
+           big[sorted(big)[-1]]
+
+
+def test_details_loads_serialised(qtbot, details_factory):
+    for idx in range(5):
+        testing.Car(make=str(idx)).save()
+
+    pending = []
+    table, view, details, _controller = details_factory(
+        executor=lambda func, msg=None, blocking=False: pending.append(func),
+        debounce_interval=0,
+        prefetch_rows=2)
+
+    view.setCurrentIndex(table.index(2, 0))
+    qtbot.waitUntil(lambda: bool(pending))
+    # The row is loaded and then its neighbours are prefetched, one at a time
+    num_loads = 0
+    while pending:
+        assert len(pending) == 1
+        pending.pop()()
+        num_loads += 1
+    assert num_loads == 5
+    assert details.rowCount(QtCore.QModelIndex()) == 3
+
+
+def test_selected_records(qtbot, historian):
+    for idx in range(5):
+        testing.Car(make=str(idx), colour='red').save()
+
+    table = entry_table.EntryTableModel(columnar_rows=True)
+    table.set_columns([columns.data_column(('state', 'make'))])
+    view = QtWidgets.QTableView()
+    qtbot.addWidget(view)
+    controller = entry_table.EntryTableController(table, view)
+    table.set_source(
+        sources.QueryRecordSource(historian, {'obj_type': testing.Car},
+                                  projection=table.get_projection), historian)
+    assert table.rowCount() == 5
+
+    # The rows only hold the values of the columns so the full records are loaded for the selection
+    assert isinstance(table.get_record(1), sources.PartialRecord)
+    view.selectRow(1)
+    view.selectionModel().select(table.index(3, 0), QtCore.QItemSelectionModel.Select)
+    selected = []
+    controller.get_selected(selected.append)
+    records = selected[0][entry_table.EntryTableController.DATA_RECORDS]
+    expected = [table.records[1].obj_id, table.records[3].obj_id]
+    assert [record.obj_id for record in records] == expected
+    assert all(record.state['colour'] == 'red' for record in records)
+    assert not any(isinstance(record, sources.PartialRecord) for record in records)
+
+    copied = []
+    controller.handle_copy(copied.append)
+    assert [record.obj_id for record in copied[0]] == [record.obj_id for record in records]
+
+
+def test_add_column_after_local_sort(qtbot, historian):
+    for idx in range(5):
+        testing.Car(make=str(idx), colour='red').save()
+
+    table = entry_table.EntryTableModel(columnar_rows=True)
+    table.set_columns([columns.data_column(('state', 'make'))])
+    view = QtWidgets.QTableView()
+    qtbot.addWidget(view)
+    entry_table.EntryTableController(table, view)
+    table.set_source(
+        sources.QueryRecordSource(historian, {'obj_type': testing.Car},
+                                  projection=table.get_projection), historian)
+    with qtbot.waitSignal(table.sorted_locally):
+        table.sort(0, QtCore.Qt.DescendingOrder)
+
+    # The rows can't be paged in from the source any more so they are paged in by identity, in the
+    # sorted order
+    table.append_columns(columns.data_column(('state', 'colour')))
+    assert not table.fully_loaded
+    table.get_record(0)
+    assert table.fully_loaded
+    display = QtCore.Qt.DisplayRole
+    assert [table.data(table.index(row, 0), display) for row in range(5)] == \
+        ['4', '3', '2', '1', '0']
+    assert [table.data(table.index(row, 1), display) for row in range(5)] == ['red'] * 5
@@ -0,0 +1,162 @@
+# pylint: disable=unused-import, redefined-outer-name
+"""Test the query profiler"""
+import mincepy
+from mincepy import testing
+from mincepy.testing import archive_uri, historian
+from PySide2 import QtCore
+
+from mincepy_gui import common
+from mincepy_gui import profiling
+from mincepy_gui import query
+from mincepy_gui import sources
+
+
+def test_query_shape():
+    assert query.query_shape({'state': {'make': 'ford'}, 'sort': {'state.make': -1}}) == \
+        query.query_shape({'state': {'make': 'fiat'}, 'sort': {'state.make': -1}})
+    assert query.query_shape({'state': {'make': 'ford'}}) != \
+        query.query_shape({'state': {'make': 5}})
+    # The number of entries in a list doesn't matter
+    assert query.query_shape({'obj_id': ['a', 'b', 'c']}) == query.query_shape({'obj_id': ['a']})
+
+
+def test_profiling_source(historian: mincepy.Historian):
+    for idx in range(10):
+        testing.Car(make=str(idx)).save()
+
+    profile = profiling.QueryProfile({'obj_type': testing.Car})
+    source = profiling.profile_source(
+        sources.QueryRecordSource(historian, {'obj_type': testing.Car}), profile)
+    assert isinstance(source, sources.RecordSource)
+
+    assert len(source.page(0, 4)) == 4
+    assert profile.num_records == 4
+    assert profile.time_to_first_record is not None
+    assert not profile.complete
+
+    assert len(list(source)) == 10
+    # The records that were paged aren't counted again
+    assert profile.num_records == 10
+    assert profile.num_repeated == 4
+    assert profile.complete
+    assert profile.bytes_transferred > 0
+    assert profile.records_per_second > 0
+
+    # Once complete every record has been delivered so any more are repeats
+    assert len(source.page(2, 4)) == 4
+    assert profile.num_records == 10
+    assert profile.num_repeated == 8
+
+    # Plain iterables can be profiled too
+    profile = profiling.QueryProfile({})
+    source = profiling.profile_source(iter(range(3)), profile)
+    assert not isinstance(source, sources.RecordSource)
+    assert list(source) == [0, 1, 2]
+    assert profile.num_records == 3
+
+
+def test_profile_tracked_records():
+    records = [sources.PartialRecord.from_dict({'obj_id': idx, 'version': 0}) for idx in range(3)]
+
+    # Only so many records are tracked to spot repeats
+    profile = profiling.QueryProfile({})
+    profile.MAX_TRACKED_RECORDS = 2
+    profile.delivered(records, 0.)
+    profile.delivered(records, 0.)
+    assert profile.num_records == 4
+    assert profile.num_repeated == 2
+
+    # Nor are they once the profile is done with
+    profile = profiling.QueryProfile({})
+    profile.delivered(records, 0.)
+    profile.forget_delivered()
+    profile.delivered(records, 0.)
+    assert profile.num_records == 6
+    assert profile.num_repeated == 0
+
+
+def test_summarise_explanation():
+    explanation = {
+        'queryPlanner': {
+            'winningPlan': {
+                'stage': 'FETCH',
+                'inputStage': {
+                    'stage': 'IXSCAN',
+                    'indexName': 'state.make_1'
+                }
+            },
+            'rejectedPlans': [{
+                'stage': 'COLLSCAN'
+            }]
+        },
+        'executionStats': {
+            'executionTimeMillis': 12
+        }
+    }
+    plan, indexes, server_time = profiling.summarise_explanation(explanation)
+    assert plan == 'FETCH < IXSCAN'
+    assert indexes == ['state.make_1']
+    assert server_time == 0.012
+
+
+def test_query_history_model():
+    history = profiling.QueryHistoryModel(max_profiles=2)
+    for num_records in (3, 1, 2):
+        profile = profiling.QueryProfile({'limit': num_records})
+        profile.delivered(list(range(num_records)), 0.)
+        history.add_profile(profile)
+
+    # Only the most recent are kept
+    assert history.rowCount() == 2
+    column = profiling.QueryHistoryModel.COLUMNS.index('Records')
+    assert history.data(history.index(0, column), common.DataRole) == 1
+
+    proxy = QtCore.QSortFilterProxyModel()
+    proxy.setSourceModel(history)
+    proxy.setSortRole(common.DataRole)
+    proxy.sort(column, QtCore.Qt.DescendingOrder)
+    assert proxy.data(proxy.index(0, column), common.DataRole) == 2
+
+
+def test_find_pipeline(historian: mincepy.Historian):
+    cars = [testing.Car(make=str(idx)) for idx in range(6)]
+    for idx, car in enumerate(cars):
+        car.save()
+        historian.meta.set(car, {'reg': idx % 2})
+
+    # The pipeline that is explained finds the same records as the archive does
+    query = {'obj_type': testing.Car, 'meta': {'reg': 1}, 'sort': {'state.make': -1}, 'limit': 2}
+    pipeline = profiling._get_find_pipeline(historian, query, {'obj_id': 1})  # pylint: disable=protected-access
+    found = historian.archive.data_collection.aggregate(pipeline)
+    assert [entry['obj_id'] for entry in found] == \
+        [record.obj_id for record in historian.records.find(**query)]
+
+
+def test_profiler_dialog(qtbot, historian: mincepy.Historian, monkeypatch):
+    explained = []
+
+    def explain(_historian, query, projection=None, verbosity='queryPlanner'):
+        explained.append((query, projection, verbosity))
+        return {'queryPlanner': {'winningPlan': {'stage': 'COLLSCAN'}}}
+
+    monkeypatch.setattr(profiling, 'explain', explain)
+    history = profiling.QueryHistoryModel()
+    dialog = profiling.QueryProfilerDialog(history, lambda: historian)
+    qtbot.addWidget(dialog)
+    source = sources.QueryRecordSource(historian, {'obj_type': testing.Car})
+    for _ in range(2):
+        profile = profiling.QueryProfile({'obj_type': testing.Car})
+        profile.first_query = profiling.get_first_query(source)
+        history.add_profile(profile)
+
+    # Queries are only explained when they are looked at, and only once
+    assert not explained
+    table = dialog._table  # pylint: disable=protected-access
+    for row in (1, 0, 1):
+        table.setCurrentIndex(table.model().index(row, 0))
+    assert [entry[2] for entry in explained] == ['queryPlanner', 'queryPlanner']
+    assert explained[0][0] == source.first_query()[0]
+    assert history.get_profile(1).plan == 'COLLSCAN'
+
+    dialog._explain_button.click()  # pylint: disable=protected-access
+    assert explained[-1][2] == 'executionStats'
@@ -0,0 +1,78 @@
+"""Test the query model and scheduling"""
+import uuid
+
+import bson
+
+from mincepy_gui import query
+from mincepy_gui import utils
+
+
+def test_normalise_query():
+    obj_id = uuid.uuid4()
+    assert query.normalise_query({'obj_type': 'car', 'version': 1}) == \
+           query.normalise_query({'version': 1, 'obj_type': 'car', 'meta': None})
+    assert query.normalise_query({'obj_id': [obj_id]}) == \
+           query.normalise_query({'obj_id': [str(obj_id).upper()]})
+
+    # The order of the sort criteria matters
+    assert query.normalise_query({'sort': {'a': 1, 'b': 1}}) != \
+           query.normalise_query({'sort': {'b': 1, 'a': 1}})
+
+
+def test_query_scheduler(qtbot):
+    query_model = query.QueryModel()
+    scheduler = query.QueryScheduler(query_model, delay=10)
+    executed = []
+    scheduler.execute_requested.connect(executed.append)
+
+    # Changes in quick succession are coalesced into one execution
+    with qtbot.waitSignal(scheduler.execute_requested):
+        query_model.set_type_restriction('car')
+        query_model.set_sort({'state.make': 1})
+    assert executed == [{'obj_type': 'car', 'sort': {'state.make': 1}}]
+
+    # Changing the query and changing it back again within the window does nothing
+    query_model.set_type_restriction('bike')
+    query_model.set_type_restriction('car')
+    assert scheduler.pending
+    qtbot.waitUntil(lambda: not scheduler.pending)
+    assert len(executed) == 1
+
+    # Neither does changing to a query that is already being shown
+    query_model.set_sort({'state.make': -1})
+    scheduler.mark_executed(query_model.get_query())
+    scheduler.flush()
+    assert len(executed) == 1
+
+
+def test_query_codec():
+    obj_id = uuid.uuid4()
+    object_id = bson.ObjectId()
+    codec = utils.QueryCodec()
+    query = {'obj_id': obj_id, 'ref': object_id, 'name': 'UUID(invalid)'}
+
+    text = codec.encode(query)
+    assert codec.decode(text) == query
+    # The same query gives back the same string without encoding again
+    assert codec.encode(query) is text
+    assert codec.decode(codec.encode([str(obj_id), repr(obj_id)])) == [str(obj_id), obj_id]
+    assert codec.decode(codec.encode(obj_id)) == obj_id
+    # Queries without literals are decoded as they are
+    assert codec.decode('{"state.make": "ford", "limit": 5}') == {'state.make': 'ford', 'limit': 5}
+
+
+def test_query_codec_nested():
+    """Only top level literals are decoded, nested ones are left as strings"""
+    obj_id = uuid.uuid4()
+    object_id = bson.ObjectId()
+    codec = utils.QueryCodec()
+    query = {'obj_id': {'$in': [obj_id, object_id]}, 'state': {'owner': obj_id}}
+
+    assert codec.decode(codec.encode(query)) == {
+        'obj_id': {
+            '$in': [repr(obj_id), repr(object_id)]
+        },
+        'state': {
+            'owner': repr(obj_id)
+        }
+    }
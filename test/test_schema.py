@@ -0,0 +1,72 @@
+# pylint: disable=unused-import, redefined-outer-name
+"""Test the schema sampling"""
+import mincepy
+from mincepy import testing
+from mincepy.testing import archive_uri, historian
+
+from mincepy_gui import schema
+
+
+def test_schema_index():
+    index = schema.SchemaIndex()
+    states = [{'make': 'ford', 'parts': [{'name': 'wheel'}]}, {'make': 5}]
+    records = [
+        mincepy.DataRecord.new_builder(obj_id=1,
+                                       type_id='car',
+                                       state=state,
+                                       snapshot_hash=None,
+                                       state_types=None).build() for state in states
+    ]
+    index.add('car', records)
+
+    assert index.get_paths('car') == [('state.make', 1.), ('state.parts', 0.5),
+                                      ('state.parts.name', 0.5)]
+    assert index.get_types('state.make') == {'str': 0.5, 'int': 0.5}
+    assert index.get_paths('boat') == []
+
+    # Only values that the database compares with each other count as one type
+    assert not index.is_single_type('state.make')
+    assert index.is_single_type('state.parts')
+    assert not index.is_single_type('state.colour')
+    states = [{'make': 5.5}, {'make': 5}, {'make': None}]
+    boats = [
+        mincepy.DataRecord.new_builder(obj_id=2,
+                                       type_id='boat',
+                                       state=state,
+                                       snapshot_hash=None,
+                                       state_types=None).build() for state in states
+    ]
+    index.add('boat', boats)
+    assert index.is_single_type('state.make', 'boat')
+
+    # Decaying keeps the frequencies the same but makes room for new samples
+    index.decay('car', 0.5)
+    assert index.num_sampled('car') == 1.
+    assert index.get_paths('car')[0] == ('state.make', 1.)
+
+
+def test_schema_sampler(historian: mincepy.Historian):
+    for idx in range(20):
+        testing.Car(make=str(idx)).save()
+
+    sampler = schema.SchemaSampler(sample_size=8, max_samples=12)
+    updates = []
+    sampler.updated.connect(lambda: updates.append(True))
+    sampler.set_historian(historian)
+    assert len(updates) == 1
+    index = sampler.index
+    car_type = historian.get_obj_type_id(testing.Car)
+    assert index.num_sampled(car_type) == 8
+    assert [path for path, _ in index.get_paths(car_type)] == ['state.colour', 'state.make']
+
+    # Refreshing samples more but never more than the maximum
+    sampler.refresh()
+    assert index.num_sampled(car_type) == 12
+    assert index.type_ids() == [car_type]
+    # No new paths were found so there was nothing to tell anyone
+    assert len(updates) == 1
+
+    testing.Person('martin', 35).save()
+    sampler.refresh()
+    assert len(updates) == 2
+    sampler.set_historian(None)
@@ -0,0 +1,343 @@
+# pylint: disable=unused-import, redefined-outer-name
+"""Test the record sources"""
+import bson
+import mincepy
+from mincepy import testing
+from mincepy.testing import archive_uri, historian
+
+from mincepy_gui import sources
+
+
+def test_query_source_paging(historian: mincepy.Historian):
+    for idx in range(10):
+        testing.Car(make=str(idx)).save()
+
+    source = sources.QueryRecordSource(historian, {'sort': {'state.make': mincepy.ASCENDING}})
+    assert [record.state['make'] for record in source] == [str(idx) for idx in range(10)]
+    assert [record.state['make'] for record in source.page(3, 4)] == ['3', '4', '5', '6']
+
+    # Check that paging respects the skip and limit of the query itself
+    source = sources.QueryRecordSource(historian, {
+        'sort': {
+            'state.make': mincepy.ASCENDING
+        },
+        'skip': 2,
+        'limit': 5
+    })
+    assert [record.state['make'] for record in source.page(3, 4)] == ['5', '6']
+    assert source.count() == 5
+
+
+def test_query_source_projection(historian: mincepy.Historian):
+    for idx in range(10):
+        testing.Car(make=str(idx), colour='red').save()
+
+    source = sources.QueryRecordSource(historian, {'sort': {
+        'state.make': mincepy.ASCENDING
+    }},
+                                       projection=lambda: ['creation_time', 'state.make'])
+    records = list(source)
+    assert len(records) == 10
+    assert [record.state['make'] for record in records] == [str(idx) for idx in range(10)]
+
+    assert all(isinstance(record, sources.PartialRecord) for record in records)
+    for record in records:
+        # Only the state entries that were asked for are fetched
+        assert record.state == {'make': record.state['make']}
+        assert record.creation_time is not None
+        assert record.obj_id is not None
+        assert record.snapshot_hash is None
+        assert record.state_types is None
+
+    full = sources.load_full_record(historian, records[5])
+    assert not isinstance(full, sources.PartialRecord)
+    assert full.state['colour'] == 'red'
+    assert full.obj_id == records[5].obj_id
+
+    # Many can be loaded at once, records that are already full are kept as they are
+    loaded = sources.load_full_records(historian, [records[2], full, records[7]])
+    assert [record.obj_id for record in loaded] == \
+        [records[2].obj_id, full.obj_id, records[7].obj_id]
+    assert loaded[1] is full
+    assert all(record.state['colour'] == 'red' for record in loaded)
+
+
+def test_get_projection():
+    assert sources.get_projection(['state', 'state.colour', 'creation_time']) == {
+        'creation_time': 1,
+        'obj_id': 1,
+        'state': 1,
+        'type_id': 1,
+        'version': 1,
+    }
+
+
+def test_caching_source(historian: mincepy.Historian):
+    for idx in range(10):
+        testing.Car(make=str(idx)).save()
+
+    cached = []
+    source = sources.CachingRecordSource(sources.QueryRecordSource(historian, {}), cached.append)
+    assert source.count() == 10
+
+    # Only complete iterations are passed on
+    iterator = iter(source)
+    next(iterator)
+    iterator.close()
+    assert not cached
+
+    records = list(source)
+    assert cached == [records]
+
+    # Records seen through paging count too
+    cached = []
+    source = sources.CachingRecordSource(sources.QueryRecordSource(historian, {}), cached.append)
+    assert source.count() == 10
+    records = source.page(0, 6)
+    assert not cached
+    records.extend(source.page(6, 6))
+    assert cached == [records]
+
+    # Too many to cache
+    source = sources.CachingRecordSource(sources.QueryRecordSource(historian, {}),
+                                         cached.append,
+                                         max_records=5)
+    assert len(list(source)) == 10
+    assert len(cached) == 1
+
+    # Iterables that can't be paged can be cached too
+    cached = []
+    iterable = sources.CachingIterable(
+        sources.ObjIdLookupSource(historian, [rec.obj_id for rec in records]), cached.append)
+    assert not isinstance(iterable, sources.RecordSource)
+    assert [record.obj_id for record in iterable] == [record.obj_id for record in cached[0]]
+
+    cached_source = sources.ListRecordSource(records)
+    assert list(cached_source) == records
+    assert cached_source.page(8, 4) == records[8:]
+    assert cached_source.count() == 10
+
+
+def test_keyset_source(historian: mincepy.Historian):
+    makes = ['b', 'a', None, 'c', 'a', 'b', None, 'a', 'c', 'b']
+    for make in makes:
+        testing.Car(make=make).save()
+
+    for direction in (mincepy.ASCENDING, mincepy.DESCENDING):
+        query = {'sort': {'state.make': direction}}
+        expected = list(sources.QueryRecordSource(historian, query))
+        expected_makes = [record.state['make'] for record in expected]
+        assert expected_makes == sorted(makes,
+                                        key=lambda make: (make is not None, make or ''),
+                                        reverse=direction == mincepy.DESCENDING)
+
+        source = sources.KeysetRecordSource(historian, query, page_size=3)
+        assert source.keyset
+        records = list(source)
+        assert [record.state['make'] for record in records] == expected_makes
+        assert len({record.obj_id for record in records}) == len(makes)
+
+        # Pages following a bookmark and ones that aren't give the same as iterating
+        source = sources.KeysetRecordSource(historian,
+                                            query,
+                                            projection=lambda: ['state.colour'],
+                                            page_size=2)
+        obj_ids = [record.obj_id for record in records]
+        assert [record.obj_id for record in source.page(4, 3)] == obj_ids[4:7]
+        assert [record.obj_id for record in source.page(7, 3)] == obj_ids[7:]
+        assert [record.state['make'] for record in source.page(2, 2)] == expected_makes[2:4]
+
+        # Far pages are found by key from wherever the nearest bookmark is, even past the end
+        source = sources.KeysetRecordSource(historian, query, page_size=2)
+        assert [record.obj_id for record in source.page(8, 5)] == obj_ids[8:]
+        assert source.page(20, 3) == []
+
+    # Seeking gives the position of the first record at or after the value in the sort order
+    source = sources.KeysetRecordSource(historian, {'sort': {'state.make': mincepy.ASCENDING}})
+    position, records = source.seek('b', 2)
+    assert position == 5
+    assert [record.state['make'] for record in records] == ['b', 'b']
+    source = sources.KeysetRecordSource(historian, {'sort': {'state.make': mincepy.DESCENDING}})
+    position, records = source.seek('bb', 10)
+    assert position == 2
+    assert [record.state['make'] for record in records
+           ] == ['b', 'b', 'b', 'a', 'a', 'a', None, None]
+
+    # Without a sort the natural order is kept
+    source = sources.KeysetRecordSource(historian, {}, page_size=3)
+    assert not source.keyset
+    natural = [record.obj_id for record in historian.records.find()]
+    assert [record.obj_id for record in source] == natural
+    assert [record.obj_id for record in source.page(5, 3)] == natural[5:8]
+
+    # Unless it's turned off, e.g. because the values may be of different types
+    query = {'sort': {'state.make': mincepy.ASCENDING}}
+    source = sources.KeysetRecordSource(historian, query, keyset=False)
+    assert not source.keyset
+    assert [record.obj_id for record in source.page(2, 3)] == \
+           [record.obj_id for record in sources.QueryRecordSource(historian, query).page(2, 3)]
+
+    # Can't do keyset paging on multiple sort keys
+    assert not sources.KeysetRecordSource(historian, {
+        'sort': {
+            'state.make': 1,
+            'state.colour': 1
+        }
+    }).keyset
+
+
+def test_keyset_source_removed(historian: mincepy.Historian):
+    cars = [testing.Car(make=make) for make in 'abcdefgh']
+    for car in cars:
+        car.save()
+
+    query = {'sort': {'state.make': mincepy.ASCENDING}}
+    source = sources.KeysetRecordSource(historian, query, page_size=2)
+    assert [record.state['make'] for record in source.page(0, 6)] == list('abcdef')
+
+    # Once records are deleted the bookmarks after them are shifted to match
+    historian.delete(cars[1], cars[2])
+    source.removed([(1, 3)])
+    assert [record.state['make'] for record in source.page(3, 2)] == list('fg')
+    assert [record.state['make'] for record in source.page(0, 10)] == list('adefgh')
+
+
+def test_first_query(historian: mincepy.Historian):
+    # The first records of a keyset source are fetched a page at a time, by key
+    query = {'sort': {'state.make': -1}}
+    source = sources.KeysetRecordSource(historian,
+                                        query,
+                                        projection=lambda: ['state.make'],
+                                        page_size=3)
+    query, projection = source.first_query()
+    assert list(query['sort'].items()) == [('state.make', -1), ('obj_id', 1)]
+    assert query['skip'] == 0
+    assert query['limit'] == 3
+    assert projection == sources.get_projection(['state.make'])
+
+    # Otherwise they are all fetched in one go
+    source = sources.KeysetRecordSource(historian, {'limit': 10})
+    query, projection = source.first_query()
+    assert query['limit'] == 10
+    assert 'sort' not in query
+    assert projection is None
+
+
+def test_obj_id_lookup(historian: mincepy.Historian):
+    obj_ids = [testing.Car(make=str(idx)).save() for idx in range(20)]
+    obj_ids.reverse()
+    # Strings work too, as do ids that aren't found
+    obj_ids[3] = str(obj_ids[3])
+    obj_ids.insert(5, bson.ObjectId())
+    obj_ids.insert(10, obj_ids[0])
+
+    source = sources.ObjIdLookupSource(historian,
+                                       obj_ids,
+                                       preserve_order=True,
+                                       chunk_size=3,
+                                       max_in_flight=2)
+    makes = [record.state['make'] for record in source]
+    assert makes == [str(idx) for idx in reversed(range(20))]
+
+    source = sources.ObjIdLookupSource(historian, obj_ids, {'obj_type': testing.Car}, chunk_size=3)
+    assert sorted(int(record.state['make']) for record in source) == list(range(20))
+
+    # With a sort the chunks are merged so the records are in order across all of them
+    for direction in (mincepy.ASCENDING, mincepy.DESCENDING):
+        query = {'sort': {'state.make': direction}}
+        source = sources.ObjIdLookupSource(historian,
+                                           obj_ids,
+                                           query,
+                                           preserve_order=True,
+                                           chunk_size=3,
+                                           max_in_flight=2)
+        makes = [record.state['make'] for record in source]
+        assert makes == sorted(makes, reverse=direction == mincepy.DESCENDING)
+        assert len(makes) == 20
+
+        # A skip and limit apply to the records of all the chunks, not to each one
+        query.update(skip=2, limit=5)
+        source = sources.ObjIdLookupSource(historian, obj_ids, query, chunk_size=3)
+        assert [record.state['make'] for record in source] == makes[2:7]
+
+    source = sources.ObjIdLookupSource(historian,
+                                       obj_ids,
+                                       query={'limit': 7},
+                                       preserve_order=True,
+                                       chunk_size=3)
+    assert [record.state['make'] for record in source] == [str(idx) for idx in range(19, 12, -1)]
+
+
+def test_obj_id_lookup_sorted_streams(historian: mincepy.Historian, monkeypatch):
+    obj_ids = [testing.Car(make=str(idx % 10), colour=str(idx)).save() for idx in range(20)]
+    lookups = []
+    lookup = sources.ObjIdLookupSource._lookup  # pylint: disable=protected-access
+
+    def counting_lookup(self, chunk, skip, limit):
+        lookups.append((skip, limit))
+        return lookup(self, chunk, skip, limit)
+
+    monkeypatch.setattr(sources.ObjIdLookupSource, '_lookup', counting_lookup)
+
+    # 4 chunks of 5 records, each fetched in 3 pages
+    source = sources.ObjIdLookupSource(historian,
+                                       obj_ids, {'sort': {
+                                           'state.make': mincepy.DESCENDING
+                                       }},
+                                       projection=lambda: ['state.colour'],
+                                       chunk_size=5,
+                                       page_size=2)
+    records = iter(source)
+    first = next(records)
+    # Only the first page of each chunk, plus the ones after that are being prefetched, are needed
+    # before the first record is produced
+    assert len(lookups) <= 8
+    rest = list(records)
+    assert len(lookups) == 12
+    makes = [record.state['make'] for record in [first] + rest]
+    assert makes == sorted(makes, reverse=True)
+    assert len(makes) == 20
+    # The paths sorted on are fetched along with those asked for
+    assert isinstance(first, sources.PartialRecord)
+    assert set(first.state) == {'make', 'colour'}
+
+    # No more than the first records of each chunk, up to the limit, are fetched
+    del lookups[:]
+    query = {'sort': {'state.make': mincepy.ASCENDING}, 'limit': 2}
+    source = sources.ObjIdLookupSource(historian, obj_ids, query, chunk_size=5, page_size=2)
+    assert [record.state['make'] for record in source] == ['0', '0']
+    assert lookups == [(0, 2)] * 4
+
+
+def test_obj_id_lookup_shared_pool(historian: mincepy.Historian):
+    obj_ids = [testing.Car().save() for _ in range(4)]
+    source1 = sources.ObjIdLookupSource(historian, obj_ids, chunk_size=2)
+    source2 = sources.ObjIdLookupSource(historian, obj_ids, chunk_size=2)
+    assert source1._pool is source2._pool  # pylint: disable=protected-access
+    assert len(list(source1)) == len(list(source2)) == 4
+
+
+def test_obj_id_list_source(historian: mincepy.Historian):
+    cars = [testing.Car(make=str(idx)) for idx in range(10)]
+    obj_ids = [car.save() for car in cars]
+    obj_ids.reverse()
+
+    source = sources.ObjIdListSource(historian, obj_ids, projection=lambda: ['state.make'])
+    assert source.count() == 10
+    assert [record.state['make'] for record in source.page(2, 3)] == ['7', '6', '5']
+    assert all(isinstance(record, sources.PartialRecord) for record in source)
+
+    # Removed positions are dropped from the list
+    historian.delete(cars[8], cars[7])
+    source.removed([(1, 3)])
+    assert source.count() == 8
+    assert [record.state['make'] for record in source.page(0, 3)] == ['9', '6', '5']
+
+
+def test_is_always_fetched():
+    assert sources.is_always_fetched('obj_id')
+    assert sources.is_always_fetched('type_id')
+    assert not sources.is_always_fetched('state')
+    assert not sources.is_always_fetched('state.colour')
+    assert not sources.is_always_fetched('creation_time')
+    assert not sources.is_always_fetched('obj_idx')